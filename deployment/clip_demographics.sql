@@ -1,20 +1,26 @@
 -- Function to clip demographics features to region boundaries.
 -- Proportionally allocates values to remaining area of clipped feature.
+--
+-- Features are clipped in sets rather than one at a time: those the region covers
+-- are left alone, those it doesn't touch are deleted, and only the features
+-- crossing its edge are intersected with it. The region is passed unchanged to
+-- every ST_Covers and ST_Intersects call, so PostGIS prepares it once and reuses it.
+--
+-- Only features with ids from min_id to max_id (all features, if they're NULL)
+-- are clipped, so a large table can be clipped in chunks, in parallel or in
+-- separate transactions. Clipping a feature twice leaves it unchanged.
+-- Returns the number of features clipped plus the number deleted.
 
 DROP FUNCTION IF EXISTS ClipDemographics();
+DROP FUNCTION IF EXISTS ClipDemographics(integer, integer);
 
-CREATE OR REPLACE FUNCTION ClipDemographics()
-  RETURNS void AS
+CREATE OR REPLACE FUNCTION ClipDemographics(min_id integer DEFAULT NULL, max_id integer DEFAULT NULL)
+  RETURNS integer AS
 $$
 DECLARE
   region geometry;
-  diff geometry;
-  intersection geometry;
-  min_feature_id int4;
-  max_feature_id int4;
-  feature_area NUMERIC;  -- in SRID units
-  intersection_area NUMERIC;
-  contained_proportion NUMERIC;
+  num_clipped integer;
+  num_deleted integer;
 BEGIN
   region := geom FROM datasources_boundary WHERE id = (SELECT region_boundary_id FROM transit_indicators_otiindicatorsconfig);
   IF (region IS NULL) THEN
@@ -23,7 +29,7 @@ BEGIN
     IF (region IS NULL) THEN
       RAISE WARNING 'Found neither city nor region bounds to which to clip demographics.';
       -- nothing to do; bail
-      RETURN;
+      RETURN 0;
     ELSE
       RAISE INFO 'Going to clip demographics features to city boundary (region boundary not found).';
     END IF;
@@ -31,38 +37,42 @@ BEGIN
     RAISE INFO 'Going to clip demographics features to region boundary.';
   END IF;
 
-  min_feature_id := min(id) FROM datasources_demographicdatafeature;
-  max_feature_id := max(id) FROM datasources_demographicdatafeature;
+  min_id := COALESCE(min_id, (SELECT min(id) FROM datasources_demographicdatafeature));
+  max_id := COALESCE(max_id, (SELECT max(id) FROM datasources_demographicdatafeature));
 
-  FOR feat_id IN min_feature_id..max_feature_id Loop
-
-    -- find the portion of the feature, if any, not contained in the region
-    diff := ST_Difference((SELECT geom FROM datasources_demographicdatafeature WHERE id = feat_id), region);
-
-    IF (ST_IsEmpty(diff) IS FALSE) THEN
-      intersection := ST_Intersection((SELECT geom FROM datasources_demographicdatafeature WHERE id = feat_id), region);
-
-      IF (ST_IsEmpty(intersection) IS TRUE) THEN
-        RAISE INFO 'Deleting demographics feature % completely outside region.', feat_id;
-        DELETE FROM datasources_demographicdatafeature WHERE id=feat_id;
-      ELSE
-        -- set feature to clipped geom with proportionally allocated metric values by area
-        intersection_area := ST_Area(intersection);
-        feature_area := ST_Area(geom) FROM datasources_demographicdatafeature WHERE id = feat_id;
-        contained_proportion := intersection_area / feature_area;
-        RAISE INFO '% percent of area of demographics feature % is within region; clipping.', contained_proportion, feat_id;
-        UPDATE datasources_demographicdatafeature
-          SET geom = ST_Multi(intersection),
-            population_metric_1 = population_metric_1 * contained_proportion,
-            population_metric_2 = population_metric_2 * contained_proportion,
-            destination_metric_1 = destination_metric_1 * contained_proportion
-          WHERE id = feat_id;
-      END IF;
-    END IF;
-
-  END Loop;
+  WITH crossing AS (
+    -- the features not entirely within the region, with the part of each that is;
+    -- the part is NULL for features outside the region and empty for those touching it
+    SELECT id, area,
+           CASE WHEN ST_Intersects(region, geom)
+                THEN ST_CollectionExtract(ST_Intersection(geom, region), 3)
+           END AS clipped
+    FROM (SELECT id, geom, ST_Area(geom) AS area
+          FROM datasources_demographicdatafeature
+          WHERE id BETWEEN min_id AND max_id
+            AND NOT ST_Covers(region, geom)) outside
+  ), deleted AS (
+    DELETE FROM datasources_demographicdatafeature f
+      USING crossing c
+      WHERE f.id = c.id AND (c.clipped IS NULL OR ST_IsEmpty(c.clipped) OR ST_Area(c.clipped) = 0)
+      RETURNING f.id
+  ), clipped AS (
+    -- set feature to clipped geom with proportionally allocated metric values by area
+    UPDATE datasources_demographicdatafeature f
+      SET geom = ST_Multi(c.clipped),
+        population_metric_1 = f.population_metric_1 * ST_Area(c.clipped) / c.area,
+        population_metric_2 = f.population_metric_2 * ST_Area(c.clipped) / c.area,
+        destination_metric_1 = f.destination_metric_1 * ST_Area(c.clipped) / c.area
+      FROM crossing c
+      WHERE f.id = c.id AND NOT ST_IsEmpty(c.clipped) AND ST_Area(c.clipped) > 0
+      RETURNING f.id
+  )
+  SELECT (SELECT count(*) FROM clipped), (SELECT count(*) FROM deleted)
+    INTO num_clipped, num_deleted;
 
+  RAISE INFO 'Clipped % and deleted % demographics features.', num_clipped, num_deleted;
+  RETURN num_clipped + num_deleted;
 END;
 $$ LANGUAGE plpgsql;
 
-ALTER FUNCTION ClipDemographics() OWNER TO transit_indicators;
+ALTER FUNCTION ClipDemographics(integer, integer) OWNER TO transit_indicators;
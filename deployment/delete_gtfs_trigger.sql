@@ -1,7 +1,10 @@
--- Trigger function to delete GTFS data when Django model object with feed metadata is deleted
+-- Trigger function to delete GTFS data when the last Django model object with feed
+-- metadata is deleted. A new feed can be uploaded while the old one is still there;
+-- the old one is deleted once the new one is loaded, keeping the new one's data.
 DROP TRIGGER IF EXISTS empty_gtfs on datasources_gtfsfeed;
 
-CREATE OR REPLACE FUNCTION empty_gtfs() RETURNS trigger AS $empty_gtfs$
+-- Empties the gtfs tables, once the last feed is deleted
+CREATE OR REPLACE FUNCTION EmptyGtfs() RETURNS void AS $$
     BEGIN
         -- Note:  cannot use TRUNCATE in a trigger, as there are active database connections
         -- (from Windshaft and Django)
@@ -29,16 +32,34 @@ CREATE OR REPLACE FUNCTION empty_gtfs() RETURNS trigger AS $empty_gtfs$
         EXECUTE 'DELETE FROM gtfs_trips';
         EXECUTE 'DELETE FROM gtfs_wheelchair_accessibility';
         EXECUTE 'DELETE FROM gtfs_wheelchair_boardings';
+        -- deviations from the schedule are rebuilt by the next realtime import
+        EXECUTE 'DROP TABLE IF EXISTS gtfs_stop_time_deviations';
+        -- the cached feeds are kept, but none of them are loaded anymore
+        EXECUTE 'UPDATE datasources_gtfsfeedcache SET is_loaded = FALSE';
+    END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION empty_gtfs() RETURNS trigger AS $empty_gtfs$
+    BEGIN
+        IF EXISTS (SELECT 1 FROM datasources_gtfsfeed) THEN
+            -- a replaced feed, deleted once the feed replacing it is loaded: the tables
+            -- hold the new feed's data, but what was derived from the old schedule is
+            -- out of date (deviations are rebuilt when indicators next read them)
+            EXECUTE 'DELETE FROM gtfs_stops_buffers';
+            EXECUTE 'DROP TABLE IF EXISTS gtfs_stop_time_deviations';
+            RETURN NULL;
+        END IF;
+        PERFORM EmptyGtfs();
         EXECUTE 'ALTER SEQUENCE datasources_gtfsfeed_id_seq RESTART WITH 1';
         EXECUTE 'ALTER SEQUENCE datasources_gtfsfeedproblem_id_seq RESTART WITH 1';
 
-        EXECUTE 'DROP TABLE IF EXISTS planet_osm_line';
-        EXECUTE 'DROP TABLE IF EXISTS planet_osm_point';
-        EXECUTE 'DROP TABLE IF EXISTS planet_osm_polygon';
-        EXECUTE 'DROP TABLE IF EXISTS planet_osm_roads';
+        -- the planet_osm_* tables (and the road lengths measured from them) are kept, so
+        -- the OSM import for the next feed can reuse them; see datasources_osmimportrecord
         RETURN NULL;
     END;
 $empty_gtfs$ LANGUAGE plpgsql;
 
 CREATE TRIGGER empty_gtfs AFTER DELETE ON datasources_gtfsfeed
     FOR EACH STATEMENT EXECUTE PROCEDURE empty_gtfs();
+
+ALTER FUNCTION EmptyGtfs() OWNER TO transit_indicators;
@@ -1,26 +1,54 @@
 -- Function to create regular grid of points with proportionately allocated demographic values.
+--
+-- The grid is generated set-wise with generate_series, directly in the UTM SRID of
+-- the GTFS stops, with a point at the center of each resolution x resolution meter
+-- cell of the demographic features' extent. Each point is assigned the feature it
+-- falls in through a join on a GiST index of the points, and gets an equal share of
+-- that feature's metrics. Points outside every feature are left out.
+--
+-- PrepareDemographicGrid and IndexDemographicGrid are the steps before and after
+-- filling the grid, shared with the NumPy engine that rasterizes it instead.
 
 DROP FUNCTION IF EXISTS CreateGrid();
+DROP FUNCTION IF EXISTS CreateGrid(double precision);
+DROP FUNCTION IF EXISTS PrepareDemographicGrid();
+DROP FUNCTION IF EXISTS IndexDemographicGrid();
 
-CREATE OR REPLACE FUNCTION CreateGrid()
+-- Reprojects the demographic features to UTM and creates an empty demographic_grid
+CREATE OR REPLACE FUNCTION PrepareDemographicGrid()
   RETURNS void AS
 $$
+DECLARE
+    utm_srid integer;
 BEGIN
-    DROP TABLE IF EXISTS demographic_grid;
+    utm_srid := Find_SRID('public', 'gtfs_stops', 'geom');
 
-    -- get grid points with SRID (ST_Extent returns object without geometry)
-    CREATE TABLE demographic_grid AS
-    SELECT (pts.grid).geom AS geom
-    FROM (SELECT ST_RegularGrid(geom, 500, 500) AS grid
-    FROM (SELECT ST_SetSRID(ST_Extent(geom),
-    find_srid('public', 'datasources_demographicdatafeature', 'geom')) AS geom
-    FROM datasources_demographicdatafeature) AS box) AS pts;
+    -- Reproject original polygons to UTM
+    ALTER TABLE datasources_demographicdatafeature DROP COLUMN IF EXISTS utm_geom;
+    EXECUTE 'ALTER TABLE datasources_demographicdatafeature ADD COLUMN utm_geom geometry(MultiPolygon, '
+            || utm_srid || ')';
+    UPDATE datasources_demographicdatafeature SET utm_geom = ST_Transform(geom, utm_srid);
+    CREATE INDEX datasources_demographicdatafeature_utm_geom_id
+        ON datasources_demographicdatafeature USING GIST (utm_geom);
+    ANALYZE datasources_demographicdatafeature;
 
-    ALTER TABLE demographic_grid ADD COLUMN feature_id integer;
-    ALTER TABLE demographic_grid ADD COLUMN population_metric_1 double precision;
-    ALTER TABLE demographic_grid ADD COLUMN population_metric_2 double precision;
-    ALTER TABLE demographic_grid ADD COLUMN destination_metric_1 double precision;
+    DROP TABLE IF EXISTS demographic_grid;
+    EXECUTE 'CREATE TABLE demographic_grid (
+                 geom geometry(Point, ' || utm_srid || '),
+                 feature_id integer,
+                 population_metric_1 double precision,
+                 population_metric_2 double precision,
+                 destination_metric_1 double precision)';
+END;
+$$ LANGUAGE plpgsql;
+
+-- Indexes a filled demographic_grid and links it to the features
+CREATE OR REPLACE FUNCTION IndexDemographicGrid()
+  RETURNS void AS
+$$
+BEGIN
     CREATE INDEX demographic_grid_feature_id ON demographic_grid(feature_id);
+    CREATE INDEX demographic_grid_geom ON demographic_grid USING GIST (geom);
 
     -- create FK, so the demographic_grid values will be deleted on related features deletion
     ALTER TABLE demographic_grid ADD CONSTRAINT demographic_grid_feature_id_fk
@@ -28,39 +56,67 @@ BEGIN
                 REFERENCES datasources_demographicdatafeature(id)
                 ON DELETE CASCADE;
 
-    UPDATE demographic_grid g SET feature_id = (SELECT id FROM datasources_demographicdatafeature f
-    WHERE ST_Intersects(f.geom, g.geom));
+    ANALYZE demographic_grid;
+END;
+$$ LANGUAGE plpgsql;
 
-    DELETE FROM demographic_grid WHERE feature_id IS NULL;
+CREATE OR REPLACE FUNCTION CreateGrid(resolution double precision DEFAULT 500)
+  RETURNS void AS
+$$
+DECLARE
+    utm_srid integer;
+    extent box2d;
+    min_col integer;
+    max_col integer;
+    min_row integer;
+    max_row integer;
+BEGIN
+    PERFORM PrepareDemographicGrid();
+    utm_srid := Find_SRID('public', 'gtfs_stops', 'geom');
 
-    -- create extra table for more efficient update
-    CREATE TEMP TABLE demographic_point_values AS
-    SELECT f.id, f.population_metric_1 / COUNT(g.feature_id) as population_metric_1,
-    f.population_metric_2 / COUNT(g.feature_id) as population_metric_2,
-    f.destination_metric_1 / COUNT(g.feature_id) as destination_metric_1
-    FROM datasources_demographicdatafeature f
-    INNER JOIN demographic_grid g ON (g.feature_id=f.id)
-    GROUP BY f.id;
+    extent := ST_Extent(utm_geom) FROM datasources_demographicdatafeature;
+    IF (extent IS NULL) THEN
+        RAISE WARNING 'No demographics features to create a grid from.';
+        -- leave an empty grid with the same indexes and foreign key as a filled one
+        PERFORM IndexDemographicGrid();
+        RETURN;
+    END IF;
 
-    UPDATE demographic_grid SET population_metric_1 = v.population_metric_1,
-    population_metric_2 = v.population_metric_2,
-    destination_metric_1 = v.destination_metric_1
-    FROM demographic_point_values v
-    WHERE v.id = feature_id;
+    -- cells aligned to multiples of the resolution, as far as they cover the extent
+    min_col := floor(ST_XMin(extent) / resolution);
+    max_col := ceil(ST_XMax(extent) / resolution) - 1;
+    min_row := floor(ST_YMin(extent) / resolution);
+    max_row := ceil(ST_YMax(extent) / resolution) - 1;
 
-    -- Reproject to UTM
-    UPDATE demographic_grid SET geom = ST_Transform(geom, (SELECT Find_SRID('public', 'gtfs_stops', 'geom')));
-    PERFORM UpdateGeometrySRID('public', 'demographic_grid', 'geom', (SELECT Find_SRID('public', 'gtfs_stops', 'geom')));
+    CREATE TEMP TABLE demographic_grid_points (grid_col integer, grid_row integer, geom geometry);
+    INSERT INTO demographic_grid_points
+    SELECT grid_col, grid_row,
+           ST_SetSRID(ST_MakePoint((grid_col + 0.5) * resolution, (grid_row + 0.5) * resolution),
+                      utm_srid)
+    FROM generate_series(min_col, max_col) AS grid_col,
+         generate_series(min_row, max_row) AS grid_row;
+    CREATE INDEX demographic_grid_points_geom ON demographic_grid_points USING GIST (geom);
+    ANALYZE demographic_grid_points;
 
-    -- Reproject original polygons to UTM
---    ALTER TABLE datasources_demographicdatafeature DROP COLUMN utm_geom;
+    -- points in more than one (overlapping) feature go to the one with the lowest id
+    INSERT INTO demographic_grid
+    SELECT geom, feature_id,
+           population_metric_1 / count(*) OVER w,
+           population_metric_2 / count(*) OVER w,
+           destination_metric_1 / count(*) OVER w
+    FROM (SELECT DISTINCT ON (p.grid_col, p.grid_row) p.geom, f.id AS feature_id,
+                 f.population_metric_1, f.population_metric_2, f.destination_metric_1
+          FROM datasources_demographicdatafeature f
+          JOIN demographic_grid_points p ON ST_Intersects(f.utm_geom, p.geom)
+          ORDER BY p.grid_col, p.grid_row, f.id) AS assigned
+    WINDOW w AS (PARTITION BY feature_id);
 
-    ALTER TABLE datasources_demographicdatafeature DROP COLUMN IF EXISTS utm_geom;
-    ALTER TABLE datasources_demographicdatafeature ADD COLUMN utm_geom geometry(MultiPolygon, 4326);
-    PERFORM UpdateGeometrySRID('datasources_demographicdatafeature','utm_geom', (SELECT Find_SRID('public', 'gtfs_stops', 'geom')));
-    UPDATE datasources_demographicdatafeature SET utm_geom = ST_Transform(geom, (SELECT Find_SRID('public', 'gtfs_stops', 'geom')));
+    DROP TABLE demographic_grid_points;
 
+    PERFORM IndexDemographicGrid();
 END;
 $$ LANGUAGE plpgsql;
 
-ALTER FUNCTION CreateGrid() OWNER TO transit_indicators;
+ALTER FUNCTION PrepareDemographicGrid() OWNER TO transit_indicators;
+ALTER FUNCTION IndexDemographicGrid() OWNER TO transit_indicators;
+ALTER FUNCTION CreateGrid(double precision) OWNER TO transit_indicators;
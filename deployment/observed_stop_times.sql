@@ -0,0 +1,14 @@
+-- The service date of the observed stop times compared with the schedule by the
+-- observed-data indicators: the observed_date of the indicator configuration, or the
+-- latest service date loaded if it isn't set. The indicators match observed trips to
+-- scheduled ones by trip_id alone, so they read a single day.
+CREATE OR REPLACE VIEW gtfs_observed_service_date AS
+SELECT coalesce(config.observed_date, latest.service_date) AS service_date
+FROM (SELECT max(service_date) AS service_date FROM gtfs_stop_times_real) latest
+LEFT JOIN transit_indicators_otiindicatorsconfig config ON TRUE;
+
+-- View of the observed stop times of that day
+CREATE OR REPLACE VIEW gtfs_stop_times_observed AS
+SELECT observed.*
+FROM gtfs_stop_times_real observed, gtfs_observed_service_date window_date
+WHERE observed.service_date = window_date.service_date;
@@ -191,6 +191,7 @@ else
         nginx \
         gunicorn \
         libgeos++-dev libpq-dev libbz2-dev proj libtool automake \
+        osmosis \
         monit
 
 fi
@@ -410,6 +411,13 @@ pushd $PROJECT_ROOT
     sudo -u postgres psql -d $DB_NAME -f ./deployment/grid_function.sql
     echo 'Adding PostgreSQL Function to Clip Demographics to Region Bounds'
     sudo -u postgres psql -d $DB_NAME -f ./deployment/clip_demographics.sql
+    echo 'Adding PostgreSQL Function to Measure OSM Roads'
+    sudo -u postgres psql -d $DB_NAME -f ./deployment/road_lengths.sql
+    echo 'Adding PostgreSQL Functions to Compare Observed and Scheduled Stop Times'
+    sudo -u postgres psql -d $DB_NAME -f ./deployment/stop_time_deviations.sql
+    # Run as the transit_indicators user, so the view can be read by GeoTrellis
+    echo 'Adding PostgreSQL View of Observed Stop Times in the Indicator Date Window'
+    PGPASSWORD=$DB_PASS psql -h $DB_HOST -U $DB_USER -d $DB_NAME -f ./deployment/observed_stop_times.sql
     # This needs to be run as the transit_indicators user so that it has ownership
     # over the tables, otherwise changing the SRID from GeoTrellis fails.
     echo 'Adding Shapefile reprojection PostgreSQL triggers'
@@ -443,6 +451,21 @@ exec /usr/local/bin/celery worker --app transit_indicators.celery_settings --que
 celery_datasources_conf_file="/etc/init/oti-celery-datasources.conf"
 echo "$celery_datasources_conf" > "$celery_datasources_conf_file"
 
+# GTFS pre-validation, kept off the datasources queue so it isn't stuck behind imports
+celery_prevalidation_conf="
+start on (filesystem or (vagrant-mounted or cloud-final))
+stop on runlevel [!2345]
+
+kill timeout 30
+
+chdir $DJANGO_ROOT
+
+exec /usr/local/bin/celery worker --app transit_indicators.celery_settings --queue prevalidation --logfile $LOG_ROOT/celery.log -l debug --pidfile /var/run/celery-prevalidation.pid --autoreload --concurrency=1
+"
+
+celery_prevalidation_conf_file="/etc/init/oti-celery-prevalidation.conf"
+echo "$celery_prevalidation_conf" > "$celery_prevalidation_conf_file"
+
 # indicators
 celery_indicators_conf="
 start on (filesystem or (vagrant-mounted or cloud-final))
@@ -474,6 +497,7 @@ celery_scenarios_conf_file="/etc/init/oti-celery-scenarios.conf"
 echo "$celery_scenarios_conf" > "$celery_scenarios_conf_file"
 
 service oti-celery-datasources restart
+service oti-celery-prevalidation restart
 service oti-celery-indicators restart
 service oti-celery-scenarios restart
 
@@ -792,6 +816,11 @@ if [ "$INSTALL_TYPE" != "travis" ]; then
       stop program = "/sbin/stop oti-celery-datasources"
       if cpu usage > 90% for 10 cycles then restart
 
+    # celery prevalidation (GTFS pre-validation task queue)
+    check process prevalidation-queue-celery with pidfile /var/run/celery-prevalidation.pid
+      start program = "/sbin/start oti-celery-prevalidation"
+      stop program = "/sbin/stop oti-celery-prevalidation"
+
     # indicators service (indicator calculation service)
     check process indicator-calc-scala with pidfile /var/run/oti-indicators.pid
       start program = "/sbin/start oti-geotrellis"
@@ -0,0 +1,89 @@
+-- Functions to precompute the length of the OSM roads, so the ratio of transit lines
+-- to roads indicator reads a few numbers instead of loading every road.
+-- Run at the end of each OSM import, and for each boundary once it's imported.
+
+-- (Re)computes osm_road_lengths: the length in meters of the planet_osm_roads (in
+-- their UTM projection) by highway class, for the whole extent (with a NULL
+-- boundary_id) and within each imported boundary. Overlapping roads are counted
+-- once. The whole extent is the one the OSM import covers for the current GTFS
+-- stops: their bounding box, widened by the given margin in degrees. The roads of
+-- an earlier import over a larger extent are kept for later imports to build on,
+-- so the roads table alone may reach further. The row with a NULL highway holds the length of the roads of all classes,
+-- so a segment shared by roads of different classes counts once in it; the rows of
+-- each class (roads without one under '') are a breakdown and shouldn't be summed.
+-- Given a boundary id, only the lengths within that boundary are recomputed.
+DROP FUNCTION IF EXISTS BuildRoadLengths(integer);
+CREATE OR REPLACE FUNCTION BuildRoadLengths(integer DEFAULT NULL,
+                                            double precision DEFAULT 0)
+  RETURNS void AS
+$$
+DECLARE
+  road_srid integer;
+  stop_extent geometry;
+BEGIN
+  CREATE TABLE IF NOT EXISTS osm_road_lengths (
+    boundary_id integer,
+    highway text,
+    length_m double precision
+  );
+
+  IF NOT EXISTS (SELECT 1 FROM information_schema.tables
+                 WHERE table_name = 'planet_osm_roads') THEN
+    DELETE FROM osm_road_lengths;
+    RAISE WARNING 'No OSM roads to measure.';
+    RETURN;
+  END IF;
+  road_srid := Find_SRID('', 'planet_osm_roads', 'way');
+
+  IF $1 IS NULL THEN
+    DELETE FROM osm_road_lengths;
+    SELECT ST_Transform(ST_SetSRID(ST_Expand(ST_Extent(the_geom), $2)::geometry, 4326),
+                        road_srid)
+    INTO stop_extent
+    FROM gtfs_stops;
+    IF stop_extent IS NULL THEN
+      RAISE WARNING 'No GTFS stops to measure the OSM roads around.';
+    ELSE
+      INSERT INTO osm_road_lengths
+      WITH clipped AS (
+        SELECT coalesce(highway, '') AS highway,
+          CASE WHEN ST_CoveredBy(way, stop_extent) THEN way
+               ELSE ST_Intersection(way, stop_extent)
+          END AS way
+        FROM planet_osm_roads
+        WHERE ST_Intersects(way, stop_extent)
+      )
+      SELECT NULL::integer, highway, ST_Length(ST_Union(way))
+      FROM clipped
+      GROUP BY highway
+      UNION ALL
+      SELECT NULL, NULL, coalesce(ST_Length(ST_Union(way)), 0)
+      FROM clipped;
+    END IF;
+  ELSE
+    DELETE FROM osm_road_lengths WHERE boundary_id = $1;
+  END IF;
+
+  -- the all-class rows union the clipped roads again, so they count a segment once
+  INSERT INTO osm_road_lengths
+  WITH clipped AS (
+    SELECT boundary.id AS boundary_id, coalesce(roads.highway, '') AS highway,
+      CASE WHEN ST_CoveredBy(roads.way, boundary.geom) THEN roads.way
+           ELSE ST_Intersection(roads.way, boundary.geom)
+      END AS way
+    FROM planet_osm_roads roads
+    JOIN (SELECT id, ST_Transform(geom, road_srid) AS geom
+          FROM datasources_boundary
+          WHERE status = 'complete' AND geom IS NOT NULL
+          AND ($1 IS NULL OR id = $1)) boundary
+      ON ST_Intersects(roads.way, boundary.geom)
+  )
+  SELECT boundary_id, highway, ST_Length(ST_Union(way))
+  FROM clipped
+  GROUP BY boundary_id, highway
+  UNION ALL
+  SELECT boundary_id, NULL, ST_Length(ST_Union(way))
+  FROM clipped
+  GROUP BY boundary_id;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,140 @@
+-- Functions to precompute how observed stop times deviate from the schedule.
+-- Run at the end of each realtime import for the days it loaded, so indicator jobs
+-- can aggregate the deviations instead of joining observed to scheduled stop times
+-- every time.
+
+-- Converts a H:MM:SS / HH:MM:SS time to seconds past midnight; NULL if malformed.
+CREATE OR REPLACE FUNCTION GtfsTimeToSeconds(text)
+  RETURNS integer AS
+$$
+  SELECT CASE WHEN trim($1) ~ '^[0-9]+:[0-5]?[0-9]:[0-5]?[0-9]$'
+              THEN split_part(trim($1), ':', 1)::integer * 3600 +
+                   split_part(trim($1), ':', 2)::integer * 60 +
+                   split_part(trim($1), ':', 3)::integer
+         END;
+$$ LANGUAGE sql IMMUTABLE;
+
+DROP FUNCTION IF EXISTS BuildStopTimeDeviations();
+
+-- Replaces the rows of gtfs_stop_time_deviations for the service dates from $1 to $2,
+-- with one row per observed stop time of those days that matches a scheduled one by
+-- trip_id and stop_sequence, and drops the rows of days no longer in
+-- gtfs_stop_times_real. Times are in seconds past midnight of the service day. Delays
+-- are observed minus scheduled times, dwell is departure minus arrival at the stop,
+-- and headways are the time since the previous arrival of the route (within the same
+-- service and day) at the same stop.
+CREATE OR REPLACE FUNCTION BuildStopTimeDeviations(date, date)
+  RETURNS void AS
+$$
+BEGIN
+  IF NOT EXISTS (SELECT 1 FROM information_schema.tables
+                 WHERE table_name IN ('gtfs_stop_times', 'gtfs_trips')
+                 HAVING count(*) = 2) THEN
+    RAISE WARNING 'No scheduled stop times to compare observed stop times with.';
+    RETURN;
+  END IF;
+
+  IF NOT EXISTS (SELECT 1 FROM information_schema.tables
+                 WHERE table_name = 'gtfs_stop_time_deviations') THEN
+    CREATE TABLE gtfs_stop_time_deviations (
+      service_date date,
+      trip_id text,
+      route_id text,
+      service_id text,
+      stop_id text,
+      stop_sequence integer,
+      scheduled_arrival integer,
+      scheduled_departure integer,
+      observed_arrival integer,
+      observed_departure integer,
+      arrival_delay integer,
+      departure_delay integer,
+      scheduled_dwell integer,
+      observed_dwell integer,
+      scheduled_headway integer,
+      observed_headway integer
+    );
+    -- indicator jobs select deviations by day, route and sample period time window
+    CREATE INDEX gtfs_stop_time_deviations_date_idx
+      ON gtfs_stop_time_deviations (service_date);
+    CREATE INDEX gtfs_stop_time_deviations_route_arrival_idx
+      ON gtfs_stop_time_deviations (route_id, scheduled_arrival);
+    CREATE INDEX gtfs_stop_time_deviations_arrival_idx
+      ON gtfs_stop_time_deviations (scheduled_arrival);
+    CREATE INDEX gtfs_stop_time_deviations_trip_idx
+      ON gtfs_stop_time_deviations (trip_id, stop_sequence);
+  END IF;
+
+  DELETE FROM gtfs_stop_time_deviations
+  WHERE service_date BETWEEN $1 AND $2
+  OR service_date < (SELECT min(service_date) FROM gtfs_stop_times_real);
+
+  INSERT INTO gtfs_stop_time_deviations
+  SELECT service_date, trip_id, route_id, service_id, stop_id, stop_sequence,
+    scheduled_arrival, scheduled_departure, observed_arrival, observed_departure,
+    observed_arrival - scheduled_arrival AS arrival_delay,
+    observed_departure - scheduled_departure AS departure_delay,
+    scheduled_departure - scheduled_arrival AS scheduled_dwell,
+    observed_departure - observed_arrival AS observed_dwell,
+    scheduled_arrival - lag(scheduled_arrival)
+      OVER (PARTITION BY service_date, route_id, service_id, stop_id
+            ORDER BY scheduled_arrival)
+      AS scheduled_headway,
+    observed_arrival - lag(observed_arrival)
+      OVER (PARTITION BY service_date, route_id, service_id, stop_id
+            ORDER BY observed_arrival)
+      AS observed_headway
+  FROM (
+    SELECT observed.service_date, observed.trip_id, trips.route_id, trips.service_id,
+      observed.stop_id, observed.stop_sequence,
+      GtfsTimeToSeconds(scheduled.arrival_time) AS scheduled_arrival,
+      GtfsTimeToSeconds(scheduled.departure_time) AS scheduled_departure,
+      observed.arrival_seconds AS observed_arrival,
+      observed.departure_seconds AS observed_departure
+    FROM gtfs_stop_times_real observed
+    JOIN gtfs_stop_times scheduled
+      ON scheduled.trip_id = observed.trip_id
+      AND scheduled.stop_sequence = observed.stop_sequence
+    JOIN gtfs_trips trips ON trips.trip_id = observed.trip_id
+    WHERE observed.service_date BETWEEN $1 AND $2
+  ) matched;
+
+  ANALYZE gtfs_stop_time_deviations;
+
+  RAISE INFO 'Computed deviations for % observed stop times.',
+    (SELECT count(*) FROM gtfs_stop_time_deviations WHERE service_date BETWEEN $1 AND $2);
+END;
+$$ LANGUAGE plpgsql;
+
+-- Builds the deviations of the day the observed-data indicators read (see
+-- gtfs_observed_service_date), unless they're already built, e.g. after the GTFS
+-- feed was replaced since the day was imported. Run by indicator jobs before they
+-- read gtfs_stop_time_deviations; returns the number of deviations of the day.
+CREATE OR REPLACE FUNCTION EnsureStopTimeDeviations()
+  RETURNS integer AS
+$$
+DECLARE
+  observed_date date;
+BEGIN
+  SELECT service_date INTO observed_date FROM gtfs_observed_service_date;
+  IF observed_date IS NULL THEN
+    RETURN 0;
+  END IF;
+  -- the table is dropped with the GTFS data, so check it exists before reading it
+  IF EXISTS (SELECT 1 FROM information_schema.tables
+             WHERE table_name = 'gtfs_stop_time_deviations') THEN
+    IF NOT EXISTS (SELECT 1 FROM gtfs_stop_time_deviations
+                   WHERE service_date = observed_date) THEN
+      PERFORM BuildStopTimeDeviations(observed_date, observed_date);
+    END IF;
+  ELSE
+    PERFORM BuildStopTimeDeviations(observed_date, observed_date);
+  END IF;
+  -- not built if there are no scheduled stop times
+  IF NOT EXISTS (SELECT 1 FROM information_schema.tables
+                 WHERE table_name = 'gtfs_stop_time_deviations') THEN
+    RETURN 0;
+  END IF;
+  RETURN (SELECT count(*) FROM gtfs_stop_time_deviations WHERE service_date = observed_date);
+END;
+$$ LANGUAGE plpgsql;
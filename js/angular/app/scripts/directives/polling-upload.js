@@ -25,6 +25,9 @@ Options:
   - checkInvalid:       function (object) should return true if the object is invalid and processing
                         should be cancelled
   - checkContinue:      function (object) should return true if the object is still processing
+  - replaceable:        If true, a loaded upload can be replaced by uploading another file, without
+                        deleting it first; the server is expected to delete the old one once the
+                        new one is processed
 
 Events:
 $rootScope:                         (event args)
@@ -32,6 +35,7 @@ $rootScope:                         (event args)
   - pollingUpload:uploadFinished    (upload)
   - pollingUpload:uploadError       (error, status)
   - pollingUpload:uploadDelete      (upload)
+  - pollingUpload:uploadReplace     (upload)
   - pollingUpload:uploadCancel      (upload)
   - pollingUpload:pollingStarted    (upload)
   - pollingUpload:pollingFinished   (upload)
@@ -53,6 +57,7 @@ $rootScope:                         (event args)
             uploadError: 'pollingUpload:uploadError',
             uploadCancel: 'pollingUpload:uploadCancel',
             uploadDelete: 'pollingUpload:uploadDelete',
+            uploadReplace: 'pollingUpload:uploadReplace',
             pollingStarted: 'pollingUpload:pollingStarted',
             pollingFinished: 'pollingUpload:pollingFinished',
             pollingError: 'pollingUpload:pollingError',
@@ -73,6 +78,9 @@ $rootScope:                         (event args)
             '    <span class="glyphicon glyphicon-ok"></span> {{ "TERM.DATA_LOADED" | translate }}',
             '    <button class="btn btn-danger pull-right" ng-click="delete()">{{ "TERM.DELETE_DATA" | translate}}</button>',
             '  </div>',
+            '  <div class="h5" ng-show="options.replaceable">',
+            '    {{ "TERM.REPLACE_DATA" | translate }}: <input type="file" ng-file-select="replace($files)" />',
+            '  </div>',
             '</div>',
             '<div class="dropzone notices" ng-show="options.checkInvalid(upload) || uploadError">',
             '  <div class="h4">',
@@ -118,6 +126,7 @@ $rootScope:                         (event args)
                 ensureDefault(scope.options, 'checkContinue', defaultCheckContinue);
                 ensureDefault(scope.options, 'checkComplete', defaultCheckComplete);
                 ensureDefault(scope.options, 'fileFormName', 'source_file');
+                ensureDefault(scope.options, 'replaceable', false);
 
                 scope.Status = OTIUploadStatus;
 
@@ -248,6 +257,23 @@ $rootScope:                         (event args)
                     });
                 };
 
+                /**
+                 *  Uploads a file to replace a loaded upload, which is left for the server to delete
+                 *
+                 *  @param $files: The array of files to upload, directly copied from
+                 *                 the angular-file-upload directive
+                 */
+                scope.replace = function ($files) {
+                    if (!($files && $files[0])) {
+                        return;
+                    }
+                    $timeout.cancel(scope.timeoutId);
+                    scope.timeoutId = null;
+                    clearUploadProblems();
+                    $rootScope.$broadcast(events.uploadReplace, scope.upload);
+                    scope.startUpload($files);
+                };
+
                 if (!scope.upload.status) {
                     clearUploadProblems();
                 }
@@ -199,6 +199,15 @@ angular.module('transitIndicators')
         clearUploadProblems();
     });
 
+    $scope.$on('pollingUpload:uploadReplace', function () {
+        // the old feed and its OSM import are deleted once the new feed is loaded
+        clearUploadProblems();
+        $scope.setSidebarCheckmark('upload', false);
+        $scope.osmImport = {};
+        $scope.osmImportProgress = -1;
+        $scope.osmImportProblems = {};
+    });
+
     $scope.$on('pollingUpload:uploadDelete', function () {
         clearUploadProblems();
         $scope.setSidebarCheckmark('upload', false);
@@ -244,7 +253,8 @@ angular.module('transitIndicators')
     // Set initial scope variables and constants
     $scope.gtfsUpload = {};
     $scope.gtfsOptions = {
-        uploadTimeoutMs: 90 * 60 * 1000
+        uploadTimeoutMs: 90 * 60 * 1000,
+        replaceable: true
     };
     $scope.GTFSUploads = OTISettingsService.gtfsUploads;
     $scope.osmImport = {};
@@ -0,0 +1,192 @@
+"""Bulk loading of demographic shapefile features with PostgreSQL's COPY.
+
+Creating each DemographicDataFeature with get_or_create costs a query comparing
+geometries and an INSERT per feature, on top of building a coordinate
+transformation for every geometry. The loader in this module reads the layer
+one batch of features at a time, reprojects every geometry with a single
+coordinate transformation built for the layer, and streams the features into
+datasources_demographicdatafeature with COPY, so loading takes time linear in
+the number of features.
+
+Features that can't be loaded, e.g. ones that aren't polygons or whose metrics
+aren't numbers, are left out and collected into a single warning. Batches the
+database rejects are split in halves until the offending features are isolated,
+as for realtime stop times.
+"""
+from itertools import islice
+from StringIO import StringIO
+
+from django.conf import settings
+from django.contrib.gis.gdal import CoordTransform, OGRException, SpatialReference
+from django.contrib.gis.geos import MultiPolygon, Polygon
+from django.utils import timezone
+from django.utils.translation import ugettext_lazy as _
+
+from datasources.models import DemographicDataFeature
+from datasources.realtime_loader import (RejectedRows, format_copy_value,
+                                         insert_isolating_failures)
+
+# Columns of datasources_demographicdatafeature filled by the loader, in the order they are copied
+COPY_COLUMNS = ('population_metric_1', 'population_metric_2', 'destination_metric_1', 'geom',
+                'datasource_id', 'city_name', 'create_date', 'last_modify_date')
+
+# Model fields each feature's metrics are loaded into, in COPY_COLUMNS order
+METRIC_FIELDS = COPY_COLUMNS[:3]
+
+FEATURES_TABLE = DemographicDataFeature._meta.db_table
+
+# Number of features sent in each COPY
+COPY_BATCH_SIZE = 5000
+
+
+class InvalidFeature(ValueError):
+    """Raised when a feature can't be loaded as demographic data"""
+    pass
+
+
+class RejectedFeatures(RejectedRows):
+    """Collects the features left out of a demographic data load, to report them as one problem"""
+    title = _('Features not imported')
+    description = _('%(count)d features could not be imported: %(rows)s')
+    sample_label = 'Feature'
+
+
+def clean_metric(value, name):
+    """Converts the value of a metric field to a float, or None if it's blank"""
+    if value is None or (isinstance(value, basestring) and not value.strip()):
+        return None
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise InvalidFeature('%s "%s" is not a number' % (name, value))
+    if number != number or number in (float('inf'), float('-inf')):
+        raise InvalidFeature('%s "%s" is not a number' % (name, value))
+    return number
+
+
+def read_features(layer, fields):
+    """Reads the metrics and geometry of each feature of a shapefile layer
+
+    Params:
+        :layer: GDAL Layer to read
+        :fields: Names of the shapefile fields holding the metrics, in METRIC_FIELDS
+                 order; a metric without a field is left empty
+    Yields a (feature number, metric values, OGRGeometry) tuple for each feature,
+    numbered from 1
+    """
+    fields = [str(field) if field else None for field in fields]
+    for number, feature in enumerate(layer, start=1):
+        yield number, [feature.get(field) if field else None for field in fields], feature.geom
+
+
+class FeatureCopyRows(object):
+    """Formats demographic features for COPY FROM STDIN.
+
+    Yields a (feature number, formatted row) tuple for each valid feature. Each
+    feature is reprojected and validated only when it's asked for, so memory use
+    doesn't grow with the layer. Features that fail are handed to on_invalid and
+    skipped.
+    """
+
+    def __init__(self, features, transform, datasource_id, on_invalid):
+        """
+        Params:
+            :features: Iterable of (feature number, metric values, OGRGeometry) tuples,
+                       e.g. from read_features
+            :transform: CoordTransform (or SRID) reprojecting the geometries to DJANGO_SRID
+            :datasource_id: ID of the DemographicDataSource the features belong to
+            :on_invalid: Called with the feature number and the reason for each invalid feature
+        """
+        self.features = features
+        self.transform = transform
+        now = format_copy_value(timezone.now().isoformat())
+        city_name = DemographicDataFeature._meta.get_field('city_name').get_default()
+        self.suffix = '\t'.join([format_copy_value(datasource_id),
+                                 format_copy_value(city_name), now, now])
+        self.on_invalid = on_invalid
+        self.valid = 0
+        self.total = 0
+
+    def format_geometry(self, geom):
+        """Reprojects a geometry and returns it as a MultiPolygon in hex EWKB"""
+        try:
+            geom.transform(self.transform)
+        except OGRException as e:
+            raise InvalidFeature('Could not reproject geometry: %s' % e)
+        geom = geom.geos
+        if isinstance(geom, Polygon):
+            geom = MultiPolygon(geom)
+        elif not isinstance(geom, MultiPolygon):
+            raise InvalidFeature('Feature is not a MultiPolygon or Polygon')
+        geom.srid = settings.DJANGO_SRID
+        return geom.hexewkb
+
+    def __iter__(self):
+        for number, values, geom in self.features:
+            self.total = number
+            try:
+                metrics = [clean_metric(value, name) for value, name in zip(values, METRIC_FIELDS)]
+                if geom is None:
+                    raise InvalidFeature('Feature has no geometry')
+                ewkb = self.format_geometry(geom)
+            except ValueError as e:
+                self.on_invalid(number, str(e))
+                continue
+            self.valid += 1
+            yield number, '%s\t%s\t%s\n' % ('\t'.join(format_copy_value(value)
+                                                      for value in metrics),
+                                            ewkb, self.suffix)
+
+
+def copy_features(cursor, features, transform, datasource_id, on_invalid,
+                  batch_size=COPY_BATCH_SIZE):
+    """Streams demographic features into datasources_demographicdatafeature with COPY FROM STDIN
+
+    Params:
+        :cursor: Database cursor to run the COPY with
+        :features: Iterable of (feature number, metric values, OGRGeometry) tuples,
+                   e.g. from read_features
+        :transform: CoordTransform (or SRID) reprojecting the geometries to DJANGO_SRID
+        :datasource_id: ID of the DemographicDataSource the features belong to
+        :on_invalid: Called with the feature number and the reason for each feature
+                     that is invalid or that the database rejects
+        :batch_size: Number of features sent in each COPY
+    Returns a (features copied, features read) tuple
+    """
+    sql = 'COPY %s (%s) FROM STDIN' % (FEATURES_TABLE, ', '.join(COPY_COLUMNS))
+
+    def copy(rows):
+        cursor.copy_expert(sql, StringIO(''.join(text for number, text in rows)))
+
+    rows = FeatureCopyRows(features, transform, datasource_id, on_invalid)
+    formatted = iter(rows)
+    copied = 0
+    while True:
+        batch = list(islice(formatted, batch_size))
+        if not batch:
+            break
+        failures = insert_isolating_failures(batch, copy)
+        for number, message in failures:
+            on_invalid(number, message)
+        copied += len(batch) - len(failures)
+    return copied, rows.total
+
+
+def load_layer(cursor, layer, fields, datasource_id, on_invalid, srs=None):
+    """Loads the features of a shapefile layer as DemographicDataFeatures
+
+    The layer's geometries are all reprojected with one coordinate transformation
+    from the layer's spatial reference to settings.DJANGO_SRID.
+
+    Params:
+        :layer: GDAL Layer to load, which must have a spatial reference
+        :fields: Names of the shapefile fields loaded into population_metric_1,
+                 population_metric_2 and destination_metric_1; any may be None
+        :srs: WKT of the layer's spatial reference, as cached on its
+              DemographicDataSource; read from the layer if not given
+    Returns a (features copied, features read) tuple
+    """
+    source_srs = SpatialReference(srs) if srs else layer.srs
+    transform = CoordTransform(source_srs, SpatialReference(settings.DJANGO_SRID))
+    return copy_features(cursor, read_features(layer, fields), transform, datasource_id,
+                         on_invalid)
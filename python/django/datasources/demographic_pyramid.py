@@ -0,0 +1,174 @@
+"""Pre-aggregated demographic grids and summary statistics.
+
+Drawing demographic data on a zoomed-out map, or building a legend for it, used to
+aggregate over every DemographicDataFeature on each request. After a load, the
+functions in this module sum the features' metrics over square cells of grids of
+several sizes, a pyramid of DemographicDataGridCells, and compute the range,
+quantile breakpoints and histogram of each metric into DemographicDataSummaries,
+so requests read a few precomputed rows instead of the feature table.
+
+The finest grid is built from the features, splitting each feature's metrics among
+the cells it overlaps in proportion to the area of the feature in each, so a large
+feature spreads over the cells it covers (features without area go, whole, in the
+cell holding a point on their surface). A feature is counted in the cell holding a
+point on its surface. Every coarser grid whose cell size is a multiple of a finer
+one's is built from that finer grid's cells instead.
+"""
+import json
+
+from django.conf import settings
+
+from datasources.models import DemographicDataFeature, DemographicDataGridCell, DemographicDataSummary
+
+# Metric columns summed into the grids and summarized
+METRICS = ('population_metric_1', 'population_metric_2', 'destination_metric_1')
+
+FEATURES_TABLE = DemographicDataFeature._meta.db_table
+CELLS_TABLE = DemographicDataGridCell._meta.db_table
+
+CELL_COLUMNS = ('datasource_id', 'cell_size', 'grid_x', 'grid_y') + METRICS + ('feature_count', 'geom')
+
+# Selects the cells of one size from the features, with their columns in CELL_COLUMNS order.
+# Each feature is paired with the cells its bounding box overlaps, one series of columns
+# and then rows (set-returning functions can't take arguments from other FROM items
+# before PostgreSQL 9.3), and weighted by the share of its area in each.
+FEATURE_CELLS_SQL = """
+    SELECT %(datasource_id)s, %(cell_size)s, grid_x, grid_y, {weighted_sums},
+           sum(holds_point::integer),
+           ST_MakeEnvelope(grid_x * %(cell_size)s, grid_y * %(cell_size)s,
+                           (grid_x + 1) * %(cell_size)s, (grid_y + 1) * %(cell_size)s, %(srid)s)
+    FROM (SELECT grid_x, grid_y, holds_point, {metrics},
+                 CASE WHEN area > 0 THEN ST_Area(ST_Intersection(geom, cell)) / area
+                      ELSE holds_point::integer END AS weight
+          FROM (SELECT grid_x, grid_y, geom, area, {metrics},
+                       ST_MakeEnvelope(grid_x * %(cell_size)s, grid_y * %(cell_size)s,
+                                       (grid_x + 1) * %(cell_size)s,
+                                       (grid_y + 1) * %(cell_size)s, %(srid)s) AS cell,
+                       floor(ST_X(point) / %(cell_size)s) = grid_x
+                         AND floor(ST_Y(point) / %(cell_size)s) = grid_y AS holds_point
+                FROM (SELECT *, generate_series(
+                                  floor(ST_YMin(geom) / %(cell_size)s)::integer,
+                                  greatest(floor(ST_YMin(geom) / %(cell_size)s)::integer,
+                                           ceil(ST_YMax(geom) / %(cell_size)s)::integer - 1))
+                                AS grid_y
+                      FROM (SELECT geom, ST_Area(geom) AS area,
+                                   ST_PointOnSurface(geom) AS point, {metrics},
+                                   generate_series(
+                                     floor(ST_XMin(geom) / %(cell_size)s)::integer,
+                                     greatest(floor(ST_XMin(geom) / %(cell_size)s)::integer,
+                                              ceil(ST_XMax(geom) / %(cell_size)s)::integer - 1))
+                                   AS grid_x
+                            FROM {features}
+                            WHERE datasource_id = %(datasource_id)s) by_column) by_cell) overlapping
+          ) weighted
+    WHERE weight > 0 OR holds_point
+    GROUP BY grid_x, grid_y
+"""
+
+# Selects the cells of one size from the cells of a finer size dividing it
+CELL_CELLS_SQL = """
+    SELECT %(datasource_id)s, %(cell_size)s, grid_x, grid_y, {sums}, sum(feature_count),
+           ST_MakeEnvelope(grid_x * %(cell_size)s, grid_y * %(cell_size)s,
+                           (grid_x + 1) * %(cell_size)s, (grid_y + 1) * %(cell_size)s, %(srid)s)
+    FROM (SELECT floor(grid_x / %(ratio)s::double precision)::integer AS grid_x,
+                 floor(grid_y / %(ratio)s::double precision)::integer AS grid_y,
+                 feature_count, {metrics}
+          FROM {cells}
+          WHERE datasource_id = %(datasource_id)s AND cell_size = %(finer_size)s) finer
+    GROUP BY grid_x, grid_y
+"""
+
+
+def get_finer_size(cell_size, built_sizes):
+    """Returns the largest of the built cell sizes that divides a cell size, or None"""
+    divisors = [size for size in built_sizes
+                if size < cell_size and abs(cell_size / size - round(cell_size / size)) < 1e-9]
+    return max(divisors) if divisors else None
+
+
+def build_pyramid(cursor, datasource_id, cell_sizes):
+    """Replaces the DemographicDataGridCells of a datasource with ones summing its features
+
+    Params:
+        :cursor: Database cursor to build the grids with
+        :datasource_id: ID of the DemographicDataSource whose features are summed
+        :cell_sizes: Widths and heights of the cells of each grid, in units of
+                     settings.DJANGO_SRID
+    Returns the number of cells created
+    """
+    cursor.execute('DELETE FROM %s WHERE datasource_id = %%s;' % CELLS_TABLE, [datasource_id])
+    metrics = ', '.join(METRICS)
+    sums = ', '.join('sum(%s)' % metric for metric in METRICS)
+    weighted_sums = ', '.join('sum(%s * weight)' % metric for metric in METRICS)
+    insert = 'INSERT INTO %s (%s) ' % (CELLS_TABLE, ', '.join(CELL_COLUMNS))
+    built_sizes = []
+    created = 0
+    for cell_size in sorted(float(size) for size in cell_sizes):
+        params = {'datasource_id': datasource_id, 'cell_size': cell_size,
+                  'srid': settings.DJANGO_SRID}
+        finer_size = get_finer_size(cell_size, built_sizes)
+        if finer_size:
+            params.update(finer_size=finer_size, ratio=int(round(cell_size / finer_size)))
+            sql = CELL_CELLS_SQL.format(sums=sums, metrics=metrics, cells=CELLS_TABLE)
+        else:
+            sql = FEATURE_CELLS_SQL.format(weighted_sums=weighted_sums, metrics=metrics,
+                                           features=FEATURES_TABLE)
+        cursor.execute(insert + sql, params)
+        created += cursor.rowcount
+        built_sizes.append(cell_size)
+    return created
+
+
+def get_histogram(cursor, datasource_id, metric, minimum, maximum, count, bins):
+    """Counts the features whose values of a metric fall in equal-width bins from minimum to maximum
+
+    The last bin includes the maximum. If all values are equal, they're all in the first bin.
+    """
+    histogram = [0] * bins
+    if minimum == maximum:
+        histogram[0] = count
+        return histogram
+    cursor.execute('SELECT LEAST(width_bucket({metric}, %s, %s, %s), %s), count(*) '
+                   'FROM {features} '
+                   'WHERE datasource_id = %s AND {metric} IS NOT NULL '
+                   'GROUP BY 1;'.format(metric=metric, features=FEATURES_TABLE),
+                   [minimum, maximum, bins, bins, datasource_id])
+    for bucket, bucket_count in cursor.fetchall():
+        histogram[bucket - 1] = bucket_count
+    return histogram
+
+
+def build_summaries(cursor, datasource_id, quantiles, bins):
+    """Replaces the DemographicDataSummaries of a datasource with ones describing its features
+
+    Params:
+        :cursor: Database cursor to read the features with
+        :datasource_id: ID of the DemographicDataSource whose features are summarized
+        :quantiles: Number of groups of equal size to find the breakpoints between
+        :bins: Number of bins of the histograms
+    Returns the DemographicDataSummaries created
+    """
+    DemographicDataSummary.objects.filter(datasource_id=datasource_id).delete()
+    summaries = []
+    for metric in METRICS:
+        cursor.execute('SELECT count({metric}), min({metric}), max({metric}) FROM {features} '
+                       'WHERE datasource_id = %s;'.format(metric=metric, features=FEATURES_TABLE),
+                       [datasource_id])
+        count, minimum, maximum = cursor.fetchone()
+        breakpoints = []
+        histogram = []
+        if count:
+            # the largest value of each of the groups ntile splits the ordered values into
+            cursor.execute('SELECT max({metric}) '
+                           'FROM (SELECT {metric}, ntile(%s) OVER (ORDER BY {metric}) AS quantile '
+                           '      FROM {features} '
+                           '      WHERE datasource_id = %s AND {metric} IS NOT NULL) ordered '
+                           'GROUP BY quantile ORDER BY quantile;'.format(metric=metric,
+                                                                         features=FEATURES_TABLE),
+                           [quantiles, datasource_id])
+            breakpoints = [row[0] for row in cursor.fetchall()]
+            histogram = get_histogram(cursor, datasource_id, metric, minimum, maximum, count, bins)
+        summaries.append(DemographicDataSummary.objects.create(
+            datasource_id=datasource_id, metric=metric, count=count, min=minimum, max=maximum,
+            quantiles=json.dumps(breakpoints), histogram=json.dumps(histogram)))
+    return summaries
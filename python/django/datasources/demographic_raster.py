@@ -0,0 +1,339 @@
+"""Dasymetric rasterization of demographic data with NumPy.
+
+An alternative to CreateGrid for building demographic_grid. Instead of giving each
+feature's metrics in equal shares to the grid points that happen to fall in it,
+every feature's metrics are spread over the cells of a raster in proportion to
+the exact area of the feature covering each cell, so the values of a cell add up
+the shares of all the features overlapping it, and small features that no grid
+point falls in aren't lost.
+
+Coverage areas are computed exactly from the features' rings with Green's
+theorem: the area of a polygon inside a cell is the integral, along its
+boundary, of the height of the boundary within the cell's row, which is
+piecewise linear on each part of an edge within a column. Only the cells along
+a feature's boundary need that integral; the cells below it in each column get
+a cell's full height, which is added with one cumulative sum.
+
+The raster is processed in tiles of settings.DEMOGRAPHIC_RASTER_TILE_SIZE cells
+square. The features overlapping a tile are clipped to it in the database, so
+memory use is bounded by the size of a tile, however large the grid. Each tile
+is written out as grid points into demographic_grid, and into one raster file
+per metric, in GeoTrellis' ARG format in settings.DEMOGRAPHIC_RASTER_DIR, where
+the Scala service's raster catalog loads them from.
+"""
+import json
+import os
+import struct
+from StringIO import StringIO
+
+import numpy as np
+
+from django.contrib.gis.geos import GEOSGeometry, GeometryCollection, MultiPolygon, Polygon
+
+from datasources.models import DemographicDataFeature
+from datasources.realtime_loader import format_copy_value
+
+# Metric columns of the features, the grid and (prefixed with RASTER_PREFIX) the rasters
+METRICS = ('population_metric_1', 'population_metric_2', 'destination_metric_1')
+RASTER_PREFIX = 'demographic_grid_'
+
+GRID_COLUMNS = ('geom', 'feature_id') + METRICS
+FEATURES_TABLE = DemographicDataFeature._meta.db_table
+
+# Differences of heights below which an edge is treated as horizontal
+EPSILON = 1e-12
+
+
+def get_polygons(geom):
+    """Returns the Polygons of a geometry, e.g. of a clipped feature"""
+    if isinstance(geom, Polygon):
+        return [geom]
+    elif isinstance(geom, (MultiPolygon, GeometryCollection)):
+        return [polygon for part in geom for polygon in get_polygons(part)]
+    return []
+
+
+def integrate_clamped(p, q):
+    """Mean of min(max(s, 0), 1) as s goes linearly from p to q, elementwise"""
+    def antiderivative(s):
+        return np.where(s <= 0, 0, np.where(s >= 1, s - 0.5, s * s / 2))
+
+    flat = np.abs(q - p) < EPSILON
+    middle = np.clip((p + q) / 2, 0, 1)
+    return np.where(flat, middle,
+                    (antiderivative(q) - antiderivative(p)) / np.where(flat, 1, q - p))
+
+
+def ring_coverage(coords, shape):
+    """Areas of the cells of a grid inside a ring, signed by the ring's orientation
+
+    Params:
+        :coords: (n, 2) array of the ring's closed coordinates, in cells from the
+                 grid's lower left corner
+        :shape: (rows, columns) of the grid, with rows counted from the bottom
+    Returns an array of that shape holding, for each cell, the area (in cells) of
+    the ring's interior inside the cell; positive if the ring is counterclockwise,
+    negative if it's clockwise.
+    """
+    rows, cols = shape
+    coverage = np.zeros(shape)
+    # the cells fully below each edge, indexed by the first row not fully below
+    below = np.zeros((rows + 1, cols))
+
+    u0, v0 = coords[:-1, 0], coords[:-1, 1]
+    u1, v1 = coords[1:, 0], coords[1:, 1]
+    # vertical edges enclose no area
+    sloped = u0 != u1
+    u0, v0, u1, v1 = u0[sloped], v0[sloped], u1[sloped], v1[sloped]
+    if not len(u0):
+        return coverage
+
+    # split each edge into pieces within one column of the grid; columns outside it
+    # aren't needed, since each column's area only depends on the pieces within it
+    left = np.minimum(u0, u1)
+    right = np.maximum(u0, u1)
+    first = np.maximum(np.floor(left).astype(int), 0)
+    last = np.minimum(np.ceil(right).astype(int) - 1, cols - 1)
+    counts = np.maximum(last - first + 1, 0)
+    edge = np.repeat(np.arange(len(u0)), counts)
+    col = first[edge] + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    a = np.maximum(left[edge], col)
+    b = np.minimum(right[edge], col + 1)
+    slope = (v1 - v0) / (u1 - u0)
+    va = v0[edge] + (a - u0[edge]) * slope[edge]
+    vb = v0[edge] + (b - u0[edge]) * slope[edge]
+    # by Green's theorem, area is the integral of -v du, in the direction of the edge
+    weight = np.where(u1[edge] > u0[edge], a - b, b - a)
+
+    low = np.minimum(va, vb)
+    high = np.maximum(va, vb)
+    first_row = np.clip(np.floor(low).astype(int), 0, rows)
+    last_row = np.clip(np.ceil(high).astype(int) - 1, -1, rows - 1)
+
+    # the rows entirely below a piece are covered to their full height
+    np.add.at(below, (first_row, col), weight)
+    coverage += np.cumsum(below[::-1], axis=0)[::-1][1:]
+
+    # the rows a piece crosses are covered up to its height within them
+    counts = np.maximum(last_row - first_row + 1, 0)
+    piece = np.repeat(np.arange(len(col)), counts)
+    row = first_row[piece] + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    heights = integrate_clamped(va[piece] - row, vb[piece] - row)
+    np.add.at(coverage, (row, col[piece]), weight[piece] * heights)
+    return coverage
+
+
+def polygon_coverage(polygon, origin, resolution, shape):
+    """Areas (in square units of the polygon) of the cells of a grid inside a polygon
+
+    Params:
+        :polygon: GEOS Polygon
+        :origin: (x, y) of the grid's lower left corner
+        :resolution: Width and height of the grid's cells
+        :shape: (rows, columns) of the grid, with rows counted from the bottom
+    """
+    coverage = np.zeros(shape)
+    for index, ring in enumerate(polygon):
+        coords = (np.asarray(ring.coords, dtype=float) - origin) / resolution
+        # shells add their area and holes take theirs away, whichever way they're wound
+        signed_area = np.sum(coords[:-1, 0] * coords[1:, 1] - coords[1:, 0] * coords[:-1, 1])
+        if (signed_area > 0) == (index == 0):
+            coverage += ring_coverage(coords, shape)
+        else:
+            coverage -= ring_coverage(coords, shape)
+    return coverage * resolution * resolution
+
+
+class Tile(object):
+    """Part of the grid, holding the metrics of its cells as they're rasterized.
+
+    Arrays are indexed by (row, column), with rows counted from the bottom.
+    """
+
+    def __init__(self, col, row, cols, rows, resolution):
+        """
+        Params:
+            :col, row: Column and row, in the whole grid, of the tile's lower left cell,
+                       counted from the grid's origin at (0, 0)
+            :cols, rows: Size of the tile in cells
+            :resolution: Width and height of the cells
+        """
+        self.col = col
+        self.row = row
+        self.resolution = resolution
+        self.shape = (rows, cols)
+        self.values = np.zeros((len(METRICS),) + self.shape)
+        # whether any feature with a value for each metric covers the cell
+        self.has_value = np.zeros((len(METRICS),) + self.shape, dtype=bool)
+        # the feature covering the most of each cell, and how much it covers
+        self.feature_ids = np.zeros(self.shape, dtype=int)
+        self.feature_areas = np.zeros(self.shape)
+
+    @property
+    def extent(self):
+        """(xmin, ymin, xmax, ymax) of the tile"""
+        rows, cols = self.shape
+        return ((self.col) * self.resolution, self.row * self.resolution,
+                (self.col + cols) * self.resolution, (self.row + rows) * self.resolution)
+
+    def add_feature(self, feature_id, metrics, area, geom):
+        """Spreads a feature's metrics over the cells it covers, by the area it covers
+
+        Params:
+            :metrics: Values of the feature's metrics, in METRICS order; None if missing
+            :area: Area of the whole feature
+            :geom: The part of the feature within the tile, as a GEOS geometry
+        """
+        if not area:
+            return
+        rows, cols = self.shape
+        for polygon in get_polygons(geom):
+            # only the window of cells under the polygon's extent is rasterized
+            xmin, ymin, xmax, ymax = polygon.extent
+            c0 = max(int(np.floor(xmin / self.resolution)) - self.col, 0)
+            r0 = max(int(np.floor(ymin / self.resolution)) - self.row, 0)
+            c1 = min(int(np.ceil(xmax / self.resolution)) - self.col, cols)
+            r1 = min(int(np.ceil(ymax / self.resolution)) - self.row, rows)
+            if c1 <= c0 or r1 <= r0:
+                continue
+            origin = ((self.col + c0) * self.resolution, (self.row + r0) * self.resolution)
+            covered = np.maximum(polygon_coverage(polygon, origin, self.resolution,
+                                                  (r1 - r0, c1 - c0)), 0)
+            window = (slice(r0, r1), slice(c0, c1))
+            for index, metric in enumerate(metrics):
+                if metric is not None:
+                    self.values[index][window] += covered * (metric / area)
+                    self.has_value[index][window] |= covered > 0
+            most = covered > self.feature_areas[window]
+            self.feature_areas[window] = np.where(most, covered, self.feature_areas[window])
+            self.feature_ids[window] = np.where(most, feature_id, self.feature_ids[window])
+
+    def get_grid_rows(self, srid):
+        """Formats a grid point at the center of each covered cell for COPY FROM STDIN"""
+        rows, cols = np.nonzero(self.feature_ids)
+        xs = (self.col + cols + 0.5) * self.resolution
+        ys = (self.row + rows + 0.5) * self.resolution
+        for x, y, row, col in zip(xs, ys, rows, cols):
+            # hex EWKB of a point with an SRID
+            point = struct.pack('<BIIdd', 1, 0x20000001, srid, x, y).encode('hex')
+            values = [self.values[index, row, col] if self.has_value[index, row, col] else None
+                      for index in range(len(METRICS))]
+            yield '%s\t%d\t%s\n' % (point, self.feature_ids[row, col],
+                                    '\t'.join(format_copy_value(value) for value in values))
+
+
+class RasterFile(object):
+    """A metric's raster in GeoTrellis' ARG format: big-endian doubles, top row first,
+    with NaN for cells without data, described by a JSON metadata file.
+    """
+
+    def __init__(self, directory, name, col, row, cols, rows, resolution, srid):
+        """
+        Params:
+            :col, row: Column and row of the raster's lower left cell
+            :cols, rows: Size of the raster in cells
+        """
+        self.name = name
+        self.col = col
+        self.row = row
+        self.rows = rows
+        path = os.path.join(directory, name + '.arg')
+        self.cells = np.memmap(path, dtype='>f8', mode='w+', shape=(rows, cols))
+        self.cells[:] = np.nan
+        self.metadata = {
+            'layer': name,
+            'type': 'arg',
+            'datatype': 'float64',
+            'path': name + '.arg',
+            'xmin': col * resolution,
+            'ymin': row * resolution,
+            'xmax': (col + cols) * resolution,
+            'ymax': (row + rows) * resolution,
+            'cellwidth': resolution,
+            'cellheight': resolution,
+            'cols': cols,
+            'rows': rows,
+            'xskew': 0,
+            'yskew': 0,
+            'epsg': srid
+        }
+        self.metadata_path = os.path.join(directory, name + '.json')
+
+    def write_tile(self, tile, index):
+        """Writes one metric of a tile into its place in the raster"""
+        rows, cols = tile.shape
+        # the file's rows are counted from the top
+        top = self.rows - (tile.row - self.row) - rows
+        left = tile.col - self.col
+        values = np.where(tile.has_value[index], tile.values[index], np.nan)
+        self.cells[top:top + rows, left:left + cols] = values[::-1]
+
+    def close(self):
+        """Flushes the cells to disk and writes the metadata"""
+        self.cells.flush()
+        del self.cells
+        with open(self.metadata_path, 'w') as metadata_file:
+            json.dump(self.metadata, metadata_file, indent=2)
+
+
+def rasterize_grid(cursor, resolution, tile_size, raster_dir=None):
+    """Fills demographic_grid by rasterizing the demographic features
+
+    PrepareDemographicGrid must have been run with the cursor, to reproject the
+    features to UTM and create the empty grid table.
+
+    Params:
+        :cursor: Database cursor to read the features and write the grid with
+        :resolution: Width and height (in meters) of the grid's cells
+        :tile_size: Width and height (in cells) of the tiles processed at once
+        :raster_dir: Directory to write the metrics' raster files into, or None
+                     not to write them
+    Returns the number of grid points created
+    """
+    cursor.execute("SELECT Find_SRID('public', 'gtfs_stops', 'geom');")
+    srid = cursor.fetchone()[0]
+    cursor.execute('SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e) '
+                   'FROM (SELECT ST_Extent(utm_geom) AS e FROM %s) extent;' % FEATURES_TABLE)
+    xmin, ymin, xmax, ymax = cursor.fetchone()
+    if xmin is None:
+        return 0
+
+    # cells are aligned to multiples of the resolution, as CreateGrid aligns them
+    min_col = int(np.floor(xmin / resolution))
+    min_row = int(np.floor(ymin / resolution))
+    cols = max(int(np.ceil(xmax / resolution)) - min_col, 1)
+    rows = max(int(np.ceil(ymax / resolution)) - min_row, 1)
+
+    rasters = []
+    if raster_dir:
+        if not os.path.isdir(raster_dir):
+            os.makedirs(raster_dir)
+        rasters = [RasterFile(raster_dir, RASTER_PREFIX + metric, min_col, min_row, cols, rows,
+                              resolution, srid)
+                   for metric in METRICS]
+
+    features_sql = ('SELECT id, %s, ST_Area(utm_geom), '
+                    'ST_AsBinary(CASE WHEN ST_Covers(tile, utm_geom) THEN utm_geom '
+                    '                 ELSE ST_Intersection(utm_geom, tile) END) '
+                    'FROM %s, (SELECT ST_MakeEnvelope(%%s, %%s, %%s, %%s, %%s) AS tile) t '
+                    'WHERE utm_geom && tile AND ST_Intersects(utm_geom, tile);'
+                    % (', '.join(METRICS), FEATURES_TABLE))
+    copy_sql = 'COPY demographic_grid (%s) FROM STDIN' % ', '.join(GRID_COLUMNS)
+    points = 0
+    for row in range(min_row, min_row + rows, tile_size):
+        for col in range(min_col, min_col + cols, tile_size):
+            tile = Tile(col, row, min(tile_size, min_col + cols - col),
+                        min(tile_size, min_row + rows - row), resolution)
+            cursor.execute(features_sql, list(tile.extent) + [srid])
+            for feature in cursor.fetchall():
+                tile.add_feature(feature[0], feature[1:1 + len(METRICS)], feature[-2],
+                                 GEOSGeometry(feature[-1]))
+            grid_rows = list(tile.get_grid_rows(srid))
+            if grid_rows:
+                cursor.copy_expert(copy_sql, StringIO(''.join(grid_rows)))
+                points += len(grid_rows)
+            for index, raster in enumerate(rasters):
+                raster.write_tile(tile, index)
+    for raster in rasters:
+        raster.close()
+    return points
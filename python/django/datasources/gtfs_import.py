@@ -0,0 +1,333 @@
+"""Incremental import of a GTFS feed over the previously imported one.
+
+The GeoTrellis import clears and reloads every gtfs_* table, even when only the
+calendar or a handful of trips changed between two versions of a feed. This module
+fingerprints each file of the two feeds and, for the files that changed, applies
+only the differences to the tables: small tables are replaced outright, while
+stops, trips and stop times are compared row by row on their keys.
+
+Only the columns and conversions used by the GeoTrellis import are written, so the
+tables end up as they would after a full import. Changes this module can't
+reproduce exactly (shapes, frequencies, stop times that need interpolating) raise
+an IncrementalImportError, and the caller falls back to a full import.
+"""
+import hashlib
+import zipfile
+
+from datasources.gtfs_validator import find_feed_members, iter_table_rows, parse_gtfs_time
+
+# Files the GeoTrellis import loads; changes to other files don't affect the database
+LOADED_FILES = ('agency.txt', 'stops.txt', 'routes.txt', 'trips.txt', 'stop_times.txt',
+                'calendar.txt', 'calendar_dates.txt', 'shapes.txt', 'frequencies.txt')
+
+# Derived tables that are out of date once a table has changed
+DERIVED_TABLES = {
+    'gtfs_stops': ('gtfs_stops_routes_join', 'gtfs_stops_info', 'gtfs_stops_buffers'),
+    'gtfs_routes': ('gtfs_stops_routes_join', 'gtfs_stops_info'),
+    'gtfs_trips': ('gtfs_stops_routes_join', 'gtfs_stops_info'),
+    'gtfs_stop_times': ('gtfs_stops_routes_join', 'gtfs_stops_info'),
+}
+
+# Number of rows sent to the database per statement
+BATCH_SIZE = 1000
+
+
+class IncrementalImportError(Exception):
+    """Raised when a feed's changes can't be applied incrementally."""
+    pass
+
+
+def fingerprint_members(feed):
+    """Computes the SHA-1 of every file at the root of a GTFS zip.
+
+    Params:
+        :feed: Path to (or file object of) the GTFS zip file
+    Returns:
+        A dict of GTFS file name -> hex SHA-1 of its contents
+    """
+    fingerprints = {}
+    with zipfile.ZipFile(feed) as zip_file:
+        for file_name, member in find_feed_members(zip_file).iteritems():
+            sha1 = hashlib.sha1()
+            with zip_file.open(member) as contents:
+                for chunk in iter(lambda: contents.read(64 * 1024), ''):
+                    sha1.update(chunk)
+            fingerprints[file_name] = sha1.hexdigest()
+    return fingerprints
+
+
+def format_gtfs_time(value):
+    """Normalizes a GTFS time to the zero-padded HH:MM:SS the import stores."""
+    seconds = parse_gtfs_time(value)
+    if seconds is None:
+        raise IncrementalImportError('Stop times without arrival and departure times must '
+                                     'be interpolated by a full import')
+    return '%02d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def to_int(value):
+    """Converts an optional integer value, like the import does for direction_id."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def to_float(value):
+    """Converts an optional float value, treating blanks as missing."""
+    if value is None or not value.strip():
+        return None
+    return float(value)
+
+
+# Row converters: each one takes a function that returns the value of a column (None if
+# the file lacks the column) and returns the values of the table's columns, in order.
+def agency_values(get):
+    return (get('agency_id') if get('agency_id') is not None else '1',
+            get('agency_name'), get('agency_url'), get('agency_timezone'),
+            get('agency_lang'), get('agency_phone'), get('agency_fare_url'))
+
+
+def routes_values(get):
+    return (get('route_id'), get('route_short_name') or '', get('route_long_name') or '',
+            int(get('route_type')),
+            get('agency_id') if get('agency_id') is not None else '1',
+            get('route_desc'), get('route_url'), get('route_color'), get('route_text_color'))
+
+
+def calendar_values(get):
+    days = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday')
+    return ((get('service_id'), get('start_date'), get('end_date')) +
+            tuple(1 if get(day) == '1' else 0 for day in days))
+
+
+def calendar_dates_values(get):
+    return (get('service_id'), get('date'), int(get('exception_type')))
+
+
+def stops_values(get):
+    # stop_lat and stop_lon are only used to build the geometries; see _update_stop_geoms
+    return (get('stop_id'), get('stop_name'), get('stop_desc'),
+            float(get('stop_lat')), float(get('stop_lon')))
+
+
+def trips_values(get):
+    return (get('trip_id'), get('service_id'), get('route_id'), get('trip_headsign'),
+            to_int(get('direction_id')), get('shape_id'))
+
+
+def stop_times_values(get):
+    return (get('trip_id'), int(get('stop_sequence')), get('stop_id'),
+            format_gtfs_time(get('arrival_time')), format_gtfs_time(get('departure_time')),
+            to_float(get('shape_dist_traveled')))
+
+
+# Tables that are small enough to be replaced whole when their file changes:
+# file name -> (table, columns, row converter)
+REPLACED_TABLES = {
+    'agency.txt': ('gtfs_agency',
+                   ('agency_id', 'agency_name', 'agency_url', 'agency_timezone', 'agency_lang',
+                    'agency_phone', 'agency_fare_url'),
+                   agency_values),
+    'routes.txt': ('gtfs_routes',
+                   ('route_id', 'route_short_name', 'route_long_name', 'route_type', 'agency_id',
+                    'route_desc', 'route_url', 'route_color', 'route_text_color'),
+                   routes_values),
+    'calendar.txt': ('gtfs_calendar',
+                     ('service_id', 'start_date', 'end_date', 'monday', 'tuesday', 'wednesday',
+                      'thursday', 'friday', 'saturday', 'sunday'),
+                     calendar_values),
+    'calendar_dates.txt': ('gtfs_calendar_dates', ('service_id', 'date', 'exception_type'),
+                           calendar_dates_values),
+}
+
+# Tables that are diffed row by row on their key, which is made of their first columns:
+# file name -> (table, columns, number of key columns, row converter)
+DIFFED_TABLES = {
+    'stops.txt': ('gtfs_stops', ('stop_id', 'stop_name', 'stop_desc', 'stop_lat', 'stop_lon'),
+                  1, stops_values),
+    'trips.txt': ('gtfs_trips',
+                  ('trip_id', 'service_id', 'route_id', 'trip_headsign', 'direction_id',
+                   'shape_id'),
+                  1, trips_values),
+    'stop_times.txt': ('gtfs_stop_times',
+                       ('trip_id', 'stop_sequence', 'stop_id', 'arrival_time', 'departure_time',
+                        'shape_dist_traveled'),
+                       2, stop_times_values),
+}
+
+
+def iter_table_values(zip_file, member, convert):
+    """Streams the converted values of each row of a table."""
+    rows = iter_table_rows(zip_file, member)
+    try:
+        header_row_num, header = next(rows)
+    except StopIteration:
+        return
+    columns = dict((column, index) for index, column in enumerate(header))
+    try:
+        for row_num, row in rows:
+            def get(name):
+                index = columns.get(name)
+                if index is None:
+                    return None
+                return row[index].strip() if index < len(row) else ''
+            try:
+                values = convert(get)
+            except (TypeError, ValueError) as e:
+                raise IncrementalImportError('Unable to read row %d of %s: %s'
+                                             % (row_num, member, e))
+            yield values
+    finally:
+        rows.close()
+
+
+def batches(iterable):
+    """Splits an iterable into lists of at most BATCH_SIZE items."""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class IncrementalImport(object):
+    """Applies the differences between two GTFS feeds to the gtfs_* tables.
+
+    The tables must hold the old feed, as imported by GeoTrellis.
+    """
+
+    def __init__(self, old_feed, new_feed, old_fingerprints, new_fingerprints):
+        """
+        Params:
+            :old_feed: Path to the GTFS zip file currently in the database
+            :new_feed: Path to the GTFS zip file to import
+            :old_fingerprints: fingerprint_members() of old_feed
+            :new_fingerprints: fingerprint_members() of new_feed
+        """
+        self.old_feed = old_feed
+        self.new_feed = new_feed
+        self.changed_files = set(
+            file_name for file_name in LOADED_FILES
+            if old_fingerprints.get(file_name) != new_fingerprints.get(file_name))
+        # table -> (inserted, updated, deleted) row counts
+        self.row_counts = {}
+
+    def check(self):
+        """Raises an IncrementalImportError if the changed files can't be applied."""
+        for file_name in self.changed_files:
+            if file_name not in REPLACED_TABLES and file_name not in DIFFED_TABLES:
+                raise IncrementalImportError('Changes to %s require a full import' % file_name)
+
+    def invalidated_tables(self):
+        """Returns the derived tables that the changes make out of date."""
+        tables = set()
+        for file_name in self.changed_files:
+            table = (REPLACED_TABLES.get(file_name) or DIFFED_TABLES.get(file_name))[0]
+            tables.update(DERIVED_TABLES.get(table, ()))
+        return tables
+
+    def apply(self, cursor):
+        """Applies the changes using the given database cursor.
+
+        Should be run in a transaction, since an IncrementalImportError can be raised
+        part way through, e.g. on finding stop times that need interpolating.
+        """
+        self.check()
+        old_zip = zipfile.ZipFile(self.old_feed)
+        new_zip = zipfile.ZipFile(self.new_feed)
+        try:
+            old_members = find_feed_members(old_zip)
+            new_members = find_feed_members(new_zip)
+            for file_name in sorted(self.changed_files):
+                if file_name in REPLACED_TABLES:
+                    self._replace_table(cursor, new_zip, new_members.get(file_name),
+                                        *REPLACED_TABLES[file_name])
+                else:
+                    self._diff_table(cursor, old_zip, old_members.get(file_name),
+                                     new_zip, new_members.get(file_name),
+                                     *DIFFED_TABLES[file_name])
+            if 'stops.txt' in self.changed_files:
+                self._update_stop_geoms(cursor)
+        finally:
+            old_zip.close()
+            new_zip.close()
+
+    def _insert(self, cursor, table, columns, rows):
+        sql = 'INSERT INTO %s (%s) VALUES (%s)' % (table, ', '.join(columns),
+                                                   ', '.join(['%s'] * len(columns)))
+        count = 0
+        for batch in batches(rows):
+            cursor.executemany(sql, batch)
+            count += len(batch)
+        return count
+
+    def _replace_table(self, cursor, zip_file, member, table, columns, convert):
+        cursor.execute('DELETE FROM %s' % table)
+        deleted = cursor.rowcount
+        inserted = 0
+        if member is not None:
+            inserted = self._insert(cursor, table, columns,
+                                    iter_table_values(zip_file, member, convert))
+        self.row_counts[table] = (inserted, 0, deleted)
+
+    def _diff_table(self, cursor, old_zip, old_member, new_zip, new_member,
+                    table, columns, num_keys, convert):
+        # Only a digest of each old row is kept in memory
+        old_digests = {}
+        if old_member is not None:
+            for values in iter_table_values(old_zip, old_member, convert):
+                old_digests[values[:num_keys]] = hash(values)
+
+        inserts = []
+        updates = []
+        counts = [0, 0, 0]
+        key_clause = ' AND '.join('%s = %%s' % column for column in columns[:num_keys])
+        update_sql = 'UPDATE %s SET %s WHERE %s' % (
+            table, ', '.join('%s = %%s' % column for column in columns[num_keys:]), key_clause)
+        if new_member is not None:
+            for values in iter_table_values(new_zip, new_member, convert):
+                key = values[:num_keys]
+                digest = old_digests.pop(key, None)
+                if digest is None:
+                    inserts.append(values)
+                elif digest != hash(values):
+                    updates.append(values[num_keys:] + key)
+                if len(inserts) == BATCH_SIZE:
+                    counts[0] += self._insert(cursor, table, columns, inserts)
+                    inserts = []
+                if len(updates) == BATCH_SIZE:
+                    cursor.executemany(update_sql, updates)
+                    counts[1] += len(updates)
+                    updates = []
+        counts[0] += self._insert(cursor, table, columns, inserts)
+        if updates:
+            cursor.executemany(update_sql, updates)
+            counts[1] += len(updates)
+
+        # Whatever is left of the old rows isn't in the new feed anymore
+        delete_sql = 'DELETE FROM %s WHERE %s' % (table, key_clause)
+        for batch in batches(old_digests.iterkeys()):
+            cursor.executemany(delete_sql, batch)
+            counts[2] += len(batch)
+        self.row_counts[table] = tuple(counts)
+
+    def _update_stop_geoms(self, cursor):
+        """Builds the geometries of inserted and updated stops from their coordinates.
+
+        The import stores stops as points in WGS 84 (the_geom) and in the UTM zone of
+        the feed (geom), but leaves stop_lat and stop_lon empty; they're only set here
+        to mark the stops that changed.
+        """
+        cursor.execute("""
+            UPDATE gtfs_stops
+            SET the_geom = ST_SetSRID(ST_MakePoint(stop_lon, stop_lat), 4326),
+                geom = ST_Transform(ST_SetSRID(ST_MakePoint(stop_lon, stop_lat), 4326),
+                                    Find_SRID('public', 'gtfs_stops', 'geom')),
+                stop_lat = NULL,
+                stop_lon = NULL
+            WHERE stop_lat IS NOT NULL AND stop_lon IS NOT NULL
+        """)
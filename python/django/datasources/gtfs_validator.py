@@ -0,0 +1,806 @@
+"""Streaming validation of GTFS feeds.
+
+transitfeed's Loader builds a full in-memory (or sqlite-backed) Schedule before it
+reports anything, which is far too slow and memory hungry for large feeds. The
+validator in this module instead reads each table straight out of the zip archive,
+one row at a time, and keeps only compact per-entity state (ID sets and a few
+integers per trip). Problems are reported through a transitfeed ProblemReporter,
+so they can be accumulated and saved exactly like the ones from the Loader.
+
+SampledFeedValidator runs the same per-row checks on only the first rows of each
+table, to report structural problems within seconds of an upload.
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+import csv
+import multiprocessing
+import os.path
+import zipfile
+
+from transitfeed import TYPE_WARNING
+
+
+# Bitmask used to keep the order-independent stop time digests at 64 bits
+DIGEST_MASK = 0xFFFFFFFFFFFFFFFF
+
+# Files that every feed must contain; a feed also needs at least one of the
+# calendar files.
+REQUIRED_FILES = ('agency.txt', 'stops.txt', 'routes.txt', 'trips.txt', 'stop_times.txt')
+CALENDAR_FILES = ('calendar.txt', 'calendar_dates.txt')
+
+# Columns that must be present in the header of each table
+REQUIRED_COLUMNS = {
+    'agency.txt': ('agency_name', 'agency_url', 'agency_timezone'),
+    'stops.txt': ('stop_id', 'stop_name', 'stop_lat', 'stop_lon'),
+    'routes.txt': ('route_id', 'route_type'),
+    'calendar.txt': ('service_id', 'monday', 'tuesday', 'wednesday', 'thursday',
+                     'friday', 'saturday', 'sunday', 'start_date', 'end_date'),
+    'calendar_dates.txt': ('service_id', 'date', 'exception_type'),
+    'shapes.txt': ('shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence'),
+    'trips.txt': ('route_id', 'service_id', 'trip_id'),
+    'stop_times.txt': ('trip_id', 'arrival_time', 'departure_time', 'stop_id',
+                       'stop_sequence'),
+}
+
+# Every column of every table defined by the GTFS reference, including optional ones
+KNOWN_COLUMNS = {
+    'agency.txt': ('agency_id', 'agency_name', 'agency_url', 'agency_timezone', 'agency_lang',
+                   'agency_phone', 'agency_fare_url', 'agency_email'),
+    'stops.txt': ('stop_id', 'stop_code', 'stop_name', 'stop_desc', 'stop_lat', 'stop_lon',
+                  'zone_id', 'stop_url', 'location_type', 'parent_station', 'stop_timezone',
+                  'wheelchair_boarding'),
+    'routes.txt': ('route_id', 'agency_id', 'route_short_name', 'route_long_name', 'route_desc',
+                   'route_type', 'route_url', 'route_color', 'route_text_color',
+                   'bikes_allowed'),
+    'calendar.txt': REQUIRED_COLUMNS['calendar.txt'],
+    'calendar_dates.txt': REQUIRED_COLUMNS['calendar_dates.txt'],
+    'shapes.txt': ('shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence',
+                   'shape_dist_traveled'),
+    'trips.txt': ('route_id', 'service_id', 'trip_id', 'trip_headsign', 'trip_short_name',
+                  'direction_id', 'block_id', 'shape_id', 'wheelchair_accessible',
+                  'bikes_allowed', 'original_trip_id'),
+    'stop_times.txt': ('trip_id', 'arrival_time', 'departure_time', 'stop_id', 'stop_sequence',
+                       'stop_headsign', 'pickup_type', 'drop_off_type', 'shape_dist_traveled',
+                       'timepoint'),
+    'fare_attributes.txt': ('fare_id', 'price', 'currency_type', 'payment_method', 'transfers',
+                            'transfer_duration'),
+    'fare_rules.txt': ('fare_id', 'route_id', 'origin_id', 'destination_id', 'contains_id'),
+    'frequencies.txt': ('trip_id', 'start_time', 'end_time', 'headway_secs', 'exact_times'),
+    'transfers.txt': ('from_stop_id', 'to_stop_id', 'transfer_type', 'min_transfer_time'),
+    'feed_info.txt': ('feed_publisher_name', 'feed_publisher_url', 'feed_lang',
+                      'feed_start_date', 'feed_end_date', 'feed_version'),
+}
+
+# Order in which tables are read; every table only references tables before it.
+TABLE_ORDER = ('agency.txt', 'stops.txt', 'routes.txt', 'calendar.txt', 'calendar_dates.txt',
+               'shapes.txt', 'trips.txt', 'stop_times.txt')
+
+
+def parse_gtfs_time(value):
+    """Convert a GTFS H:MM:SS / HH:MM:SS time to seconds past midnight.
+
+    Returns None for blank values; raises ValueError for malformed ones.
+    """
+    if not value:
+        return None
+    parts = value.split(':')
+    if len(parts) != 3:
+        raise ValueError('Time must be in HH:MM:SS format')
+    hours, minutes, seconds = [int(part) for part in parts]
+    if hours < 0 or not 0 <= minutes < 60 or not 0 <= seconds < 60:
+        raise ValueError('Time is out of range')
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def find_feed_members(zip_file):
+    """Maps GTFS file names to the names of the members holding them.
+
+    Only members at the root of the archive are used, like the GeoTrellis import;
+    directories such as __MACOSX are ignored.
+    """
+    members = {}
+    for name in zip_file.namelist():
+        if '/' in name:
+            continue
+        members[os.path.basename(name).lower()] = name
+    return members
+
+
+def iter_table_rows(zip_file, member):
+    """Streams the header and rows of one table out of a zip archive.
+
+    Yields a (row_num, row) tuple for each non-blank row, where row_num matches the
+    line numbering transitfeed uses (the header is row 1). The header is yielded
+    first with a row_num of 1, with any byte order mark and padding removed.
+    """
+    table = zip_file.open(member)
+    try:
+        reader = csv.reader(table)
+        header = None
+        for row in reader:
+            if header is None:
+                if row and row[0].startswith('\xef\xbb\xbf'):
+                    row[0] = row[0][3:]
+                header = [column.strip() for column in row]
+                yield 1, header
+                continue
+            if not row or (len(row) == 1 and not row[0].strip()):
+                continue
+            yield reader.line_num, row
+    finally:
+        table.close()
+
+
+def has_column_value(feed, file_name, column):
+    """Scans one column of a table for a non-blank value.
+
+    Stops reading at the first non-blank value, so feeds that have the column
+    filled in are answered after a single row.
+
+    Params:
+        :feed: Path to (or file object of) the GTFS zip file
+        :file_name: Name of the table, e.g. 'stop_times.txt'
+        :column: Name of the column to look for
+    """
+    with zipfile.ZipFile(feed) as zip_file:
+        member = find_feed_members(zip_file).get(file_name)
+        if member is None:
+            return False
+        rows = iter_table_rows(zip_file, member)
+        try:
+            header_row_num, header = next(rows)
+            if column not in header:
+                return False
+            index = header.index(column)
+            return any(len(row) > index and row[index].strip() for row_num, row in rows)
+        except StopIteration:
+            return False
+        finally:
+            rows.close()
+
+
+class ProblemRecorder(object):
+    """Stands in for a ProblemReporter in a worker process.
+
+    Records each problem reported, along with the file context it was reported in,
+    so that the parent process can replay them on the real ProblemReporter.
+    """
+
+    def __init__(self):
+        # (ProblemReporter method name, args, kwargs, file context or None)
+        self.calls = []
+        self.context = None
+
+    def SetFileContext(self, file_name, row_num, row, headers):
+        self.context = (file_name, row_num, row, headers)
+
+    def ClearContext(self):
+        self.context = None
+
+    def __getattr__(self, name):
+        def record(*args, **kwargs):
+            context = self.context
+            if context is not None:
+                # the row list is reused by the validator, so keep a copy
+                context = context[:2] + (list(context[2]),) + context[3:]
+            self.calls.append((name, args, kwargs, context))
+        return record
+
+    @staticmethod
+    def replay(calls, problems):
+        """Reports recorded problems to a ProblemReporter."""
+        for name, args, kwargs, context in calls:
+            if context is None:
+                problems.ClearContext()
+            else:
+                problems.SetFileContext(*context)
+            getattr(problems, name)(*args, **kwargs)
+        problems.ClearContext()
+
+
+@contextmanager
+def allow_child_processes():
+    """Lets the current process start child processes even if it's daemonic.
+
+    Celery's prefork pool runs tasks in daemonic processes, which multiprocessing
+    refuses to start children from, because it can't guarantee they're cleaned up when
+    the daemon is killed. The validation pool is joined or terminated before its
+    parent goes on, so it's safe to clear the flag while the pool runs.
+    """
+    current = multiprocessing.current_process()
+    daemonic = current.daemon
+    current.daemon = False
+    try:
+        yield
+    finally:
+        current.daemon = daemonic
+
+
+def validate_table_in_process(args):
+    """Validates a single table of a feed; run in a worker process by validate().
+
+    Returns the name of the table, the problems recorded by a ProblemRecorder, and
+    the validator state that the cross-table checks need.
+    """
+    feed, file_name, check_duplicate_trips = args
+    recorder = ProblemRecorder()
+    validator = StreamingFeedValidator(feed, recorder, check_duplicate_trips)
+    with zipfile.ZipFile(feed) as zip_file:
+        validator._validate_table(zip_file, find_feed_members(zip_file)[file_name], file_name)
+    state = dict((name, getattr(validator, name)) for name in StreamingFeedValidator.STATE)
+    return file_name, recorder.calls, state
+
+
+class StreamingFeedValidator(object):
+    """Validates a GTFS zip one table at a time in bounded memory.
+
+    Checks required files and columns, required and well-formed values, duplicate
+    IDs, references between tables, time ordering within trips, shape coverage and
+    duplicate trips. Stop times are expected to be grouped by trip in stop_sequence
+    order, as practically every feed is; the ordering checks are skipped for rows
+    that arrive out of sequence.
+
+    Each table is checked on its own, collecting IDs and the references it makes to
+    other tables, and the references are resolved once every table has been read.
+    That lets the tables be validated in parallel worker processes.
+
+    After validate() has run, has_shapes and has_shape_dist_traveled tell whether
+    the feed carries the data needed to calculate route lengths.
+    """
+
+    # Number of uses of each referenced ID whose rows are kept for reporting problems; at
+    # least as many as the problem accumulator keeps sample rows (GTFS_PROBLEM_SAMPLE_ROWS)
+    REFERENCE_SAMPLES = 10
+
+    # Attributes that hold what has been learned from reading tables
+    STATE = ('tables_read', 'agency_ids', 'stop_names', 'stations', 'route_ids', 'service_ids',
+             'shape_ids', 'used_shape_ids', 'used_stop_ids', 'trips', 'trip_stop_times',
+             'references', 'has_shapes', 'has_shape_dist_traveled')
+
+    def __init__(self, feed, problems, check_duplicate_trips=True, processes=1):
+        """
+        Params:
+            :feed: Path to (or file object of) the GTFS zip file; must be a path
+                   to validate in several processes
+            :problems: transitfeed ProblemReporter that receives the problems found
+            :check_duplicate_trips: Whether to look for trips with identical schedules
+            :processes: Number of worker processes to validate tables in; 1 to
+                        validate them all in this process
+        """
+        self.feed = feed
+        self.problems = problems
+        self.check_duplicate_trips = check_duplicate_trips
+        self.processes = processes
+
+        # Tables that were present with all their required columns; references
+        # into a table are only checked once it has been read.
+        self.tables_read = set()
+
+        self.agency_ids = set()
+        self.stop_names = {}
+        self.stations = set()
+        self.route_ids = set()
+        self.service_ids = set()
+        self.shape_ids = set()
+        self.used_shape_ids = set()
+        self.used_stop_ids = set()
+        # trip_id -> (route_id, service_id)
+        self.trips = {}
+        # trip_id -> [last stop_sequence, last departure, stop count, digest,
+        #             first stop_sequence, first stop has times, last stop has times]
+        self.trip_stop_times = {}
+
+        self.has_shapes = False
+        self.has_shape_dist_traveled = False
+
+        # (column, attribute holding the IDs referenced, tables holding them, message) ->
+        #     {referenced ID: [number of uses, [(file name, row number) of its first uses]]}
+        self.references = OrderedDict()
+        self.current_file = None
+        # Number of rows to read from each table; None to read all of them
+        self.sample_rows = None
+
+    def validate(self):
+        """Runs every check, reporting problems as they are found."""
+        try:
+            zip_file = zipfile.ZipFile(self.feed)
+        except IOError:
+            self.problems.FeedNotFound(str(self.feed))
+            return
+        except zipfile.BadZipfile:
+            self.problems.UnknownFormat(str(self.feed))
+            return
+
+        try:
+            members = find_feed_members(zip_file)
+            for file_name in REQUIRED_FILES:
+                if file_name not in members:
+                    self.problems.MissingFile(file_name)
+            if not any(file_name in members for file_name in CALENDAR_FILES):
+                self.problems.MissingFile(CALENDAR_FILES[0])
+
+            for file_name, member in sorted(members.iteritems()):
+                if file_name not in KNOWN_COLUMNS:
+                    self.problems.UnknownFile(member)
+                elif file_name not in TABLE_ORDER:
+                    # tables that aren't checked row by row still get their header checked
+                    self._validate_header(zip_file, member, file_name)
+
+            file_names = [file_name for file_name in TABLE_ORDER if file_name in members]
+            if self.processes > 1 and isinstance(self.feed, basestring):
+                self._validate_tables_in_processes(file_names)
+            else:
+                for file_name in file_names:
+                    # stop times can't be checked at all without their trips
+                    if file_name == 'stop_times.txt' and 'trips.txt' not in self.tables_read:
+                        continue
+                    self._validate_table(zip_file, members[file_name], file_name)
+
+            self._validate_references()
+        finally:
+            self.problems.ClearContext()
+            zip_file.close()
+
+    def _validate_tables_in_processes(self, file_names):
+        """Validates tables in a pool of worker processes, then merges their results.
+
+        Works in daemonic processes too, like the celery workers validation runs in.
+        """
+        with allow_child_processes():
+            pool = multiprocessing.Pool(min(self.processes, len(file_names)))
+            try:
+                # the largest tables go first, so they don't hold up the end of the run
+                largest_first = sorted(file_names, key=lambda name: name in ('stop_times.txt',
+                                                                              'shapes.txt'),
+                                       reverse=True)
+                results = pool.map(validate_table_in_process,
+                                   [(self.feed, name, self.check_duplicate_trips)
+                                    for name in largest_first])
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+
+        results = dict((file_name, (calls, state)) for file_name, calls, state in results)
+        for file_name in file_names:
+            calls, state = results[file_name]
+            if file_name == 'stop_times.txt' and 'trips.txt' not in self.tables_read:
+                continue
+            ProblemRecorder.replay(calls, self.problems)
+            self._merge_state(state)
+
+    def _merge_state(self, state):
+        """Adds what a worker process learned about one table to this validator."""
+        for name, value in state.iteritems():
+            if name == 'references':
+                for key, references in value.iteritems():
+                    merged = self.references.setdefault(key, {})
+                    for referenced_id, (uses, samples) in references.iteritems():
+                        merged_uses = merged.setdefault(referenced_id, [0, []])
+                        merged_uses[0] += uses
+                        merged_uses[1].extend(samples[:self.REFERENCE_SAMPLES -
+                                                      len(merged_uses[1])])
+            elif isinstance(value, bool):
+                setattr(self, name, getattr(self, name) or value)
+            else:
+                getattr(self, name).update(value)
+
+    def _add_reference(self, column, value, ids_attribute, tables, message, row_num):
+        """Records a reference to another table, to be checked by _validate_references.
+
+        Params:
+            :column: Column holding the reference
+            :value: Referenced ID
+            :ids_attribute: Name of the attribute holding the IDs it should be one of
+            :tables: Tables holding those IDs; the reference is only checked if one of
+                     them was read, or always if None
+            :message: Description of the problem when the ID is unknown
+            :row_num: Row of the reference
+        """
+        references = self.references.get((column, ids_attribute, tables, message))
+        if references is None:
+            references = self.references[(column, ids_attribute, tables, message)] = {}
+        uses = references.get(value)
+        if uses is None:
+            uses = references[value] = [0, []]
+        uses[0] += 1
+        if len(uses[1]) < self.REFERENCE_SAMPLES:
+            uses[1].append((self.current_file, row_num))
+
+    def _read_header(self, rows, file_name):
+        """Returns the header of a table, or None if it couldn't be read.
+
+        Columns that aren't part of the GTFS reference are reported as warnings.
+        """
+        try:
+            header_row_num, header = next(rows)
+        except StopIteration:
+            self.problems.EmptyFile(file_name)
+            return None
+        except csv.Error as e:
+            self.problems.CsvSyntax(description=str(e), context=(file_name, 1, [], []))
+            return None
+        for column in header:
+            if column not in KNOWN_COLUMNS[file_name]:
+                self.problems.UnrecognizedColumn(file_name, column)
+        return header
+
+    def _validate_header(self, zip_file, member, file_name):
+        """Checks only the header of a table."""
+        rows = iter_table_rows(zip_file, member)
+        try:
+            self._read_header(rows, file_name)
+        finally:
+            rows.close()
+
+    def _validate_table(self, zip_file, member, file_name):
+        """Reads one table, handing each row to its row validator."""
+        validate_row = getattr(self, '_validate_%s_row' % file_name[:-len('.txt')])
+        rows = iter_table_rows(zip_file, member)
+        header = self._read_header(rows, file_name)
+        if header is None:
+            return
+
+        missing = [column for column in REQUIRED_COLUMNS[file_name] if column not in header]
+        for column in missing:
+            self.problems.MissingColumn(file_name, column)
+        if missing:
+            return
+        self.tables_read.add(file_name)
+        self.current_file = file_name
+        columns = dict((column, index) for index, column in enumerate(header))
+        num_columns = len(header)
+
+        num_rows = 0
+        bad_encoding = False
+        try:
+            for row_num, row in rows:
+                if num_rows == self.sample_rows:
+                    break
+                num_rows += 1
+                self.problems.SetFileContext(file_name, row_num, row, header)
+                if not bad_encoding:
+                    # one badly encoded value is reported per table
+                    bad_encoding = not self._check_encoding(row, header)
+                if len(row) < num_columns:
+                    row.extend([''] * (num_columns - len(row)))
+                validate_row(row_num, [value.strip() for value in row], columns)
+        except csv.Error as e:
+            self.problems.CsvSyntax(description=str(e), context=(file_name, num_rows + 2, [], []))
+        finally:
+            self.problems.ClearContext()
+            rows.close()
+
+        if num_rows == 0:
+            self.problems.EmptyFile(file_name)
+
+    def _check_encoding(self, row, header):
+        """Reports the first value of a row that isn't valid UTF-8.
+
+        Returns False if one was found.
+        """
+        try:
+            ''.join(row).decode('utf-8')
+            return True
+        except UnicodeDecodeError:
+            pass
+        for index, value in enumerate(row):
+            try:
+                value.decode('utf-8')
+            except UnicodeDecodeError:
+                column = header[index] if index < len(header) else ''
+                self.problems.InvalidValue(column, value.decode('utf-8', 'replace'),
+                                           'Value is not UTF-8 encoded')
+                return False
+        return False
+
+    def _get(self, row, columns, name):
+        """Returns the value of an optional column, or '' if the column is absent."""
+        index = columns.get(name)
+        return row[index] if index is not None else ''
+
+    def _require(self, row, columns, name):
+        """Returns the value of a required column, reporting it if blank."""
+        value = row[columns[name]]
+        if not value:
+            self.problems.MissingValue(name)
+        return value
+
+    def _check_float(self, value, name, minimum, maximum):
+        """Reports value if it isn't a float within [minimum, maximum]."""
+        try:
+            number = float(value)
+        except ValueError:
+            self.problems.InvalidValue(name, value)
+            return
+        if not minimum <= number <= maximum:
+            self.problems.InvalidValue(name, value, 'Value must be between %s and %s'
+                                       % (minimum, maximum))
+
+    def _check_int(self, value, name, choices=None):
+        """Reports value if it isn't an integer (optionally one of choices)."""
+        try:
+            number = int(value)
+        except ValueError:
+            self.problems.InvalidValue(name, value)
+            return None
+        if choices is not None and number not in choices:
+            self.problems.InvalidValue(name, value)
+        return number
+
+    def _check_date(self, value, name):
+        """Reports value if it isn't a YYYYMMDD date."""
+        if len(value) != 8 or not value.isdigit():
+            self.problems.InvalidValue(name, value, 'Date must be in YYYYMMDD format')
+
+    def _validate_agency_row(self, row_num, row, columns):
+        for name in REQUIRED_COLUMNS['agency.txt']:
+            self._require(row, columns, name)
+        agency_id = self._get(row, columns, 'agency_id')
+        if agency_id in self.agency_ids:
+            self.problems.DuplicateID('agency_id', agency_id)
+        elif not agency_id and self.agency_ids:
+            self.problems.MissingValue('agency_id',
+                                       'agency_id is required when a feed has several agencies')
+        self.agency_ids.add(agency_id)
+
+    def _validate_stops_row(self, row_num, row, columns):
+        stop_id = self._require(row, columns, 'stop_id')
+        stop_name = self._require(row, columns, 'stop_name')
+        self._check_float(row[columns['stop_lat']], 'stop_lat', -90, 90)
+        self._check_float(row[columns['stop_lon']], 'stop_lon', -180, 180)
+        if stop_id in self.stop_names:
+            self.problems.DuplicateID('stop_id', stop_id)
+        location_type = self._get(row, columns, 'location_type')
+        if location_type and self._check_int(location_type, 'location_type', (0, 1)) == 1:
+            self.stations.add(stop_id)
+        self.stop_names[stop_id] = stop_name
+
+    def _validate_routes_row(self, row_num, row, columns):
+        route_id = self._require(row, columns, 'route_id')
+        if route_id in self.route_ids:
+            self.problems.DuplicateID('route_id', route_id)
+        self.route_ids.add(route_id)
+        agency_id = self._get(row, columns, 'agency_id')
+        if agency_id:
+            self._add_reference('agency_id', agency_id, 'agency_ids', ('agency.txt',),
+                                'agency_id does not match any agency in agency.txt', row_num)
+        if self._require(row, columns, 'route_type'):
+            self._check_int(row[columns['route_type']], 'route_type')
+        if not (self._get(row, columns, 'route_short_name') or
+                self._get(row, columns, 'route_long_name')):
+            self.problems.MissingValue('route_short_name',
+                                       'Either route_short_name or route_long_name is required')
+
+    def _validate_calendar_row(self, row_num, row, columns):
+        service_id = self._require(row, columns, 'service_id')
+        if service_id in self.service_ids:
+            self.problems.DuplicateID('service_id', service_id)
+        self.service_ids.add(service_id)
+        for day in ('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday'):
+            self._check_int(row[columns[day]], day, (0, 1))
+        self._check_date(row[columns['start_date']], 'start_date')
+        self._check_date(row[columns['end_date']], 'end_date')
+
+    def _validate_calendar_dates_row(self, row_num, row, columns):
+        self.service_ids.add(self._require(row, columns, 'service_id'))
+        self._check_date(row[columns['date']], 'date')
+        self._check_int(row[columns['exception_type']], 'exception_type', (1, 2))
+
+    def _validate_shapes_row(self, row_num, row, columns):
+        self.shape_ids.add(self._require(row, columns, 'shape_id'))
+        self._check_float(row[columns['shape_pt_lat']], 'shape_pt_lat', -90, 90)
+        self._check_float(row[columns['shape_pt_lon']], 'shape_pt_lon', -180, 180)
+        self._check_int(row[columns['shape_pt_sequence']], 'shape_pt_sequence')
+        self.has_shapes = True
+
+    def _validate_trips_row(self, row_num, row, columns):
+        trip_id = self._require(row, columns, 'trip_id')
+        route_id = self._require(row, columns, 'route_id')
+        service_id = self._require(row, columns, 'service_id')
+        if trip_id in self.trips:
+            self.problems.DuplicateID('trip_id', trip_id)
+        if route_id:
+            self._add_reference('route_id', route_id, 'route_ids', ('routes.txt',),
+                                'route_id does not match any route in routes.txt', row_num)
+        if service_id:
+            self._add_reference('service_id', service_id, 'service_ids', CALENDAR_FILES,
+                                'service_id does not match any service in the calendar',
+                                row_num)
+        shape_id = self._get(row, columns, 'shape_id')
+        if shape_id:
+            self._add_reference('shape_id', shape_id, 'shape_ids', None,
+                                'shape_id does not match any shape in shapes.txt', row_num)
+            self.used_shape_ids.add(shape_id)
+        self.trips[trip_id] = (route_id, service_id)
+
+    def _validate_stop_times_row(self, row_num, row, columns):
+        trip_id = row[columns['trip_id']]
+        stop_id = row[columns['stop_id']]
+        arrival = row[columns['arrival_time']]
+        departure = row[columns['departure_time']]
+
+        if not trip_id:
+            self.problems.MissingValue('trip_id')
+            return
+        self._add_reference('trip_id', trip_id, 'trips', ('trips.txt',),
+                            'trip_id does not match any trip in trips.txt', row_num)
+        if stop_id:
+            self._add_reference('stop_id', stop_id, 'stop_names', ('stops.txt',),
+                                'stop_id does not match any stop in stops.txt', row_num)
+        else:
+            self.problems.MissingValue('stop_id')
+        self.used_stop_ids.add(stop_id)
+
+        try:
+            sequence = int(row[columns['stop_sequence']])
+        except ValueError:
+            self.problems.InvalidValue('stop_sequence', row[columns['stop_sequence']])
+            return
+        try:
+            arrival_secs = parse_gtfs_time(arrival)
+        except ValueError as e:
+            self.problems.InvalidValue('arrival_time', arrival, str(e))
+            arrival_secs = None
+        try:
+            departure_secs = parse_gtfs_time(departure)
+        except ValueError as e:
+            self.problems.InvalidValue('departure_time', departure, str(e))
+            departure_secs = None
+        if (arrival_secs is None) != (departure_secs is None):
+            self.problems.OtherProblem('Stop time has only one of arrival_time and '
+                                       'departure_time set for trip %s' % trip_id)
+        elif arrival_secs is not None and departure_secs < arrival_secs:
+            self.problems.InvalidValue('departure_time', departure,
+                                       'departure_time is before arrival_time')
+
+        if not self.has_shape_dist_traveled and self._get(row, columns, 'shape_dist_traveled'):
+            self.has_shape_dist_traveled = True
+
+        has_times = arrival_secs is not None
+        row_digest = hash((arrival, departure, stop_id))
+        state = self.trip_stop_times.get(trip_id)
+        if state is None:
+            self.trip_stop_times[trip_id] = [sequence, departure_secs, 1, row_digest & DIGEST_MASK,
+                                             sequence, has_times, has_times]
+            return
+
+        state[2] += 1
+        state[3] = (state[3] + row_digest) & DIGEST_MASK
+        if sequence == state[0] or sequence == state[4]:
+            self.problems.DuplicateID(('trip_id', 'stop_sequence'), (trip_id, sequence))
+        elif sequence > state[0]:
+            if (arrival_secs is not None and state[1] is not None and
+                    arrival_secs < state[1]):
+                self.problems.OtherProblem('The stop at stop_sequence %d of trip %s arrives '
+                                           'before the departure from the previous stop'
+                                           % (sequence, trip_id))
+            state[0] = sequence
+            if departure_secs is not None:
+                state[1] = departure_secs
+            state[6] = has_times
+        elif sequence < state[4]:
+            state[4] = sequence
+            state[5] = has_times
+
+    def _validate_references(self):
+        """Runs the checks that need every table to have been read."""
+        for (column, ids_attribute, tables, message), references in self.references.iteritems():
+            if tables is not None and not self.tables_read.intersection(tables):
+                continue
+            ids = getattr(self, ids_attribute)
+            for value, (uses, samples) in references.iteritems():
+                if value not in ids:
+                    # reported once per use, as if each row had been checked as it was read
+                    for use in xrange(uses):
+                        if use < len(samples):
+                            file_name, row_num = samples[use]
+                            self.problems.SetFileContext(file_name, row_num, [], [])
+                        else:
+                            self.problems.ClearContext()
+                        self.problems.InvalidValue(column, value, message)
+
+        # Trips, stops and shapes reported here aren't tied to a single row
+        self.problems.ClearContext()
+
+        if 'stop_times.txt' in self.tables_read:
+            self._validate_trip_stop_times()
+            for stop_id, stop_name in self.stop_names.iteritems():
+                if stop_id not in self.used_stop_ids and stop_id not in self.stations:
+                    self.problems.UnusedStop(stop_id, stop_name)
+
+        for shape_id in self.shape_ids - self.used_shape_ids:
+            self.problems.OtherProblem('The shape with shape_id "%s" is not used by any trip.'
+                                       % shape_id, type=TYPE_WARNING)
+
+    def _validate_trip_stop_times(self):
+        """Checks each trip's stop times as a whole, and looks for duplicate trips."""
+        trips_by_schedule = {}
+        for trip_id, (route_id, service_id) in self.trips.iteritems():
+            state = self.trip_stop_times.get(trip_id)
+            if state is None:
+                self.problems.OtherProblem('The trip with the trip_id "%s" doesn\'t have any '
+                                           'stop times defined.' % trip_id, type=TYPE_WARNING)
+                continue
+            if not (state[5] and state[6]):
+                self.problems.OtherProblem('The first and last stops of trip %s must have '
+                                           'arrival and departure times' % trip_id)
+            if self.check_duplicate_trips:
+                key = (route_id, service_id, state[2], state[3])
+                duplicate_of = trips_by_schedule.get(key)
+                if duplicate_of is None:
+                    trips_by_schedule[key] = trip_id
+                else:
+                    self.problems.DuplicateTrip(duplicate_of, route_id, trip_id, route_id)
+
+
+class SampledFeedValidator(StreamingFeedValidator):
+    """Quickly checks the structure of a GTFS zip and a sample of its rows.
+
+    Reads the zip's central directory, the header of every table and at most
+    sample_rows rows of each, so it reports missing files and columns, unreadable
+    members and badly encoded or malformed rows within seconds, whatever the size
+    of the feed. References between tables and whole-trip checks need every row,
+    so they are left to the full StreamingFeedValidator run.
+    """
+
+    def __init__(self, feed, problems, sample_rows=1000):
+        """
+        Params:
+            :feed: Path to (or file object of) the GTFS zip file
+            :problems: transitfeed ProblemReporter that receives the problems found
+            :sample_rows: Number of rows to check from the start of each table
+        """
+        super(SampledFeedValidator, self).__init__(feed, problems, check_duplicate_trips=False)
+        self.sample_rows = sample_rows
+
+    def validate(self):
+        """Runs the sampled checks, reporting problems as they are found."""
+        try:
+            zip_file = zipfile.ZipFile(self.feed)
+        except IOError:
+            self.problems.FeedNotFound(str(self.feed))
+            return
+        except zipfile.BadZipfile:
+            self.problems.UnknownFormat(str(self.feed))
+            return
+
+        try:
+            members = find_feed_members(zip_file)
+            for file_name in REQUIRED_FILES:
+                if file_name not in members:
+                    self.problems.MissingFile(file_name)
+            if not any(file_name in members for file_name in CALENDAR_FILES):
+                self.problems.MissingFile(CALENDAR_FILES[0])
+
+            for file_name, member in sorted(members.iteritems()):
+                if file_name not in KNOWN_COLUMNS:
+                    self.problems.UnknownFile(member)
+                elif not self._validate_member(zip_file.getinfo(member), file_name):
+                    continue
+                elif file_name not in TABLE_ORDER:
+                    self._validate_header(zip_file, member, file_name)
+                else:
+                    self._validate_table(zip_file, member, file_name)
+        finally:
+            self.problems.ClearContext()
+            zip_file.close()
+
+    def _validate_member(self, info, file_name):
+        """Checks a table's entry in the central directory.
+
+        Returns False if the table can't be read.
+        """
+        if info.flag_bits & 0x1:
+            self.problems.FileFormat('%s is encrypted' % file_name)
+            return False
+        if info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            self.problems.FileFormat('%s uses an unsupported compression method (%d)'
+                                     % (file_name, info.compress_type))
+            return False
+        if info.file_size == 0:
+            self.problems.EmptyFile(file_name)
+            return False
+        return True
@@ -0,0 +1,106 @@
+"""
+Management command to benchmark the realtime stop times loaders
+"""
+
+import csv
+import datetime
+from optparse import make_option
+import os
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from datasources.models import RealTime
+from datasources.realtime_loader import (RejectedRows, copy_stop_times, open_stop_times_files,
+                                         read_stop_times)
+from datasources.tasks.realtime import insert_stop_times
+
+LOADERS = ('copy', 'orm')
+
+# Number of stops on each generated trip
+STOPS_PER_TRIP = 40
+
+
+def write_stop_times(path, rows):
+    """Writes a stop_times.txt_new file with the given number of generated rows"""
+    with open(path, 'w') as stop_times_file:
+        writer = csv.writer(stop_times_file)
+        writer.writerow(['trip_id', 'arrival_time', 'departure_time', 'stop_id',
+                         'stop_sequence', 'stop_headsign', 'pickup_type'])
+        for row in xrange(rows):
+            trip, sequence = divmod(row, STOPS_PER_TRIP)
+            arrival = 6 * 3600 + (trip % 960) * 60 + sequence * 90
+            departure = arrival + 20
+            writer.writerow(['T%d' % trip,
+                             '%02d:%02d:%02d' % (arrival // 3600, arrival // 60 % 60, arrival % 60),
+                             '%02d:%02d:%02d' % (departure // 3600, departure // 60 % 60,
+                                                 departure % 60),
+                             'S%d' % ((trip * 7 + sequence) % 5000),
+                             sequence + 1,
+                             'Downtown',
+                             0])
+
+
+class Command(BaseCommand):
+    """Command to measure the throughput of the realtime stop times loaders
+
+    Loads a stop times file with each loader inside a transaction that is
+    rolled back afterwards, so the loaded realtime data isn't touched.
+
+    """
+    args = None
+    help = 'Measures how many realtime stop times per second each loader imports'
+    option_list = BaseCommand.option_list + (
+        make_option('--rows', type='int', default=100000,
+                    help='Number of stop times to generate. Ignored if --file is given.'),
+        make_option('--file', default=None,
+                    help='stop_times.txt_new file (optionally .gz or .zip) to load instead '
+                         'of generated stop times'),
+        make_option('--loader', choices=LOADERS + ('all',), default='all',
+                    help='Loader to benchmark: copy, orm or all (the default)'),
+    )
+
+    def handle(self, *args, **options):
+        """Method that handles running the benchmark"""
+        path = options['file']
+        temp_dir = None
+        if path is None:
+            temp_dir = tempfile.mkdtemp()
+            path = os.path.join(temp_dir, 'stop_times.txt_new')
+            write_stop_times(path, options['rows'])
+        elif not os.path.isfile(path):
+            raise CommandError('No such file: %s' % path)
+
+        loaders = LOADERS if options['loader'] == 'all' else (options['loader'],)
+        try:
+            for loader in loaders:
+                imported, total, elapsed = self.load(loader, path)
+                self.stdout.write('%s: imported %d of %d rows in %.2fs (%d rows/s)'
+                                  % (loader, imported, total, elapsed,
+                                     imported / elapsed if elapsed else 0))
+        finally:
+            if temp_dir is not None:
+                os.remove(path)
+                os.rmdir(temp_dir)
+
+    def load(self, loader, path):
+        """Loads the file with one loader, then rolls the load back
+
+        Returns a (rows imported, rows read, seconds taken) tuple
+        """
+        with transaction.atomic():
+            real_time = RealTime.objects.create()
+            rejected_rows = RejectedRows()
+            rows = read_stop_times(open_stop_times_files(path), datetime.date.today())
+            start = time.time()
+            if loader == 'copy':
+                with connection.cursor() as cursor:
+                    imported, total, partitions = copy_stop_times(cursor, rows, real_time.id,
+                                                                  rejected_rows.add)
+            else:
+                imported, total = insert_stop_times(rows, real_time, rejected_rows.add)
+            elapsed = time.time() - start
+            transaction.set_rollback(True)
+        return imported, total, elapsed
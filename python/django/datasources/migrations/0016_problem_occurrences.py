@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datasources', '0015_auto_20140926_1757'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='boundaryproblem',
+            name='occurrences',
+            field=models.PositiveIntegerField(default=1),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='boundaryproblem',
+            name='sample_rows',
+            field=models.TextField(default='', blank=True),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='demographicdatasourceproblem',
+            name='occurrences',
+            field=models.PositiveIntegerField(default=1),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='demographicdatasourceproblem',
+            name='sample_rows',
+            field=models.TextField(default='', blank=True),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='gtfsfeedproblem',
+            name='occurrences',
+            field=models.PositiveIntegerField(default=1),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='gtfsfeedproblem',
+            name='sample_rows',
+            field=models.TextField(default='', blank=True),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='osmdataproblem',
+            name='occurrences',
+            field=models.PositiveIntegerField(default=1),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='osmdataproblem',
+            name='sample_rows',
+            field=models.TextField(default='', blank=True),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='realtimeproblem',
+            name='occurrences',
+            field=models.PositiveIntegerField(default=1),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='realtimeproblem',
+            name='sample_rows',
+            field=models.TextField(default='', blank=True),
+            preserve_default=False,
+        ),
+    ]
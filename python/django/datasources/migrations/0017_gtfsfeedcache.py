@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datasources', '0016_problem_occurrences'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GTFSFeedCache',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('sha1', models.CharField(unique=True, max_length=40)),
+                ('has_errors', models.BooleanField(default=False)),
+                ('unzipped_dir', models.TextField(blank=True)),
+                ('is_loaded', models.BooleanField(default=False)),
+                ('create_date', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='GTFSFeedCacheProblem',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('type', models.CharField(max_length=3, choices=[(b'err', 'Error'), (b'war', 'Warning')])),
+                ('description', models.TextField()),
+                ('title', models.CharField(max_length=255)),
+                ('occurrences', models.PositiveIntegerField(default=1)),
+                ('sample_rows', models.TextField(blank=True)),
+                ('cache', models.ForeignKey(to='datasources.GTFSFeedCache')),
+            ],
+            options={
+                'abstract': False,
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AddField(
+            model_name='gtfsfeed',
+            name='source_sha1',
+            field=models.CharField(default='', max_length=40, db_index=True, blank=True),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datasources', '0017_gtfsfeedcache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gtfsfeed',
+            name='member_fingerprints',
+            field=models.TextField(default='', blank=True),
+            preserve_default=False,
+        ),
+    ]
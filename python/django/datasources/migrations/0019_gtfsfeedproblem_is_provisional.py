@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datasources', '0018_gtfsfeed_member_fingerprints'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gtfsfeedproblem',
+            name='is_provisional',
+            field=models.BooleanField(default=False),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datasources', '0019_gtfsfeedproblem_is_provisional'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='realtime',
+            name='service_date',
+            field=models.DateField(null=True, blank=True),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datasources', '0020_realtime_service_date'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='osmdata',
+            name='source',
+            field=models.CharField(default=b'overpass', max_length=16, choices=[(b'overpass', 'Download from the Overpass API'), (b'pbf', 'Extract from a local .osm.pbf file')]),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='osmdata',
+            name='pbf_path',
+            field=models.CharField(max_length=255, blank=True),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.contrib.gis.db.models.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datasources', '0021_osmdata_source'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OSMImportRecord',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('coverage', django.contrib.gis.db.models.fields.MultiPolygonField(srid=4326)),
+                ('source_fingerprint', models.CharField(max_length=255)),
+                ('srid', models.IntegerField()),
+                ('table_checksums', models.TextField()),
+                ('import_date', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
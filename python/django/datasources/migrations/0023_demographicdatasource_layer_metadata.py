@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.contrib.gis.db.models.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datasources', '0022_osmimportrecord'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='demographicdatasource',
+            name='shapefile_name',
+            field=models.CharField(max_length=255, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='demographicdatasource',
+            name='srs',
+            field=models.TextField(blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='demographicdatasource',
+            name='extent',
+            field=django.contrib.gis.db.models.fields.PolygonField(srid=3857, null=True, blank=True),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.contrib.gis.db.models.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datasources', '0023_demographicdatasource_layer_metadata'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DemographicDataGridCell',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('cell_size', models.FloatField()),
+                ('grid_x', models.IntegerField()),
+                ('grid_y', models.IntegerField()),
+                ('population_metric_1', models.FloatField(null=True, blank=True)),
+                ('population_metric_2', models.FloatField(null=True, blank=True)),
+                ('destination_metric_1', models.FloatField(null=True, blank=True)),
+                ('feature_count', models.PositiveIntegerField()),
+                ('geom', django.contrib.gis.db.models.fields.PolygonField(srid=3857)),
+                ('datasource', models.ForeignKey(to='datasources.DemographicDataSource')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='demographicdatagridcell',
+            unique_together=set([('datasource', 'cell_size', 'grid_x', 'grid_y')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='demographicdatagridcell',
+            index_together=set([('datasource', 'cell_size')]),
+        ),
+        migrations.CreateModel(
+            name='DemographicDataSummary',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('metric', models.CharField(max_length=32)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('min', models.FloatField(null=True, blank=True)),
+                ('max', models.FloatField(null=True, blank=True)),
+                ('quantiles', models.TextField(blank=True)),
+                ('histogram', models.TextField(blank=True)),
+                ('datasource', models.ForeignKey(to='datasources.DemographicDataSource')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='demographicdatasummary',
+            unique_together=set([('datasource', 'metric')]),
+        ),
+    ]
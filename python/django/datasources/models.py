@@ -70,6 +70,10 @@ class DataSourceProblem(models.Model):
                             choices=ProblemTypes.CHOICES)
     description = models.TextField()
     title = models.CharField(max_length=255)
+    # Identical problems are stored once; occurrences is how many times the problem
+    # was found, and sample_rows holds the context of the first few, one per line.
+    occurrences = models.PositiveIntegerField(default=1)
+    sample_rows = models.TextField(blank=True)
 
     class Meta(object):
         abstract = True
@@ -85,12 +89,60 @@ class GTFSFeed(FileDataSource):
         COMPLETE: GTFS data successfully validated and loaded into the local database
         ERROR: An error occurred during processing. Check related instances
                of the GTFSFeedProblem endpoint
+
+    A new feed can be uploaded while the loaded one is kept, so it can be imported
+    incrementally over it; the old feed is deleted once the new one is loaded.
     """
+    # SHA-1 of the uploaded zip file, computed while it was uploaded
+    source_sha1 = models.CharField(max_length=40, blank=True, db_index=True)
+    # JSON object of GTFS file name -> SHA-1, used by incremental imports
+    member_fingerprints = models.TextField(blank=True)
+
+    def delete_replaced(self):
+        """Deletes the other feeds, once this one is loaded in their place
+
+        The empty_gtfs trigger leaves the gtfs tables alone while a feed remains,
+        so they keep this feed's data.
+        """
+        GTFSFeed.objects.exclude(pk=self.pk).delete()
 
 
 class GTFSFeedProblem(DataSourceProblem):
-    """Problem (either a warning or error) for a GTSFeed object"""
+    """Problem (either a warning or error) for a GTSFeed object
+
+    Problems found by the quick pre-validation are provisional until the full
+    validation replaces them.
+    """
     gtfsfeed = models.ForeignKey(GTFSFeed)
+    is_provisional = models.BooleanField(default=False)
+
+
+class GTFSFeedCache(models.Model):
+    """Validation and import results for the contents of a GTFS zip file.
+
+    Keyed by the SHA-1 of the file, so that uploading the same bytes again can reuse
+    the problems found on validation and the extracted files, and skip the import
+    entirely if that data is still loaded.
+    """
+    sha1 = models.CharField(max_length=40, unique=True)
+    has_errors = models.BooleanField(default=False)
+    # Directory the feed was extracted to for the GeoTrellis import
+    unzipped_dir = models.TextField(blank=True)
+    # Whether the gtfs_* tables currently hold this feed; reset by the empty_gtfs trigger
+    is_loaded = models.BooleanField(default=False)
+    create_date = models.DateTimeField(auto_now_add=True)
+
+    @classmethod
+    def mark_loaded(cls, sha1):
+        """Records that the gtfs_* tables now hold the feed with the given hash"""
+        # Only one feed's data can be in the gtfs tables at a time
+        cls.objects.exclude(sha1=sha1).update(is_loaded=False)
+        cls.objects.filter(sha1=sha1).update(is_loaded=True)
+
+
+class GTFSFeedCacheProblem(DataSourceProblem):
+    """Problem found when a cached GTFS file was validated"""
+    cache = models.ForeignKey(GTFSFeedCache)
 
 
 class Boundary(FileDataSource):
@@ -119,8 +171,42 @@ class OSMData(FileDataSource):
         IMPORTING: Importing downloaded data into the local db
         COMPLETE: Import done
         ERROR: An error occurred during processing. Check related OSMDataProblem endpoint
+
+    The data is either downloaded from the overpass API, or clipped out of a
+    locally stored .osm.pbf file (pbf_path, or else settings.OSM_PBF_PATH), so
+    imports can run without network access.
     """
+    class Sources(object):
+        OVERPASS = 'overpass'
+        PBF = 'pbf'
+        CHOICES = (
+            (OVERPASS, _(u'Download from the Overpass API')),
+            (PBF, _(u'Extract from a local .osm.pbf file')),
+        )
+
     gtfsfeed = models.ForeignKey(GTFSFeed)
+    source = models.CharField(max_length=16, default=Sources.OVERPASS, choices=Sources.CHOICES)
+    pbf_path = models.CharField(max_length=255, blank=True)
+
+    def get_pbf_path(self):
+        """Path of the .osm.pbf file to extract data from, for the PBF source"""
+        return self.pbf_path or settings.OSM_PBF_PATH
+
+
+class OSMImportRecord(models.Model):
+    """What the last OSM import left in the planet_osm_* tables, so later imports can reuse it
+
+    The tables are kept when the GTFS feed they were imported for is deleted, so
+    the record isn't tied to a feed or its OSMData either.
+    """
+    # The area covered (in degrees, the union of the bounding boxes of the imports merged
+    # into the tables), where the data came from, the SRID it was projected to and a JSON
+    # object of table name -> checksum
+    coverage = models.MultiPolygonField(srid=4326)
+    source_fingerprint = models.CharField(max_length=255)
+    srid = models.IntegerField()
+    table_checksums = models.TextField()
+    import_date = models.DateTimeField(auto_now=True)
 
 
 class OSMDataProblem(DataSourceProblem):
@@ -140,7 +226,11 @@ class RealTime(FileDataSource):
         COMPLETE: Stop times successfully loaded
         ERROR: Error during processing. Check related instances of RealTimeProblem
 
+    Stop times are kept by service date. Files in a zip upload take the date in
+    their name; the other stop times take service_date, or the date in the
+    upload's name, or else the day of the upload.
     """
+    service_date = models.DateField(null=True, blank=True)
 
 
 class RealTimeProblem(DataSourceProblem):
@@ -175,6 +265,12 @@ class DemographicDataSource(FileDataSource):
     # correctly.
     num_features = models.PositiveIntegerField(blank=True, null=True)
 
+    # Metadata of the shapefile's layer, cached when its fields are extracted: the path of
+    # the shapefile inside the uploaded zip, its spatial reference as WKT, and its extent
+    shapefile_name = models.CharField(max_length=255, blank=True)
+    srs = models.TextField(blank=True)
+    extent = models.PolygonField(srid=settings.DJANGO_SRID, blank=True, null=True)
+
 
 class DemographicDataSourceProblem(DataSourceProblem):
     """Problem with a demographic data shapefile."""
@@ -216,3 +312,62 @@ class DemographicDataFeature(DataSource):
 
     # The DataSource where this data came from
     datasource = models.ForeignKey(DemographicDataSource)
+
+
+class DemographicDataGridCell(models.Model):
+    """Sums of the demographic metrics over a square cell of one level of a pyramid of grids.
+
+    When demographic data is loaded, the features' metrics are summed over the cells
+    of grids of each of settings.DEMOGRAPHIC_PYRAMID_CELL_SIZES, so maps can be drawn
+    at any zoom level without reading every feature. Each feature is counted in the
+    cell holding a point on its surface.
+    """
+    datasource = models.ForeignKey(DemographicDataSource)
+
+    # Width and height of the cell (in units of settings.DJANGO_SRID), and its column
+    # and row, counted from the origin, in the grid of cells of that size
+    cell_size = models.FloatField()
+    grid_x = models.IntegerField()
+    grid_y = models.IntegerField()
+
+    population_metric_1 = models.FloatField(blank=True, null=True)
+    population_metric_2 = models.FloatField(blank=True, null=True)
+    destination_metric_1 = models.FloatField(blank=True, null=True)
+
+    # Number of features summed into the cell
+    feature_count = models.PositiveIntegerField()
+
+    geom = models.PolygonField(srid=settings.DJANGO_SRID)
+
+    objects = models.GeoManager()
+
+    class Meta(object):
+        unique_together = (('datasource', 'cell_size', 'grid_x', 'grid_y'),)
+        index_together = (('datasource', 'cell_size'),)
+
+
+class DemographicDataSummary(models.Model):
+    """Summary statistics of one metric of the demographic features of a datasource.
+
+    Lets legends be built without reading every feature.
+    """
+    datasource = models.ForeignKey(DemographicDataSource)
+
+    # Name of the DemographicDataFeature field summarized, e.g. population_metric_1
+    metric = models.CharField(max_length=32)
+
+    # Number of features with a value for the metric, and the range of their values
+    count = models.PositiveIntegerField(default=0)
+    min = models.FloatField(blank=True, null=True)
+    max = models.FloatField(blank=True, null=True)
+
+    # JSON list of the upper bounds of settings.DEMOGRAPHIC_SUMMARY_QUANTILES groups of
+    # features of equal size, ordered by their values
+    quantiles = models.TextField(blank=True)
+
+    # JSON list of the number of features in each of settings.DEMOGRAPHIC_SUMMARY_HISTOGRAM_BINS
+    # equal-width bins between min and max
+    histogram = models.TextField(blank=True)
+
+    class Meta(object):
+        unique_together = (('datasource', 'metric'),)
@@ -0,0 +1,507 @@
+"""Bulk loading of observed stop times with PostgreSQL's COPY.
+
+Building a RealStopTime object per row and sending batches through bulk_create
+spends most of its time in Python object construction and in the server parsing
+INSERT statements. The loader in this module instead turns the rows of an
+uploaded stop_times file into COPY's text format as they are read, so the file
+is streamed straight into gtfs_stop_times_real. Rows are validated on the way
+through, and invalid ones are reported and left out instead of failing the COPY.
+
+Rows are copied in batches, each in its own savepoint. If the database still
+rejects a batch, it is split in halves until the offending rows are isolated, so
+a handful of bad rows costs a few extra statements rather than a row-by-row
+fallback.
+
+gtfs_stop_times_real is partitioned by service date through table inheritance:
+each day of each import is loaded into its own child table, which is indexed
+before it's attached to the parent, so readers never see a half-loaded day and
+adding a day costs the same however much history is kept. A day that's
+uploaded again replaces the old day's partition, and days older than the
+retention window are detached; detached partitions are dropped later.
+
+Uploads may be a plain stop_times file, a gzipped one, or a zip holding several
+of them (e.g. one per day); they are decompressed on the fly as rows are read.
+"""
+import csv
+import datetime
+import gzip
+import io
+import os.path
+import re
+import zipfile
+from itertools import islice
+from StringIO import StringIO
+
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from django.utils.translation import ugettext_lazy as _
+
+from datasources.gtfs_validator import parse_gtfs_time
+from gtfs_realtime.models import RealStopTime
+
+# Columns of gtfs_stop_times_real filled from the file, in the order they are copied
+COPY_COLUMNS = ('trip_id', 'stop_id', 'stop_sequence', 'arrival_time', 'departure_time',
+                'arrival_seconds', 'departure_seconds', 'stop_headsign', 'pickup_type',
+                'drop_off_type', 'shape_dist_traveled', 'service_date', 'datasource_id')
+
+# Parent table of the partitions, which are named after their service date and import,
+# e.g. gtfs_stop_times_real_p20150601_12
+STOP_TIMES_TABLE = RealStopTime._meta.db_table
+PARTITION_NAME = STOP_TIMES_TABLE + '_p%s_%d'
+PARTITION_PATTERN = '^' + STOP_TIMES_TABLE + '_p[0-9]{8}_[0-9]+$'
+
+# Dates in the names of uploaded files, e.g. stop_times_2015-06-01.txt or 20150601.txt
+SERVICE_DATE_PATTERN = re.compile(r'(?<![0-9])([0-9]{4})-?([0-9]{2})-?([0-9]{2})(?![0-9])')
+
+# Extensions of the stop times files read out of zip uploads
+STOP_TIMES_EXTENSIONS = ('.txt_new', '.txt')
+
+# Number of rows sent in each COPY
+COPY_BATCH_SIZE = 50000
+
+# Rejected row ranges listed in the problem description; the rest are only counted
+MAX_LISTED_RANGES = 1000
+
+# Bounds of PostgreSQL's integer type
+MIN_INTEGER = -2 ** 31
+MAX_INTEGER = 2 ** 31 - 1
+
+# Maximum lengths of the text columns
+MAX_LENGTHS = dict((name, RealStopTime._meta.get_field(name).max_length)
+                   for name in ('trip_id', 'stop_id', 'arrival_time', 'departure_time',
+                                'stop_headsign'))
+
+# Values that need escaping in COPY's text format
+COPY_ESCAPES = (('\\', '\\\\'), ('\t', '\\t'), ('\n', '\\n'), ('\r', '\\r'))
+
+
+class InvalidRow(ValueError):
+    """Raised when a row can't be loaded as a stop time"""
+    pass
+
+
+def clean_text(row, name, required=False, default=''):
+    """Returns a text column of a row, checked against the field's length"""
+    value = row.get(name)
+    if value is None:
+        value = default
+    if required and not value:
+        raise InvalidRow('%s is required' % name)
+    max_length = MAX_LENGTHS[name]
+    # a value can't have more characters than bytes, so most need no decoding
+    if value is not None and len(value) > max_length and len(value.decode('utf-8')) > max_length:
+        raise InvalidRow('%s is longer than %d characters' % (name, max_length))
+    return value
+
+
+def clean_time(value, name):
+    """Converts a time to seconds past midnight of the service day, or None if it's blank"""
+    try:
+        return parse_gtfs_time(value.strip())
+    except ValueError as e:
+        raise InvalidRow('%s "%s" is invalid: %s' % (name, value, e))
+
+
+def clean_integer(row, name, default=None):
+    """Returns an integer column of a row, or the default if it's blank"""
+    value = (row.get(name) or '').strip()
+    if not value:
+        if default is None:
+            raise InvalidRow('%s is required' % name)
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        raise InvalidRow('%s "%s" is not an integer' % (name, value))
+    if not MIN_INTEGER <= number <= MAX_INTEGER:
+        raise InvalidRow('%s %s is out of range' % (name, value))
+    return number
+
+
+def clean_float(row, name):
+    """Returns a float column of a row, or None if it's blank"""
+    value = (row.get(name) or '').strip()
+    if not value:
+        return None
+    try:
+        number = float(value)
+    except ValueError:
+        raise InvalidRow('%s "%s" is not a number' % (name, value))
+    if number != number or number in (float('inf'), float('-inf')):
+        raise InvalidRow('%s "%s" is not a number' % (name, value))
+    return number
+
+
+def clean_stop_time(row):
+    """Validates a row of a stop_times file and applies the defaults of optional columns.
+
+    Returns the values of the row in COPY_COLUMNS order, without the datasource.
+    Raises InvalidRow if the row can't be loaded.
+    """
+    for value in row.itervalues():
+        if isinstance(value, list):
+            raise InvalidRow('Row has more values than the header has columns')
+        if isinstance(value, basestring):
+            if '\x00' in value:
+                raise InvalidRow('Row contains a NUL character')
+            try:
+                value.decode('utf-8')
+            except UnicodeDecodeError:
+                raise InvalidRow('Row is not UTF-8 encoded')
+
+    arrival_time = clean_text(row, 'arrival_time')
+    departure_time = clean_text(row, 'departure_time')
+    return (clean_text(row, 'trip_id', required=True),
+            clean_text(row, 'stop_id', required=True),
+            clean_integer(row, 'stop_sequence'),
+            arrival_time,
+            departure_time,
+            clean_time(arrival_time, 'arrival_time'),
+            clean_time(departure_time, 'departure_time'),
+            clean_text(row, 'stop_headsign', default=None),
+            clean_integer(row, 'pickup_type', default=0),
+            clean_integer(row, 'drop_off_type', default=0),
+            clean_float(row, 'shape_dist_traveled'),
+            row['service_date'])
+
+
+def format_copy_value(value):
+    """Formats one value in COPY's text format"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, float):
+        return repr(value)
+    if not isinstance(value, basestring):
+        return str(value)
+    for character, escaped in COPY_ESCAPES:
+        if character in value:
+            value = value.replace(character, escaped)
+    return value
+
+
+class RejectedRows(object):
+    """Collects the rows left out of an import, to report them as a single problem.
+
+    Row numbers are kept as ranges of consecutive rows, and the reasons for only
+    the first few rows are kept, so memory use stays small even if every row of
+    a large file is rejected.
+    """
+    title = _('Rows not imported')
+    description = _('%(count)d rows could not be imported: %(rows)s')
+    sample_label = 'Row'
+
+    def __init__(self, max_samples=None):
+        if max_samples is None:
+            max_samples = settings.GTFS_PROBLEM_SAMPLE_ROWS
+        self.max_samples = max_samples
+        # [first row, last row] of each range of consecutive rejected rows
+        self.ranges = []
+        self.count = 0
+        self.samples = []
+
+    def add(self, line, message):
+        """Records a rejected row and the reason it was rejected"""
+        self.count += 1
+        if self.ranges and self.ranges[-1][1] == line - 1:
+            self.ranges[-1][1] = line
+        else:
+            self.ranges.append([line, line])
+        if len(self.samples) < self.max_samples:
+            self.samples.append('%s %d: %s' % (self.sample_label, line, message))
+
+    def get_description(self):
+        """Lists the rejected rows, as ranges where they are consecutive"""
+        ranges = ', '.join(str(first) if first == last else '%d-%d' % (first, last)
+                           for first, last in sorted(self.ranges)[:MAX_LISTED_RANGES])
+        if len(self.ranges) > MAX_LISTED_RANGES:
+            ranges += _(' and %d more ranges') % (len(self.ranges) - MAX_LISTED_RANGES)
+        return self.description % {'count': self.count, 'rows': ranges}
+
+    def report(self, error_factory):
+        """Saves a warning for the rejected rows, if there are any"""
+        if self.count:
+            error_factory.warn(self.title, self.get_description(),
+                               occurrences=self.count, sample_rows='\n'.join(self.samples))
+
+
+def insert_isolating_failures(rows, insert):
+    """Inserts a batch of rows, splitting it in halves on failure to isolate bad rows
+
+    Each attempt runs in its own savepoint, so a failed insert doesn't abort the
+    surrounding transaction. Finding k bad rows in a batch of n takes about
+    k * log2(n) extra inserts.
+
+    Params:
+        :rows: List of (row number, row) tuples
+        :insert: Function that inserts a list of such tuples, raising on failure
+    Returns a list of (row number, error message) tuples for the rows that failed
+    """
+    try:
+        with transaction.atomic():
+            insert(rows)
+        return []
+    except (DatabaseError, ValueError, TypeError) as e:
+        if len(rows) == 1:
+            # the database's messages carry context on the following lines
+            message = (str(e).strip().splitlines() or [e.__class__.__name__])[0]
+            return [(rows[0][0], message)]
+    middle = len(rows) // 2
+    return (insert_isolating_failures(rows[:middle], insert) +
+            insert_isolating_failures(rows[middle:], insert))
+
+
+def get_service_date(name):
+    """Returns the date in a file name, or None if it has none"""
+    match = SERVICE_DATE_PATTERN.search(os.path.basename(name))
+    if match:
+        try:
+            return datetime.date(*(int(part) for part in match.groups()))
+        except ValueError:
+            pass
+    return None
+
+
+def open_stop_times_files(path):
+    """Opens the stop times files of an upload, one at a time
+
+    Yields a (member name, file object) tuple for each stop times file at the
+    root of a zip, in name order, or a (None, file object) tuple for a plain or
+    gzipped stop_times file. Compressed files are decompressed as they are read,
+    never to disk. Each file is closed once the next one is asked for.
+    """
+    if path.endswith('.zip'):
+        with zipfile.ZipFile(path) as zip_file:
+            names = sorted(name for name in zip_file.namelist()
+                           if '/' not in name and name.endswith(STOP_TIMES_EXTENSIONS))
+            if not names:
+                raise ValueError('The zip file holds no %s files'
+                                 % ' or '.join(STOP_TIMES_EXTENSIONS))
+            for name in names:
+                member = zip_file.open(name)
+                try:
+                    yield name, member
+                finally:
+                    member.close()
+    elif path.endswith('.gz'):
+        # buffered, since GzipFile reads lines slowly on its own
+        with io.BufferedReader(gzip.open(path, 'rb')) as stop_times_file:
+            yield None, stop_times_file
+    else:
+        with open(path, 'r') as stop_times_file:
+            yield None, stop_times_file
+
+
+def read_stop_times(stop_times_files, service_date):
+    """Reads the rows of stop times files, each starting with a header row
+
+    Yields a (row number, row dict) tuple for each row, with the row's service
+    date under 'service_date': the date in the name of the zip member it was
+    read from, or else the given service date. Rows are numbered across all the
+    files, so rows of later files continue the count.
+    """
+    line = 0
+    for name, stop_times_file in stop_times_files:
+        file_date = (name and get_service_date(name)) or service_date
+        for line, row in enumerate(csv.DictReader(stop_times_file), start=line + 1):
+            row['service_date'] = file_date
+            yield line, row
+
+
+class StopTimeCopyRows(object):
+    """Formats stop time rows for COPY FROM STDIN.
+
+    Yields a (row number, service date, formatted row) tuple for each valid row. Each row is
+    read and validated only when it's asked for, so memory use doesn't grow with
+    the files. Rows that fail validation are handed to on_invalid and skipped.
+    """
+
+    def __init__(self, rows, datasource_id, on_invalid):
+        """
+        Params:
+            :rows: Iterable of (row number, row dict) tuples, e.g. from read_stop_times
+            :datasource_id: ID of the RealTime the stop times belong to
+            :on_invalid: Called with the row number and the reason for each invalid row
+        """
+        self.rows = rows
+        self.datasource_id = format_copy_value(datasource_id)
+        self.on_invalid = on_invalid
+        self.valid = 0
+        self.total = 0
+
+    def __iter__(self):
+        for line, row in self.rows:
+            self.total = line
+            try:
+                values = clean_stop_time(row)
+            except InvalidRow as e:
+                self.on_invalid(line, str(e))
+                continue
+            self.valid += 1
+            yield line, row['service_date'], '%s\t%s\n' % (
+                '\t'.join(format_copy_value(value) for value in values), self.datasource_id)
+
+
+def copy_stop_times(cursor, rows, datasource_id, on_invalid, batch_size=COPY_BATCH_SIZE):
+    """Streams stop times into new partitions of gtfs_stop_times_real with COPY FROM STDIN
+
+    A partition is created for each service date the rows have, and left
+    unattached until attach_partitions is called with them, so nothing loaded
+    here is visible to readers before then.
+
+    Params:
+        :cursor: Database cursor to run the COPY with
+        :rows: Iterable of (row number, row dict) tuples, e.g. from read_stop_times
+        :datasource_id: ID of the RealTime the stop times belong to
+        :on_invalid: Called with the row number and the reason for each row that
+                     is invalid or that the database rejects
+        :batch_size: Number of rows sent in each COPY
+    Returns a (rows copied, rows read, partitions) tuple, where partitions maps
+    each service date to the partition its rows were copied into
+    """
+    partitions = {}
+
+    def copy_into(table):
+        sql = 'COPY %s (%s) FROM STDIN' % (table, ', '.join(COPY_COLUMNS))
+
+        def copy(rows):
+            cursor.copy_expert(sql, StringIO(''.join(text for line, text in rows)))
+        return copy
+
+    stop_times = StopTimeCopyRows(rows, datasource_id, on_invalid)
+    rows = iter(stop_times)
+    copied = 0
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            break
+        by_date = {}
+        for line, service_date, text in batch:
+            by_date.setdefault(service_date, []).append((line, text))
+        for service_date, date_rows in sorted(by_date.items()):
+            if service_date not in partitions:
+                partitions[service_date] = create_partition(cursor, service_date, datasource_id)
+            failures = insert_isolating_failures(date_rows, copy_into(partitions[service_date]))
+            for line, message in failures:
+                on_invalid(line, message)
+            copied += len(date_rows) - len(failures)
+    return copied, stop_times.total, partitions
+
+
+def get_table_constraints(cursor, table):
+    """Returns the (name, definition) of each key constraint of a table"""
+    cursor.execute("""SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint
+                      WHERE conrelid = %s::regclass AND contype IN ('p', 'u', 'f')
+                      ORDER BY contype DESC, conname""", [table])
+    return cursor.fetchall()
+
+
+def get_table_indexes(cursor, table):
+    """Returns the (name, definition) of each index of a table not backing a constraint"""
+    cursor.execute("""SELECT c.relname, pg_get_indexdef(i.indexrelid)
+                      FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+                      WHERE i.indrelid = %s::regclass
+                      AND NOT EXISTS (SELECT 1 FROM pg_constraint
+                                      WHERE conindid = i.indexrelid)
+                      ORDER BY c.relname""", [table])
+    return cursor.fetchall()
+
+
+def create_partition(cursor, service_date, datasource_id):
+    """Creates an empty, unattached partition for the stop times of a day of an import
+
+    The partition has the columns and defaults (sharing the id sequence) of
+    gtfs_stop_times_real and a check that its rows are of the service date, but
+    no indexes or keys yet, so loading is fast.
+    Returns the name of the partition
+    """
+    table = PARTITION_NAME % (service_date.strftime('%Y%m%d'), datasource_id)
+    cursor.execute('DROP TABLE IF EXISTS %s' % table)
+    cursor.execute('CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS INCLUDING CONSTRAINTS, '
+                   'CHECK (service_date = %%s))' % (table, STOP_TIMES_TABLE), [service_date])
+    return table
+
+
+def index_partition(cursor, table):
+    """Adds the keys and indexes of gtfs_stop_times_real to a partition"""
+    for number, (name, definition) in enumerate(get_table_constraints(cursor, STOP_TIMES_TABLE)):
+        cursor.execute('ALTER TABLE %s ADD CONSTRAINT %s_key%d %s'
+                       % (table, table, number, definition))
+    for number, (name, definition) in enumerate(get_table_indexes(cursor, STOP_TIMES_TABLE)):
+        cursor.execute(re.sub(r'INDEX \S+ ON \S+ ', 'INDEX %s_idx%d ON %s ' % (table, number, table),
+                              definition, count=1))
+    cursor.execute('ANALYZE %s' % table)
+
+
+def get_partition_date(table):
+    """Returns the service date of a partition, from its name"""
+    return datetime.datetime.strptime(table[len(STOP_TIMES_TABLE) + 2:][:8], '%Y%m%d').date()
+
+
+def get_partitions(cursor):
+    """Returns the (name, service date) of each partition attached to gtfs_stop_times_real"""
+    cursor.execute("""SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                      WHERE i.inhparent = %s::regclass ORDER BY c.relname""",
+                   [STOP_TIMES_TABLE])
+    return [(name, get_partition_date(name)) for name, in cursor.fetchall()]
+
+
+def attach_partitions(cursor, partitions):
+    """Attaches loaded partitions to gtfs_stop_times_real
+
+    Must run in a transaction, so readers see either the old or the new stop
+    times of a day. The partitions are indexed first, so the parent is locked
+    only while partitions of the same days are detached and the new ones
+    attached, which takes the same short time however much data they hold.
+    Detached partitions are left for drop_retired_partitions.
+
+    Params:
+        :partitions: Dict of service date to the partition loaded for it, as
+                     returned by copy_stop_times
+    """
+    if not partitions:
+        return
+    for table in partitions.itervalues():
+        index_partition(cursor, table)
+    cursor.execute('LOCK TABLE %s IN ACCESS EXCLUSIVE MODE' % STOP_TIMES_TABLE)
+    for name, service_date in get_partitions(cursor):
+        if service_date in partitions:
+            cursor.execute('ALTER TABLE %s NO INHERIT %s' % (name, STOP_TIMES_TABLE))
+    # rows loaded before partitioning, or by the ORM loader, are kept in the parent itself
+    cursor.execute('DELETE FROM ONLY %s WHERE service_date IN %%s' % STOP_TIMES_TABLE,
+                   [tuple(partitions)])
+    for table in partitions.itervalues():
+        cursor.execute('ALTER TABLE %s INHERIT %s' % (table, STOP_TIMES_TABLE))
+
+
+def expire_partitions(cursor, retention_days):
+    """Detaches the partitions of days outside the retention window
+
+    The window is the retention_days days up to the latest service date that's
+    loaded. Detached partitions are left for drop_retired_partitions.
+    Returns the first day of the window, or None if there are no stop times
+    """
+    cursor.execute('SELECT max(service_date) FROM %s' % STOP_TIMES_TABLE)
+    latest, = cursor.fetchone()
+    if latest is None:
+        return None
+    first_date = latest - datetime.timedelta(days=retention_days - 1)
+    for name, service_date in get_partitions(cursor):
+        if service_date < first_date:
+            cursor.execute('ALTER TABLE %s NO INHERIT %s' % (name, STOP_TIMES_TABLE))
+    cursor.execute('DELETE FROM ONLY %s WHERE service_date < %%s' % STOP_TIMES_TABLE,
+                   [first_date])
+    return first_date
+
+
+def drop_retired_partitions(cursor):
+    """Drops the partitions detached from gtfs_stop_times_real
+
+    Partitions that are still being loaded are invisible here until their
+    import commits, by which time they're attached.
+    """
+    cursor.execute("""SELECT c.relname FROM pg_class c
+                      WHERE c.relkind = 'r' AND c.relname ~ %s
+                      AND NOT EXISTS (SELECT 1 FROM pg_inherits WHERE inhrelid = c.oid)
+                      ORDER BY c.relname""", [PARTITION_PATTERN])
+    for name, in cursor.fetchall():
+        cursor.execute('DROP TABLE IF EXISTS %s' % name)
@@ -1,11 +1,15 @@
+import json
 import operator
 import os
 
+from django.conf import settings
+from django.db.models import Sum
 from rest_framework import serializers
 
 from models import (GTFSFeed, GTFSFeedProblem, DataSourceProblem, Boundary,
                     BoundaryProblem, DemographicDataSource, DemographicDataSourceProblem,
-                    DemographicDataFieldName, OSMData, OSMDataProblem, RealTime, RealTimeProblem)
+                    DemographicDataFieldName, DemographicDataGridCell, DemographicDataSummary,
+                    OSMData, OSMDataProblem, RealTime, RealTimeProblem)
 
 
 # TODO: Refactor as an actual custom field if we start adding lots of custom
@@ -26,13 +30,13 @@ class DataSourceProblemCountsMixin(object):
         except AttributeError:
             raise AttributeError('Serializer\'s Meta class is missing a problem_model field.')
         problem_set_getter = operator.attrgetter(class_lower + '_set')
-        errors = (problem_set_getter(obj)
-                  .filter(type=DataSourceProblem.ProblemTypes.ERROR)
-                  .count())
-        warnings = (problem_set_getter(obj)
-                    .filter(type=DataSourceProblem.ProblemTypes.WARNING)
-                    .count())
-        return dict(errors=errors, warnings=warnings)
+        # each problem row stands for all the occurrences of that problem
+        counts = dict(problem_set_getter(obj)
+                      .order_by()
+                      .values_list('type')
+                      .annotate(Sum('occurrences')))
+        return dict(errors=counts.get(DataSourceProblem.ProblemTypes.ERROR, 0),
+                    warnings=counts.get(DataSourceProblem.ProblemTypes.WARNING, 0))
 
 
 class ValidateZipMixin(object):
@@ -52,12 +56,14 @@ class ValidateZipMixin(object):
 
 
 class ValidateTxtNewMixin(object):
-    """Provides functionality to validate that a file has the .txt extension."""
+    """Provides functionality to validate that a file has the .txt_new extension.
+
+    The file may also be gzipped (.txt_new.gz), or be a .zip holding several such files.
+    """
     def _validate_txtnew_extension(self, filename):
-        """ Checks that filename ends in txt_new """
-        name, extension = os.path.splitext(filename)
-        if extension != '.txt_new':
-            msg = "Uploaded filename must end in .txt_new"
+        """ Checks that filename ends in txt_new, txt_new.gz or zip """
+        if not filename.endswith(('.txt_new', '.txt_new.gz', '.zip')):
+            msg = "Uploaded filename must end in .txt_new, .txt_new.gz or .zip"
             raise serializers.ValidationError(msg)
 
     def validate_txtnew_file(self, attrs, source):
@@ -77,6 +83,7 @@ class GTFSFeedSerializer(serializers.ModelSerializer, DataSourceProblemCountsMix
     class Meta:
         model = GTFSFeed
         problem_model = GTFSFeedProblem
+        read_only_fields = ('source_sha1',)
         ordering = ('-id',)
 
 
@@ -98,6 +105,16 @@ class OSMDataSerializer(serializers.ModelSerializer, DataSourceProblemCountsMixi
                         ValidateZipMixin):
     problems = serializers.SerializerMethodField('get_datasource_problem_counts')
 
+    def validate(self, attrs):
+        """ Make sure imports from a local .osm.pbf file have a file to read """
+        if attrs.get('source') == OSMData.Sources.PBF:
+            pbf_path = attrs.get('pbf_path') or settings.OSM_PBF_PATH
+            if not pbf_path.endswith('.osm.pbf'):
+                raise serializers.ValidationError("A local file ending in .osm.pbf is required.")
+            if not os.path.isfile(pbf_path):
+                raise serializers.ValidationError("%s does not exist." % pbf_path)
+        return attrs
+
     class Meta:
         model = OSMData
         problem_model = OSMDataProblem
@@ -131,7 +148,7 @@ class DemographicDataSourceSerializer(serializers.ModelSerializer, DataSourcePro
     class Meta:
         model = DemographicDataSource
         problem_model = DemographicDataSourceProblem
-        read_only_fields = ('status', 'num_features',)
+        read_only_fields = ('status', 'num_features', 'shapefile_name', 'srs', 'extent',)
         ordering = ('-id',)
 
     def get_shapefile_fields(self, obj):
@@ -139,3 +156,27 @@ class DemographicDataSourceSerializer(serializers.ModelSerializer, DataSourcePro
         field_names = (DemographicDataFieldName.objects.filter(datasource=obj)
                        .values_list('name', flat=True))
         return field_names
+
+
+class DemographicDataGridCellSerializer(serializers.ModelSerializer):
+    """Serializes the metric sums of a cell of a demographic grid"""
+
+    class Meta:
+        model = DemographicDataGridCell
+
+
+class DemographicDataSummarySerializer(serializers.ModelSerializer):
+    """Serializes the summary statistics of a demographic metric, decoding the JSON lists"""
+    quantiles = serializers.SerializerMethodField('get_quantiles')
+    histogram = serializers.SerializerMethodField('get_histogram')
+
+    class Meta:
+        model = DemographicDataSummary
+
+    def get_quantiles(self, obj):
+        """Get the upper bounds of the metric's quantiles"""
+        return json.loads(obj.quantiles) if obj.quantiles else []
+
+    def get_histogram(self, obj):
+        """Get the number of features in each bin of the metric's histogram"""
+        return json.loads(obj.histogram) if obj.histogram else []
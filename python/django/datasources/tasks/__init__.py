@@ -1,12 +1,19 @@
 """Thin wrappers for celery tasks so that autodiscovery works without having a giant file."""
 from datasources.tasks.shapefile import (run_shapefile_to_boundary, run_get_shapefile_fields,
                                          run_load_shapefile_data)
-from datasources.tasks.osm import run_osm_import
-from datasources.tasks.gtfs import run_validate_gtfs
-from datasources.tasks.realtime import run_realtime_import
+from datasources.tasks.osm import run_boundary_road_lengths, run_osm_import
+from datasources.tasks.gtfs import run_prevalidate_gtfs, run_validate_gtfs
+from datasources.tasks.realtime import run_drop_retired_stop_times, run_realtime_import
 from transit_indicators.celery_settings import app
 
 
+@app.task
+def prevalidate_gtfs(gtfsfeed_id):
+    # the full validation is only queued once the feed's structure checks out
+    if run_prevalidate_gtfs(gtfsfeed_id):
+        validate_gtfs.apply_async(args=[gtfsfeed_id], queue='datasources')
+
+
 @app.task
 def validate_gtfs(gtfsfeed_id):
     run_validate_gtfs(gtfsfeed_id)
@@ -15,6 +22,8 @@ def validate_gtfs(gtfsfeed_id):
 @app.task
 def shapefile_to_boundary(boundary_id):
     run_shapefile_to_boundary(boundary_id)
+    # the lines/roads indicator reads the length of the roads within each boundary
+    run_boundary_road_lengths(boundary_id)
 
 
 @app.task
@@ -35,3 +44,10 @@ def import_osm_data(osmdata_id):
 @app.task
 def import_real_time_data(realtime_id):
     run_realtime_import(realtime_id)
+    # the stop times it replaced are dropped separately, so the import doesn't wait on it
+    drop_retired_stop_times.apply_async(queue='datasources')
+
+
+@app.task
+def drop_retired_stop_times():
+    run_drop_retired_stop_times()
@@ -1,39 +1,86 @@
-import itertools
+from collections import OrderedDict
+import json
 import os
 import os.path
 import re
 import requests
+import shutil
 from simplejson import JSONDecodeError
 import zipfile
+import zlib
 
 from celery.utils.log import get_task_logger
 from django.conf import settings
+from django.db import connection, transaction
 from django.utils.translation import ugettext_lazy as _
 from transitfeed import GetGtfsFactory, ProblemReporter, ProblemAccumulatorInterface
 from transit_indicators.models import IndicatorJob
 from urllib import urlencode
 
-from datasources.models import Boundary, GTFSFeed, GTFSFeedProblem, OSMData, DemographicDataSource
+from datasources.gtfs_import import IncrementalImport, IncrementalImportError, fingerprint_members
+from datasources.gtfs_validator import (SampledFeedValidator, StreamingFeedValidator,
+                                        has_column_value)
+from datasources.models import (Boundary, GTFSFeed, GTFSFeedCache, GTFSFeedCacheProblem,
+                                GTFSFeedProblem, OSMData, DemographicDataSource)
 from userdata.models import OTIUser
 
 # set up shared task logger
 logger = get_task_logger(__name__)
 
+# Size of the chunks zip members are extracted in, so memory use doesn't grow with the feed
+EXTRACT_BUFFER_SIZE = 1024 * 1024
+
 
 class OTIProblemAccumulator(ProblemAccumulatorInterface):
     """Tracks problems of GTFS files
 
     Differs from existing accumulators primarily by not
-    printing to file and instead saving problems in a local
-    list that is used later to save individual problems in
-    the database.
+    printing to file and instead aggregating problems in memory,
+    so they can be saved in the database later. Identical problems
+    (same title, type and description) are kept once, along with
+    the number of times they occurred and a few sample rows.
     """
 
-    def __init__(self):
-        self.problems = []
+    def __init__(self, max_sample_rows=None):
+        if max_sample_rows is None:
+            max_sample_rows = settings.GTFS_PROBLEM_SAMPLE_ROWS
+        self.max_sample_rows = max_sample_rows
+        # (title, type, description) -> [first problem, occurrences, sample rows]
+        self.problems = OrderedDict()
 
     def _Report(self, e):
-        self.problems.append(e)
+        type = (GTFSFeedProblem.ProblemTypes.WARNING
+                if e.IsWarning()
+                else GTFSFeedProblem.ProblemTypes.ERROR)
+        key = (get_problem_title(e), type, e.FormatProblem())
+        aggregate = self.problems.get(key)
+        if aggregate is None:
+            aggregate = self.problems[key] = [e, 0, []]
+        aggregate[1] += 1
+        if len(aggregate[2]) < self.max_sample_rows:
+            sample = get_problem_sample_row(e)
+            if sample:
+                aggregate[2].append(sample)
+
+    def count(self, type):
+        """Returns the total number of occurrences of problems of the given type"""
+        return sum(occurrences for (title, problem_type, description), (e, occurrences, samples)
+                   in self.problems.iteritems() if problem_type == type)
+
+    def get_gtfsfeed_problems(self, gtfsfeed, **kwargs):
+        """Returns unsaved GTFSFeedProblems for the aggregated problems
+
+        Any keyword arguments are passed on as additional field values.
+        """
+        return [GTFSFeedProblem(gtfsfeed=gtfsfeed,
+                                title=title,
+                                type=type,
+                                description=description,
+                                occurrences=occurrences,
+                                sample_rows='\n'.join(samples),
+                                **kwargs)
+                for (title, type, description), (e, occurrences, samples)
+                in self.problems.iteritems()]
 
 
 def get_problem_title(problem):
@@ -42,94 +89,140 @@ def get_problem_title(problem):
                   problem.__class__.__name__)
 
 
+def get_problem_sample_row(problem):
+    """Helper function to describe where a problem occurred, including the row's values"""
+    context = problem.FormatContext()
+    row = getattr(problem, 'row', None)
+    if row:
+        context = '%s: %s' % (context, ','.join(row))
+    return context
+
+
+def run_prevalidate_gtfs(gtfsfeed_id):
+    """Function to quickly check the structure of an uploaded GTFSFeed file
+
+    Reads the zip's central directory, the table headers and a sample of
+    rows from each table, and saves the problems found as provisional
+    GTFSFeedProblems, so they show up within seconds of the upload. The
+    full validation replaces them once it has run. Errors found here are
+    final: the feed is marked as failed and isn't validated any further.
+
+    Arguments:
+    :param gtfsfeed_id: ID of GTFSFeed object
+    :returns: Whether the full validation should be run
+    """
+
+    gtfsfeed = GTFSFeed.objects.get(id=gtfsfeed_id)
+
+    gtfsfeed.status = GTFSFeed.Statuses.VALIDATING
+    gtfsfeed.save()
+
+    if (gtfsfeed.source_sha1 and
+            GTFSFeedCache.objects.filter(sha1=gtfsfeed.source_sha1).exists()):
+        # The full results for identical contents are already at hand
+        return True
+
+    accumulator = OTIProblemAccumulator()
+    problems = ProblemReporter(accumulator=accumulator)
+    logger.debug('Pre-validating %s gtfs file', gtfsfeed.source_file)
+    validator = SampledFeedValidator(gtfsfeed.source_file.path, problems,
+                                     sample_rows=settings.GTFS_PREVALIDATION_SAMPLE_ROWS)
+    validator.validate()
+
+    has_errors = accumulator.count(GTFSFeedProblem.ProblemTypes.ERROR) > 0
+    GTFSFeedProblem.objects.bulk_create(
+        accumulator.get_gtfsfeed_problems(gtfsfeed, is_provisional=not has_errors),
+        batch_size=1000)
+    logger.debug('Pre-validation found %s distinct problems in %s gtfs file',
+                 len(accumulator.problems), gtfsfeed.source_file)
+
+    if has_errors:
+        gtfsfeed.status = GTFSFeed.Statuses.ERROR
+        gtfsfeed.save()
+        return False
+    return True
+
+
 def run_validate_gtfs(gtfsfeed_id):
     """Function to validate uploaded GTSFeed files
 
     Creates GTSFeedProblem objects for each error/warning
     and updates GTFSFeed processing status once completed.
 
+    If a file with identical contents was validated before, its problems
+    are reused instead, and if that file's data is still loaded the import
+    is skipped as well.
+
     Arguments:
     :param gtfsfeed_id: ID of GTFSFeed object
     """
 
     gtfsfeed = GTFSFeed.objects.get(id=gtfsfeed_id)
-    accumulator = OTIProblemAccumulator()
-    problems = ProblemReporter(accumulator=accumulator)
-    gtfs_factory = GetGtfsFactory()
 
     gtfsfeed.status = GTFSFeed.Statuses.VALIDATING
     gtfsfeed.save()
 
-    # load gtfs file(s)
-    loader = gtfs_factory.Loader(
-        gtfsfeed.source_file,
-        problems=problems,
-        extra_validation=False,
-        memory_db=False,
-        check_duplicate_trips=True,
-        gtfs_factory=gtfs_factory)
-
-    # loads GTFS file and performs validation
-    logger.debug('Loading %s gtfs file for validation', gtfsfeed.source_file)
-    schedule = loader.Load()
-    logger.debug('Finished loading gtfs file')
-
-    # save individual problems in database
-    errors_count = 0
-    warnings_count = 0
-    for problem in accumulator.problems:
-        type = (GTFSFeedProblem.ProblemTypes.WARNING
-                if problem.IsWarning()
-                else GTFSFeedProblem.ProblemTypes.ERROR)
-        description = problem.FormatProblem()
-        title = get_problem_title(problem)
-        obj, created = GTFSFeedProblem.objects.get_or_create(
-            gtfsfeed=gtfsfeed,
-            description=description,
-            title=title,
-            type=type)
-        if created:
-            if type == GTFSFeedProblem.ProblemTypes.ERROR:
-                errors_count += 1
-            elif type == GTFSFeedProblem.ProblemTypes.WARNING:
-                warnings_count += 1
-
-    logger.debug('Found %s problems in %s gtfs file',
-                 errors_count + warnings_count,
-                 gtfsfeed.source_file)
-
-    # This adds a warning message to the import process if
-    # both a shapes.txt and no shapes_dist_traveled are available
-    # since length for routes and modes will not be available.
-    # Note: In developing this, no gtfs files with a shape_dist_traveled,
-    # but no shapes.txt file were able to be found.
-    if len(schedule.GetShapeList()) == 0:
-        # Check if shapes.txt of shape_dist_traveled exist
-        stopdatetimes = itertools.chain(*[trip.GetStopTimes() for trip in schedule.trips.values()])
-        if not any([stopdatetime.shape_dist_traveled for stopdatetime in stopdatetimes]):
-            length_description = _('Unable to calculate route and system length without a shapes.txt' +
-                                  ' or shapes_dist_traveled field in stop_times.txt')
-            unused = GTFSFeedProblem.objects.create(gtfsfeed=gtfsfeed,
-                                                    description=length_description,
-                                                    title=_('Unable to calculate length'),
-                                                    type=GTFSFeedProblem.ProblemTypes.WARNING)
-
-    if errors_count == 0:
-        gtfsfeed.status = GTFSFeed.Statuses.PROCESSING
-        gtfsfeed.save()
+    cache = None
+    if gtfsfeed.source_sha1:
+        cache = GTFSFeedCache.objects.filter(sha1=gtfsfeed.source_sha1).first()
+
+    if cache is not None:
+        logger.debug('Reusing validation results of identical gtfs file %s', cache.sha1)
+        with transaction.atomic():
+            gtfsfeed.gtfsfeedproblem_set.filter(is_provisional=True).delete()
+            copy_problems(cache.gtfsfeedcacheproblem_set.all(), GTFSFeedProblem,
+                          gtfsfeed=gtfsfeed)
+        has_errors = cache.has_errors
     else:
+        has_errors = validate_gtfsfeed(gtfsfeed) > 0
+        if gtfsfeed.source_sha1:
+            cache, created = GTFSFeedCache.objects.get_or_create(
+                sha1=gtfsfeed.source_sha1,
+                defaults={'has_errors': has_errors})
+            if created:
+                copy_problems(gtfsfeed.gtfsfeedproblem_set.all(), GTFSFeedCacheProblem,
+                              cache=cache)
+
+    if has_errors:
         # Bail out if errors, no need to continue processing
         gtfsfeed.status = GTFSFeed.Statuses.ERROR
         gtfsfeed.save()
         return
-
+    gtfsfeed.status = GTFSFeed.Statuses.PROCESSING
+    gtfsfeed.save()
 
     # delete any uploaded shapefiles that aren't for this GTFS' city
     delete_other_city_uploads(gtfsfeed.city_name)
 
+    if cache is not None and cache.is_loaded:
+        logger.debug('gtfs file %s is already loaded, skipping import', cache.sha1)
+        gtfsfeed.status = GTFSFeed.Statuses.COMPLETE
+        gtfsfeed.save()
+        gtfsfeed.delete_replaced()
+        return
+
+    if settings.GTFS_IMPORT_MODE == 'incremental' and run_incremental_import(gtfsfeed):
+        gtfsfeed.status = GTFSFeed.Statuses.COMPLETE
+        gtfsfeed.save()
+        if gtfsfeed.source_sha1:
+            GTFSFeedCache.mark_loaded(gtfsfeed.source_sha1)
+        gtfsfeed.delete_replaced()
+        return
+
+    if cache is not None and cache.unzipped_dir and os.path.isdir(cache.unzipped_dir):
+        zip_dir = cache.unzipped_dir
+    else:
+        zip_dir = extract_gtfs(gtfsfeed.source_file)
+        if cache is not None:
+            cache.unzipped_dir = zip_dir
+            cache.save()
+
+    # the data of a feed being replaced stays loaded until GeoTrellis replaces it (it
+    # clears the tables it loads), and the old feed is only deleted once GeoTrellis
+    # reports this one complete, so a failed import leaves the old feed in place
     # send to GeoTrellis
     logger.debug('going to send gtfs to geotrellis')
-    response = send_to_geotrellis(gtfsfeed.source_file, gtfsfeed_id)
+    response = send_to_geotrellis(zip_dir, gtfsfeed_id)
     success = response.get('success', False)
 
     # Update processing status
@@ -145,6 +238,170 @@ def run_validate_gtfs(gtfsfeed_id):
     gtfsfeed.save()
 
 
+def validate_gtfsfeed(gtfsfeed):
+    """Validates the file of a GTFSFeed and saves the problems found
+
+    Arguments:
+    :param gtfsfeed: GTFSFeed object to validate
+    :returns: The number of errors found
+    """
+    accumulator = OTIProblemAccumulator()
+    problems = ProblemReporter(accumulator=accumulator)
+
+    # loads GTFS file and performs validation
+    logger.debug('Validating %s gtfs file with the %s validator',
+                 gtfsfeed.source_file, settings.GTFS_VALIDATOR)
+    if settings.GTFS_VALIDATOR == 'transitfeed':
+        has_length_data = validate_with_transitfeed(gtfsfeed.source_file, problems)
+    else:
+        has_length_data = validate_streaming(gtfsfeed.source_file, problems)
+    logger.debug('Finished validating gtfs file')
+
+    # save the aggregated problems in database
+    errors_count = accumulator.count(GTFSFeedProblem.ProblemTypes.ERROR)
+    warnings_count = accumulator.count(GTFSFeedProblem.ProblemTypes.WARNING)
+    with transaction.atomic():
+        # the full results replace those of the pre-validation
+        gtfsfeed.gtfsfeedproblem_set.filter(is_provisional=True).delete()
+        GTFSFeedProblem.objects.bulk_create(accumulator.get_gtfsfeed_problems(gtfsfeed),
+                                            batch_size=1000)
+
+    logger.debug('Found %s problems (%s distinct) in %s gtfs file',
+                 errors_count + warnings_count,
+                 len(accumulator.problems),
+                 gtfsfeed.source_file)
+
+    # This adds a warning message to the import process if
+    # both a shapes.txt and no shapes_dist_traveled are available
+    # since length for routes and modes will not be available.
+    # Note: In developing this, no gtfs files with a shape_dist_traveled,
+    # but no shapes.txt file were able to be found.
+    if not has_length_data:
+        length_description = _('Unable to calculate route and system length without a shapes.txt' +
+                              ' or shapes_dist_traveled field in stop_times.txt')
+        unused = GTFSFeedProblem.objects.create(gtfsfeed=gtfsfeed,
+                                                description=length_description,
+                                                title=_('Unable to calculate length'),
+                                                type=GTFSFeedProblem.ProblemTypes.WARNING)
+
+    return errors_count
+
+
+def get_member_fingerprints(gtfsfeed):
+    """Returns the fingerprints of the files in a GTFSFeed, computing them if needed"""
+    if not gtfsfeed.member_fingerprints:
+        gtfsfeed.member_fingerprints = json.dumps(fingerprint_members(gtfsfeed.source_file.path))
+        gtfsfeed.save()
+    return json.loads(gtfsfeed.member_fingerprints)
+
+
+def run_incremental_import(gtfsfeed):
+    """Applies the changes between the loaded GTFS feed and a new one to the gtfs tables
+
+    Only possible while the last completed feed is still loaded, and only for changes
+    that don't need the GeoTrellis import (see datasources.gtfs_import). Derived tables
+    made out of date by the changes are reported as a warning on the new feed.
+
+    Arguments:
+    :param gtfsfeed: GTFSFeed object to import
+    :returns: Whether the feed was imported; if not, it needs a full import
+    """
+    previous = (GTFSFeed.objects.filter(status=GTFSFeed.Statuses.COMPLETE)
+                .exclude(id=gtfsfeed.id)
+                .order_by('-id')
+                .first())
+    if (previous is None or not previous.source_sha1 or
+            not GTFSFeedCache.objects.filter(sha1=previous.source_sha1, is_loaded=True).exists() or
+            not os.path.isfile(previous.source_file.path)):
+        logger.debug('No loaded gtfs feed to import %s incrementally over', gtfsfeed.source_file)
+        return False
+
+    incremental_import = IncrementalImport(previous.source_file.path,
+                                           gtfsfeed.source_file.path,
+                                           get_member_fingerprints(previous),
+                                           get_member_fingerprints(gtfsfeed))
+    try:
+        with transaction.atomic():
+            with connection.cursor() as c:
+                incremental_import.apply(c)
+                invalidated = incremental_import.invalidated_tables()
+                if 'gtfs_stops_routes_join' in invalidated:
+                    c.execute('SELECT stops_routes();')
+    except IncrementalImportError as e:
+        logger.info('Falling back to a full import of %s: %s', gtfsfeed.source_file, e)
+        return False
+
+    logger.info('Incrementally imported %s; changed files: %s; rows (inserted, updated, '
+                'deleted): %s', gtfsfeed.source_file,
+                ', '.join(sorted(incremental_import.changed_files)),
+                incremental_import.row_counts)
+    if invalidated:
+        GTFSFeedProblem.objects.create(
+            gtfsfeed=gtfsfeed,
+            title=_('Derived data invalidated'),
+            description=_('The incremental import changed data that the following tables '
+                          'are derived from: %s') % ', '.join(sorted(invalidated)),
+            type=GTFSFeedProblem.ProblemTypes.WARNING)
+    return True
+
+
+def copy_problems(problems, problem_class, **kwargs):
+    """Saves copies of problems as instances of another problem class
+
+    Arguments:
+    :param problems: Iterable of DataSourceProblems to copy
+    :param problem_class: DataSourceProblem subclass to create
+    :param kwargs: Additional field values for the copies, e.g. their foreign key
+    """
+    problem_class.objects.bulk_create([
+        problem_class(type=problem.type,
+                      title=problem.title,
+                      description=problem.description,
+                      occurrences=problem.occurrences,
+                      sample_rows=problem.sample_rows,
+                      **kwargs)
+        for problem in problems], batch_size=1000)
+
+
+def validate_with_transitfeed(gtfs_file, problems):
+    """Validates a GTFS file by loading it completely with transitfeed's Loader
+
+    Arguments:
+    :param gtfs_file: GTFS zip file to validate
+    :param problems: transitfeed ProblemReporter to report problems to
+    :returns: Whether the feed has a shapes.txt or shape_dist_traveled values
+    """
+    gtfs_factory = GetGtfsFactory()
+    loader = gtfs_factory.Loader(
+        gtfs_file,
+        problems=problems,
+        extra_validation=False,
+        memory_db=False,
+        check_duplicate_trips=True,
+        gtfs_factory=gtfs_factory)
+    schedule = loader.Load()
+
+    if len(schedule.GetShapeList()) > 0:
+        return True
+    # Check if shape_dist_traveled exists by scanning the column rather than
+    # querying every trip's stop times out of the schedule
+    return has_column_value(gtfs_file.path, 'stop_times.txt', 'shape_dist_traveled')
+
+
+def validate_streaming(gtfs_file, problems):
+    """Validates a GTFS file by streaming each of its tables out of the zip
+
+    Arguments:
+    :param gtfs_file: GTFS zip file to validate
+    :param problems: transitfeed ProblemReporter to report problems to
+    :returns: Whether the feed has a shapes.txt or shape_dist_traveled values
+    """
+    validator = StreamingFeedValidator(gtfs_file.path, problems, check_duplicate_trips=True,
+                                       processes=settings.GTFS_VALIDATION_PROCESSES)
+    validator.validate()
+    return validator.has_shapes or validator.has_shape_dist_traveled
+
+
 def delete_other_city_uploads(cityname):
     """Helper function to delete uploaded shapefiles for cities other than the given city name.
 
@@ -157,7 +414,55 @@ def delete_other_city_uploads(cityname):
     OSMData.objects.exclude(city_name=cityname).delete()
     DemographicDataSource.objects.exclude(city_name=cityname).delete()
 
-def send_to_geotrellis(gtfs_file, gtfsfeed_id):
+def extract_gtfs(gtfs_file):
+    """Extracts a GTFS zip file next to it, for GeoTrellis to import
+
+    Arguments:
+    :param gtfs_file: GTFS zip file to extract
+    :returns: The directory the files were extracted to
+    """
+    zip_dir = '%s_unzipped' % gtfs_file.path
+    if not os.path.exists(zip_dir):
+        os.makedirs(zip_dir)
+
+    with zipfile.ZipFile(gtfs_file.path) as zip_file:
+        for info in zip_file.infolist():
+            if '/' in info.filename: # the __MACOSX directory breaks the import
+                continue             # but there shouldn't be any directories anyway.
+            path = os.path.join(zip_dir, info.filename)
+            if (os.path.isfile(path) and os.path.getsize(path) == info.file_size and
+                    file_crc32(path) == info.CRC):
+                logger.debug('%s is already extracted', path)
+                continue
+            extract_member(zip_file, info, path)
+    return zip_dir
+
+
+def extract_member(zip_file, info, path):
+    """Streams one member of a zip file to disk in fixed-size chunks
+
+    The member is written to a temporary file that is synced and then renamed
+    to path, so path never holds a partially extracted file.
+    """
+    temp_path = '%s.partial' % path
+    with zip_file.open(info) as member:
+        with open(temp_path, 'wb') as outfile:
+            shutil.copyfileobj(member, outfile, EXTRACT_BUFFER_SIZE)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+    os.rename(temp_path, path)
+
+
+def file_crc32(path):
+    """Computes the CRC-32 of a file the way zip files store it"""
+    crc = 0
+    with open(path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(EXTRACT_BUFFER_SIZE), ''):
+            crc = zlib.crc32(chunk, crc)
+    return crc & 0xffffffff
+
+
+def send_to_geotrellis(zip_dir, gtfsfeed_id):
     """Sends GTFS data to GeoTrellis for storage
 
     Note: this makes use of the current assumption that GeoTrellis is running
@@ -167,20 +472,10 @@ def send_to_geotrellis(gtfs_file, gtfsfeed_id):
     such as s3, and add URI-fetching to the GeoTrellis portion.
 
     Arguments:
+    :param zip_dir: Directory holding the extracted GTFS files
+    :param gtfsfeed_id: ID of the GTFSFeed being imported
     :returns: Whether or not the file was processed successfully
     """
-    zip_dir = '%s_unzipped' % gtfs_file.path
-    if not os.path.exists(zip_dir):
-        os.makedirs(zip_dir)
-
-    zip_file = zipfile.ZipFile(gtfs_file)
-    for name in zip_file.namelist():
-        if '/' in name: # the __MACOSX directory breaks the import
-            continue    # but there shouldn't be any directories anyway.
-        outfile = open(os.path.join(zip_dir, name), 'wb')
-        outfile.write(zip_file.read(name))
-        outfile.close()
-
     gtfs_response = {
         'success': False,
         'message': '',
@@ -1,5 +1,15 @@
-"""Handles downloading and importing OSM Data"""
+"""Handles downloading or extracting, and importing OSM Data
 
+Each import records the area its data covers, a fingerprint of where its data
+came from and checksums of the planet_osm_* tables it left. A later import from
+the same source can then skip osm2pgsql altogether if the tables are unchanged
+and already cover its bounding box, or import just the area they don't cover,
+adding it to the recorded one.
+The tables and the record are kept when the GTFS feed is deleted, so this holds
+for the import following the upload of a new version of the feed.
+"""
+
+import json
 import os
 import subprocess
 import tempfile
@@ -8,9 +18,10 @@ import requests
 from celery.utils.log import get_task_logger
 
 from django.conf import settings
-from django.db import connection
+from django.contrib.gis.geos import MultiPolygon, Polygon
+from django.db import DatabaseError, connection, transaction
 
-from datasources.models import OSMData, OSMDataProblem
+from datasources.models import Boundary, OSMData, OSMDataProblem, OSMImportRecord
 from datasources.tasks.shapefile import ErrorFactory
 
 #  Note: The download is done using the overpass API
@@ -19,16 +30,207 @@ from datasources.tasks.shapefile import ErrorFactory
 #  for downloads/reads unlike the main openstreetmap API endpoint
 OSM_API_URL = 'http://www.overpass-api.de/api/xapi?way[bbox=%s,%s,%s,%s][highway=*]'
 
+#  Clips the highway ways (with the nodes they use) inside a bounding box out of a
+#  local .osm.pbf extract, writing them as .osm XML. The bounding box comes first, so
+#  the filters after it only go through the data of the area rather than the whole
+#  extract
+OSMOSIS_COMMAND = ['osmosis', '-q',
+                   '--read-pbf', 'file=%(pbf_path)s',
+                   '--bounding-box', 'left=%(left)s', 'bottom=%(bottom)s',
+                   'right=%(right)s', 'top=%(top)s', 'completeWays=yes',
+                   '--tag-filter', 'accept-ways', 'highway=*',
+                   '--tag-filter', 'reject-relations',
+                   '--used-node',
+                   '--write-xml', 'file=%(output)s']
+
+# Tables filled by osm2pgsql, whose checksums tell whether a later import can reuse them
+OSM_TABLES = ('planet_osm_line', 'planet_osm_point', 'planet_osm_polygon', 'planet_osm_roads')
+
+# Prefix of the tables the data of an area not yet covered is imported into before
+# it's merged into the OSM_TABLES, and the suffixes of all the tables osm2pgsql
+# creates with it in slim mode
+DELTA_PREFIX = 'planet_osm_delta'
+DELTA_SUFFIXES = ('line', 'point', 'polygon', 'roads', 'nodes', 'ways', 'rels')
+
 # set up shared task logger
 logger = get_task_logger(__name__)
 
 
+def download_osm_data(bbox, filename):
+    """Downloads the highways in a bounding box from the overpass API into filename"""
+    response = requests.get(OSM_API_URL % bbox, stream=True)
+    response.raise_for_status()
+
+    logger.debug('Downloading OSM data from overpass/OSM api')
+    with open(filename, 'wb') as fh:
+        for chunk in response.iter_content(chunk_size=1024):
+            if chunk:
+                fh.write(chunk)
+                fh.flush()
+    logger.debug('Finished downloading OSM data')
+
+
+def extract_osm_data(pbf_path, bbox, filename):
+    """Clips the highways in a bounding box out of a local .osm.pbf file into filename
+
+    The extract is streamed through osmosis, so even a planet file is read
+    without loading it into memory.
+    """
+    left, bottom, right, top = bbox
+    osmosis_command = [arg % dict(pbf_path=pbf_path, output=filename,
+                                  left=left, bottom=bottom, right=right, top=top)
+                       for arg in OSMOSIS_COMMAND]
+    logger.debug('Extracting OSM data with %s', ' '.join(osmosis_command))
+    subprocess.check_call(osmosis_command)
+    logger.debug('Finished extracting OSM data')
+
+
+def pad_bbox(bbox, margin):
+    """Widens a bounding box in degrees by margin on each side"""
+    left, bottom, right, top = bbox
+    return (max(left - margin, -180), max(bottom - margin, -90),
+            min(right + margin, 180), min(top + margin, 90))
+
+
+def get_delta_bbox(covered, bbox):
+    """Returns the smallest bounding box holding the part of bbox outside covered
+
+    covered is the area (in degrees) already imported. Returns None if it holds
+    all of bbox.
+    """
+    outside = Polygon.from_bbox(bbox).difference(covered)
+    if outside.empty:
+        return None
+    return outside.extent
+
+
+def get_source_fingerprint(osm_data):
+    """Identifies where the data of an import comes from
+
+    A local .osm.pbf file is identified by its path, size and modification time,
+    which is enough to notice a new extract without reading the whole file.
+    """
+    if osm_data.source == OSMData.Sources.PBF:
+        pbf_path = os.path.abspath(osm_data.get_pbf_path())
+        pbf_stat = os.stat(pbf_path)
+        return 'pbf:%s:%d:%d' % (pbf_path, pbf_stat.st_size, pbf_stat.st_mtime)
+    return 'overpass:%s' % OSM_API_URL
+
+
+def get_table_checksums(cursor):
+    """Returns a dict of each of the OSM_TABLES to a checksum of its rows
+
+    The checksum is made of the number of rows and the lowest, highest and sum of
+    their OSM ids, or None if the table doesn't exist. Unlike a hash of every id,
+    that's computed without building a string of the whole table.
+    """
+    checksums = {}
+    for table in OSM_TABLES:
+        cursor.execute('SELECT 1 FROM information_schema.tables WHERE table_name = %s', [table])
+        if cursor.fetchone() is None:
+            checksums[table] = None
+            continue
+        cursor.execute("""SELECT count(*) || ':' || coalesce(min(osm_id) || ':' ||
+                                                      max(osm_id) || ':' || sum(osm_id), '')
+                          FROM %s""" % table)
+        checksums[table] = cursor.fetchone()[0]
+    return checksums
+
+
+def get_reusable_import(fingerprint, srid):
+    """Returns the OSMImportRecord of the data in the OSM_TABLES, if an import can build on it
+
+    That's the record of the last import to complete, if it came from the same
+    source and projection, and the tables still hold what it left in them (they
+    may have been dropped or re-imported by hand, for instance). Returns None otherwise.
+    """
+    previous = OSMImportRecord.objects.order_by('-import_date', '-id').first()
+    if (previous is None or previous.source_fingerprint != fingerprint or
+            previous.srid != srid):
+        return None
+    with connection.cursor() as c:
+        if get_table_checksums(c) != json.loads(previous.table_checksums):
+            return None
+    return previous
+
+
+def save_import_record(coverage, fingerprint, srid):
+    """Replaces the OSMImportRecord with one describing what's in the OSM_TABLES now
+
+    coverage is the area (in degrees) the tables hold the data of.
+    """
+    if isinstance(coverage, Polygon):
+        coverage = MultiPolygon(coverage)
+    coverage.srid = 4326
+    with transaction.atomic(), connection.cursor() as c:
+        checksums = json.dumps(get_table_checksums(c))
+        OSMImportRecord.objects.all().delete()
+        return OSMImportRecord.objects.create(coverage=coverage, source_fingerprint=fingerprint,
+                                              srid=srid, table_checksums=checksums)
+
+
+def merge_delta_tables():
+    """Adds the data imported into the DELTA_PREFIX tables to the OSM_TABLES
+
+    Objects already in a table, such as roads crossing into the delta area, are
+    left as they are. The delta tables are dropped afterwards.
+    """
+    with transaction.atomic(), connection.cursor() as c:
+        for table in OSM_TABLES:
+            delta_table = table.replace('planet_osm', DELTA_PREFIX, 1)
+            c.execute("""INSERT INTO %s SELECT * FROM %s delta
+                         WHERE NOT EXISTS (SELECT 1 FROM %s existing
+                                           WHERE existing.osm_id = delta.osm_id)"""
+                      % (table, delta_table, table))
+        for suffix in DELTA_SUFFIXES:
+            c.execute('DROP TABLE IF EXISTS %s_%s' % (DELTA_PREFIX, suffix))
+
+
+def build_road_lengths(boundary_id=None, margin=0):
+    """Precompute the length of the OSM roads by highway class
+
+    Rebuilds osm_road_lengths for the whole extent and every boundary, or, given
+    a boundary, just the lengths within it. The whole extent is the bounding box
+    of the GTFS stops, widened by margin degrees like the import's.
+    """
+    logger.debug('Measuring OSM roads')
+    with transaction.atomic(), connection.cursor() as c:
+        c.execute('SELECT BuildRoadLengths(%s, %s);', [boundary_id, margin])
+
+
+def run_road_lengths(error_factory, margin):
+    """Measure the OSM roads around the GTFS stops, warning if it fails"""
+    try:
+        build_road_lengths(margin=margin)
+    except DatabaseError as e:
+        # the lines/roads indicator measures the roads itself without the lengths
+        logger.exception('Error measuring OSM roads')
+        error_factory.warn('Unable to measure the imported roads', str(e))
+
+
+def run_boundary_road_lengths(boundary_id):
+    """Measure the OSM roads within a boundary, if it was imported"""
+    if not Boundary.objects.filter(pk=boundary_id, status=Boundary.Statuses.COMPLETE).exists():
+        return
+    try:
+        build_road_lengths(boundary_id)
+    except DatabaseError:
+        # the lines/roads indicator measures the roads itself without the lengths
+        logger.exception('Error measuring OSM roads within boundary %d', boundary_id)
+
+
 def run_osm_import(osmdata_id):
-    """Download and run import step for OSM data
+    """Download or extract, and run import step for OSM data
+
+    Stores raw OSM highway data within a bounding box defined by imported GTFS
+    data, either downloaded from the overpass API or, for the PBF source,
+    clipped out of a locally stored .osm.pbf file. Uses the SRID defined on the
+    gtfs_stops table to determine correct UTM projection to import data as.
 
-    Downloads and stores raw OSM data within a bounding box defined
-    by imported GTFS data. Uses the SRID defined on the gtfs_stops
-    table to determine correct UTM projection to import data as.
+    If the data of the last import came from the same source and still covers
+    the bounding box, the import is skipped; if it covers part of it, only the
+    rest is imported and merged in. The imported roads are then measured for
+    the lines/roads indicator.
 
     Uses Raw SQL to
       - get extent from GTFS data since we
@@ -67,6 +269,7 @@ def run_osm_import(osmdata_id):
         except Exception as e:
             err_msg = 'Error obtaining bounding box from gtfs_stops table'
             handle_error(err_msg, e.message)
+            return
         try:
             logger.debug('Making query for UTM projection srid from gtfs_stops table (geom field)')
             utm_projection_query = "SELECT FIND_SRID('', 'gtfs_stops', 'geom');"
@@ -76,32 +279,60 @@ def run_osm_import(osmdata_id):
             err_msg = 'Error obtaining SRID from gtfs_stops table'
             logger.exception(err_msg)
             handle_error(err_msg, e.message)
+            return
+
+    try:
+        fingerprint = get_source_fingerprint(osm_data)
+    except OSError as e:
+        handle_error('Error reading %s' % osm_data.get_pbf_path(), str(e))
+        return
+    # a local extract is clipped with a margin around the stops, which later
+    # imports may reuse
+    if osm_data.source == OSMData.Sources.PBF:
+        margin = settings.OSM_PBF_MARGIN
+    else:
+        margin = 0
+    import_bbox = pad_bbox(bbox, margin)
 
+    delta_bbox = None
+    previous = get_reusable_import(fingerprint, utm_projection)
+    if previous is not None:
+        delta_bbox = get_delta_bbox(previous.coverage, bbox)
+        if delta_bbox is None:
+            logger.debug('OSM data imported on %s already covers %s; skipping import',
+                         previous.import_date, bbox)
+            osm_data.status = OSMData.Statuses.COMPLETE
+            osm_data.save()
+            # the stops may have moved within the covered extent
+            run_road_lengths(error_factory, margin)
+            return
+        delta_bbox = pad_bbox(delta_bbox, margin)
+        logger.debug('Importing only %s, outside the OSM data imported on %s',
+                     delta_bbox, previous.import_date)
 
-    _, temp_filename = tempfile.mkstemp()
+    _, temp_filename = tempfile.mkstemp(suffix='.osm')
     logger.debug('Generated tempfile %s to download osm data into', temp_filename)
     osm_data.source_file = temp_filename
     osm_data.status = OSMData.Statuses.DOWNLOADING
     osm_data.save()
 
     try:
-        response = requests.get(OSM_API_URL % bbox, stream=True)
-
-        logger.debug('Downloading OSM data from overpass/OSM api')
-        # Download OSM data
-        with open(temp_filename, 'wb') as fh:
-            for chunk in response.iter_content(chunk_size=1024):
-                if chunk:
-                    fh.write(chunk)
-                    fh.flush()
-        logger.debug('Finished downloading OSM data')
+        if osm_data.source == OSMData.Sources.PBF:
+            extract_osm_data(osm_data.get_pbf_path(), delta_bbox or import_bbox, temp_filename)
+        else:
+            download_osm_data(delta_bbox or import_bbox, temp_filename)
 
         osm_data.status = OSMData.Statuses.IMPORTING
         osm_data.save()
     except Exception as e:
-        err_msg = 'Error downloading data'
-        logger.exception('Error downloading data')
-        handle_error(err_msg, e.message)
+        if osm_data.source == OSMData.Sources.PBF:
+            err_msg = 'Error extracting data from %s' % osm_data.get_pbf_path()
+        else:
+            err_msg = 'Error downloading data'
+        logger.exception(err_msg)
+        handle_error(err_msg, str(e))
+        os.remove(temp_filename)
+        return
 
     # Get Database settings
     db_host = settings.DATABASES['default']['HOST']
@@ -119,15 +350,32 @@ def run_osm_import(osmdata_id):
                          '-s', # use slim mode to cache to DB rather than in-memory
                          '-E', str(utm_projection),
                          temp_filename]
+    if delta_bbox:
+        # imported beside the existing tables, to be merged into them
+        osm2pgsql_command[-1:-1] = ['--prefix', DELTA_PREFIX]
     try:
         logger.debug('Running OSM import command %s', ' '.join(osm2pgsql_command))
         subprocess.check_call(osm2pgsql_command, env=env)
+        coverage = Polygon.from_bbox(delta_bbox or import_bbox)
+        if delta_bbox:
+            merge_delta_tables()
+            # the tables hold the data of both imports
+            coverage = coverage.union(previous.coverage)
+        save_import_record(coverage, fingerprint, utm_projection)
         osm_data.status = OSMData.Statuses.COMPLETE
     except subprocess.CalledProcessError as e:
         osm_data.status = OSMData.Statuses.ERROR
         err_msg = 'Error running osm2pgsql command'
         logger.exception('Error running osm2pgsql command')
         error_factory.error(err_msg, e.message)
+    except DatabaseError as e:
+        osm_data.status = OSMData.Statuses.ERROR
+        err_msg = 'Error merging imported OSM data'
+        logger.exception(err_msg)
+        error_factory.error(err_msg, str(e))
     finally:
         osm_data.save()
         os.remove(temp_filename)
+
+    if osm_data.status == OSMData.Statuses.COMPLETE:
+        run_road_lengths(error_factory, margin)
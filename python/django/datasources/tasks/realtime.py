@@ -1,5 +1,4 @@
 """Handles sending realtime data to geotrellis for processing"""
-import csv
 import os
 import subprocess
 import tempfile
@@ -11,6 +10,11 @@ from django.conf import settings
 from django.db import connection, transaction
 
 from datasources.models import RealTime, RealTimeProblem
+from datasources.realtime_loader import (InvalidRow, RejectedRows, attach_partitions, clean_time,
+                                          copy_stop_times, drop_retired_partitions,
+                                          expire_partitions, get_service_date,
+                                          insert_isolating_failures, open_stop_times_files,
+                                          read_stop_times)
 from datasources.tasks.shapefile import ErrorFactory
 from gtfs_realtime.models import RealStopTime
 
@@ -38,15 +42,119 @@ def run_realtime_import(realtime_id):
     if result['imported'] == 0:
         msg = '0 of %i rows', result['total']
         handle_error('No Rows Imported', msg)
-    else:
-        real_time.status = RealTime.Statuses.COMPLETE
-        real_time.save()
+        return
+
+    try:
+        build_stop_time_deviations(min(result['service_dates']), max(result['service_dates']))
+    except Exception as e:
+        # the observed stop times are still usable without the deviations
+        logger.exception('Error computing stop time deviations')
+        error_factory.warn('Unable to compare stop times with the schedule', str(e))
+
+    real_time.status = RealTime.Statuses.COMPLETE
+    real_time.save()
+
+
+def build_stop_time_deviations(first_date, last_date):
+    """ Precompute how the observed stop times of some days deviate from the schedule
+
+    Replaces the rows of gtfs_stop_time_deviations for the service dates from
+    first_date to last_date with the arrival and departure delays, dwell times
+    and headways of each observed stop time matching a scheduled one, and drops
+    the rows of days no longer kept.
+    """
+    logger.debug('Computing stop time deviations from %s to %s', first_date, last_date)
+    with transaction.atomic(), connection.cursor() as c:
+        c.execute('SELECT BuildStopTimeDeviations(%s, %s);', [first_date, last_date])
+
 
 def load_stop_times(real_time, error_factory):
     """ Load stop times into RealStopTime model
 
-    The file to import should match the GTFS spec for stop_times.txt
+    The file to import should match the GTFS spec for stop_times.txt; it may be
+    gzipped, or be a zip holding several such files
+
+    The file is streamed with COPY into a new partition of gtfs_stop_times_real
+    per service date, each attached in one step once loaded. They replace the
+    stop times of the same days, and days outside the retention window of
+    settings.REALTIME_RETENTION_DAYS are detached; the detached partitions are
+    left for run_drop_retired_stop_times. If settings.REALTIME_LOADER is 'orm',
+    RealStopTime objects are created in batches instead, and the stop times of
+    other imports for the same days are deleted afterwards, before the same
+    retention window is applied. Rows that can't be imported are reported
+    together in a single warning.
+    """
+
+    rejected_rows = RejectedRows()
+    service_dates = set()
+
+    def reject_row(line, message):
+        logger.debug('Row %d error: %s', line, message)
+        rejected_rows.add(line, message)
+
+    def note_service_dates(rows):
+        for line, row in rows:
+            service_dates.add(row['service_date'])
+            yield line, row
+
+    imported = 0
+    total = 0
+    try:
+        path = real_time.source_file.path
+        service_date = (real_time.service_date or get_service_date(path) or
+                        real_time.create_date.date())
+        rows = note_service_dates(read_stop_times(open_stop_times_files(path), service_date))
+        if settings.REALTIME_LOADER == 'orm':
+            imported, total = insert_stop_times(rows, real_time, reject_row)
+            if imported > 0:
+                # Delete the stop times of other imports for the days imported
+                logger.debug('Cleaning old stop time entries...')
+                with transaction.atomic(), connection.cursor() as cursor:
+                    replaced_stop_times = (RealStopTime.objects
+                                           .filter(service_date__in=service_dates)
+                                           .exclude(datasource=real_time))
+                    replaced_stop_times.delete()
+                    expire_partitions(cursor, settings.REALTIME_RETENTION_DAYS)
+        else:
+            with transaction.atomic(), connection.cursor() as cursor:
+                imported, total, partitions = copy_stop_times(cursor, rows, real_time.id,
+                                                              reject_row)
+                if imported > 0:
+                    logger.debug('Attaching %i days of stop times...', len(partitions))
+                    attach_partitions(cursor, partitions)
+                    expire_partitions(cursor, settings.REALTIME_RETENTION_DAYS)
+                else:
+                    for table in partitions.itervalues():
+                        cursor.execute('DROP TABLE %s' % table)
+        logger.debug('Imported %i of %i stop times', imported, total)
+        rejected_rows.report(error_factory)
+    except Exception as e:
+        error_factory.error('Import failed', e.message)
+        imported = 0
+
+    return {
+        'imported': imported,
+        'total': total,
+        'service_dates': service_dates
+    }
+
+
+def run_drop_retired_stop_times():
+    """ Drop the stop times replaced or expired by realtime imports """
+    logger.debug('Dropping retired stop times')
+    with connection.cursor() as cursor:
+        drop_retired_partitions(cursor)
 
+
+def insert_stop_times(rows, real_time, on_invalid):
+    """ Insert stop times as RealStopTime objects, in batches
+
+    A batch that fails is split until the rows causing the failure are found,
+    and those are handed to on_invalid with their row number and error.
+
+    Params:
+        :rows: Iterable of (row number, row dict) tuples, e.g. from read_stop_times
+    Returns a (rows imported, rows read) tuple
     """
 
     BATCH_SIZE = 5000
@@ -57,52 +165,37 @@ def load_stop_times(real_time, error_factory):
             val = default
         row[key] = val
 
-    def insert_realstoptimes(realstoptimes, line):
-        try:
-            RealStopTime.objects.bulk_create(realstoptimes)
-        except Exception:
-            for num, realstoptime in enumerate(realstoptimes, line):
-                try:
-                    realstoptime.save()
-                except Exception as e:
-                    logger.debug('Row %d error: %s', num, e)
-                    key = 'Row %i' % num
-                    error_factory.warn(key, e.message)
+    def bulk_create(rows):
+        RealStopTime.objects.bulk_create([realstoptime for line, realstoptime in rows])
+
+    def insert_realstoptimes(rows):
+        failures = insert_isolating_failures(rows, bulk_create)
+        for line, message in failures:
+            on_invalid(line, message)
+        return len(rows) - len(failures)
 
     imported = 0
-    try:
-        with open(real_time.source_file.path, 'r') as stop_times_file:
-            dict_reader = csv.DictReader(stop_times_file)
-            stop_time_objects = []
-            for line, row in enumerate(dict_reader, start=1):
-                # Ensure optionals have proper defaults
-                ensure_row_key(row, 'pickup_type', 0)
-                ensure_row_key(row, 'drop_off_type', 0)
-                ensure_row_key(row, 'shape_dist_traveled')
-
-                stop_time_object = RealStopTime(datasource=real_time, **row)
-                stop_time_objects.append(stop_time_object)
-                imported += 1
-
-                if line % BATCH_SIZE == 0:
-                    # line - BATCH_SIZE is passed to insert_realstoptimes
-                    # so it knows what line this batch begins on
-                    insert_realstoptimes(stop_time_objects, line - BATCH_SIZE)
-                    stop_time_objects = []
-                    logger.debug('Imported objects %i of %i', imported, line)
-
-            insert_realstoptimes(stop_time_objects, line)
-    except Exception as e:
-        error_factory.error('Import failed', e.message)
-        imported = 0
+    line = 0
+    stop_time_objects = []
+    for line, row in rows:
+        # Ensure optionals have proper defaults
+        ensure_row_key(row, 'pickup_type', 0)
+        ensure_row_key(row, 'drop_off_type', 0)
+        ensure_row_key(row, 'shape_dist_traveled')
+        try:
+            row['arrival_seconds'] = clean_time(row.get('arrival_time') or '', 'arrival_time')
+            row['departure_seconds'] = clean_time(row.get('departure_time') or '',
+                                                  'departure_time')
+        except InvalidRow as e:
+            on_invalid(line, str(e))
+            continue
 
-    if imported > 0:
-        # Delete all other stop times not of this import
-        logger.debug('Cleaning old stop time entries...')
-        other_stop_times = RealStopTime.objects.exclude(datasource=real_time)
-        other_stop_times.delete()
+        stop_time_objects.append((line, RealStopTime(datasource=real_time, **row)))
 
-    return {
-        'imported': imported,
-        'total': line
-    }
+        if len(stop_time_objects) == BATCH_SIZE:
+            imported += insert_realstoptimes(stop_time_objects)
+            stop_time_objects = []
+            logger.debug('Imported objects %i of %i', imported, line)
+
+    imported += insert_realstoptimes(stop_time_objects)
+    return imported, line
@@ -1,23 +1,27 @@
 import os
-import tempfile
+import time
 import zipfile
 
-import shutil
-
 from celery.utils.log import get_task_logger
 from django.conf import settings
-from django.contrib.gis.gdal import DataSource as GDALDataSource
+from django.contrib.gis.gdal import DataSource as GDALDataSource, OGRGeometry
 from django.contrib.gis.geos import MultiPolygon, Polygon
-from django.db import connection
+from django.db import connection, transaction
+from django.db.models import Max, Min
 
+from datasources.demographic_loader import RejectedFeatures, load_layer
+from datasources.demographic_pyramid import build_pyramid, build_summaries
 from datasources.models import (Boundary, BoundaryProblem, DataSourceProblem,
                                 DemographicDataSource, DemographicDataSourceProblem,
-                                DemographicDataFieldName, DemographicDataFeature,
-                                GTFSFeed)
+                                DemographicDataFieldName, DemographicDataFeature, GTFSFeed)
+from transit_indicators.models import OTIIndicatorsConfig
 
 # set up shared task logger
 logger = get_task_logger(__name__)
 
+# Share of its size a cached layer extent is grown by before comparing it with a boundary
+EXTENT_MARGIN = 0.01
+
 
 class ErrorFactory(object):
     """Constructs *Problem instances for imports being processed."""
@@ -34,63 +38,206 @@ class ErrorFactory(object):
         self.problemReference = problemReference
         self.referenceField = referenceField
 
-    def warn(self, title, description=''):
-        """Create a warning."""
+    def warn(self, title, description='', **kwargs):
+        """Create a warning; kwargs set any other fields of the problem."""
         params = dict(type=DataSourceProblem.ProblemTypes.WARNING,
                       description=description,
-                      title=title)
+                      title=title,
+                      **kwargs)
         params[self.referenceField] = self.problemReference
         self.problemClass.objects.create(**params)
 
-    def error(self, title, description=''):
-        """Create an error."""
+    def error(self, title, description='', **kwargs):
+        """Create an error; kwargs set any other fields of the problem."""
         params = dict(type=DataSourceProblem.ProblemTypes.ERROR,
                       description=description,
-                      title=title)
+                      title=title,
+                      **kwargs)
         params[self.referenceField] = self.problemReference
         self.problemClass.objects.create(**params)
 
 
-def extract_zip_to_temp_dir(file):
-    """Extracts zipfile into a new temporary folder."""
-    temp_dir = tempfile.mkdtemp()
-    unzipper = zipfile.ZipFile(file)
-    unzipper.extractall(temp_dir)
-    unzipper.close()
+def get_shapefiles_in_zip(path):
+    """Finds any shapefiles in a zip archive, reading only its table of contents."""
+    with zipfile.ZipFile(path) as zip_file:
+        return [name for name in zip_file.namelist() if name.endswith('.shp')]
+
+
+def get_vsizip_path(path, name):
+    """Returns the path GDAL reads a file inside a zip archive through, without extracting it."""
+    return '/vsizip/%s/%s' % (os.path.abspath(path), name)
+
+
+def get_layer_extent(layer):
+    """Returns the extent of a layer as a Polygon in the database SRID."""
+    extent = OGRGeometry.from_bbox(layer.extent.tuple)
+    extent.srs = layer.srs
+    extent.transform(settings.DJANGO_SRID)
+    extent = extent.geos
+    extent.srid = settings.DJANGO_SRID
+    return extent
+
+
+def snap_to_grid(geom, grid_size):
+    """Rounds the coordinates of a Polygon or MultiPolygon to a grid of the given size."""
+    def snap(value):
+        return round(value / grid_size) * grid_size
 
-    return temp_dir
+    polygons = [geom] if isinstance(geom, Polygon) else list(geom)
+    return MultiPolygon([Polygon(*[[(snap(coords[0]), snap(coords[1])) for coords in ring]
+                                   for ring in polygon])
+                         for polygon in polygons], srid=geom.srid)
 
 
-def get_shapefiles_in_dir(path):
-    """Finds any shapefiles in path."""
-    all_files = []
-    for dirpath, subdirs, files in os.walk(path):
-        for name in files:
-            all_files.append(os.path.join(dirpath, name))
-    return filter(lambda f: f.endswith('.shp'), all_files)
+def get_union(geoms, grid_size=0):
+    """Attempts to union a list of polygon geometries.
 
+    The polygons are merged in a single cascaded union, which combines them
+    pairwise as a tree rather than adding each to an ever-growing result, so
+    boundaries made of thousands of features union in seconds.
 
-def get_union(geoms):
-    """Attempts to union a list of geometries."""
+    Params:
+        :geoms: List of Polygons or MultiPolygons, as GDAL or GEOS geometries
+        :grid_size: If given, coordinates are first snapped to a grid of this
+                    size (in the units of the geometries), which closes slivers
+                    between neighbouring features
+    Returns a GEOS geometry. Invalid polygons, e.g. with self-intersecting rings,
+    are repaired with a zero-width buffer.
+    """
     if len(geoms) <= 0:
         raise ValueError('Cannot union empty feature list.')
 
-    combined = geoms[0]
-    for geom in geoms[1:]:
-        combined = combined.union(geom)
+    polygons = []
+    for geom in geoms:
+        geom = geom.geos if isinstance(geom, OGRGeometry) else geom
+        if not isinstance(geom, (Polygon, MultiPolygon)):
+            raise ValueError('Feature is not a MultiPolygon or Polygon')
+        if grid_size:
+            geom = snap_to_grid(geom, grid_size)
+        if not geom.valid:
+            geom = geom.buffer(0)
+        # repairing can leave a Polygon, a MultiPolygon, or nothing of a collapsed one
+        if isinstance(geom, Polygon):
+            polygons.append(geom)
+        elif isinstance(geom, MultiPolygon):
+            polygons.extend(geom)
+    if not polygons:
+        raise ValueError('No valid polygons to union.')
+
+    combined = MultiPolygon(polygons, srid=polygons[0].srid).cascaded_union
+    if not combined.valid:
+        combined = combined.buffer(0)
     return combined
 
 
 def make_multipolygon(geom):
     """Wraps Polygons in MultiPolygons"""
-    if isinstance(geom.geos, Polygon):
-        return MultiPolygon(geom.geos)
-    elif isinstance(geom.geos, MultiPolygon):
-        return geom.geos
+    geom = geom.geos if isinstance(geom, OGRGeometry) else geom
+    if isinstance(geom, Polygon):
+        return MultiPolygon(geom)
+    elif isinstance(geom, MultiPolygon):
+        return geom
     else:
         raise ValueError('Feature is not a MultiPolygon or Polygon')
 
 
+def get_clip_boundary():
+    """Returns the Boundary demographics are clipped to, as ClipDemographics picks it, or None"""
+    config = OTIIndicatorsConfig.objects.first()
+    if config is None:
+        return None
+    for boundary in (config.region_boundary, config.city_boundary):
+        if boundary is not None and boundary.geom is not None:
+            return boundary
+    return None
+
+
+def clip_demographics(chunk_size=None, datasource=None):
+    """Clips the demographic features to the region boundary, or else the city boundary.
+
+    Features are clipped by ClipDemographics in chunks of consecutive ids, each in
+    its own transaction. Features crossing the boundary keep the share of their
+    metrics proportional to the share of their area inside it, and features
+    outside it are deleted.
+
+    Given the DemographicDataSource just loaded, its cached extent settles the
+    common cases without touching the features: nothing is clipped if the boundary
+    contains the extent, and its features are all deleted if the boundary misses it.
+    Returns the number of features clipped or deleted.
+    """
+    if datasource is not None and datasource.extent is not None:
+        boundary = get_clip_boundary()
+        # the extent's corners were reprojected, but not its edges, so allow some slack
+        xmin, ymin, xmax, ymax = datasource.extent.extent
+        extent = datasource.extent.buffer(max(xmax - xmin, ymax - ymin) * EXTENT_MARGIN)
+        if boundary is None or boundary.geom.contains(extent):
+            logger.info('Demographics extent is within the boundary; nothing to clip')
+            return 0
+        if not boundary.geom.intersects(extent):
+            logger.info('Demographics extent is outside the boundary; deleting its features')
+            features = DemographicDataFeature.objects.filter(datasource=datasource)
+            deleted = features.count()
+            features.delete()
+            return deleted
+
+    if chunk_size is None:
+        chunk_size = settings.DEMOGRAPHICS_CLIP_CHUNK_SIZE
+    ids = DemographicDataFeature.objects.aggregate(min=Min('id'), max=Max('id'))
+    if ids['min'] is None:
+        return 0
+
+    started = time.time()
+    changed = 0
+    for first_id in xrange(ids['min'], ids['max'] + 1, chunk_size):
+        with transaction.atomic(), connection.cursor() as c:
+            c.execute('SELECT ClipDemographics(%s, %s);', [first_id, first_id + chunk_size - 1])
+            changed += c.fetchone()[0]
+    logger.info('Clipped demographics features to the boundary in %.1f seconds; %i changed',
+                time.time() - started, changed)
+    return changed
+
+
+def create_grid():
+    """Samples the demographic features onto a regular grid of points in demographic_grid.
+
+    The grid's resolution comes from OTIIndicatorsConfig.demographic_grid_resolution_m.
+    It's built by CreateGrid, or if settings.DEMOGRAPHIC_GRID_ENGINE is 'numpy', by
+    rasterizing the features with NumPy.
+    """
+    config = OTIIndicatorsConfig.objects.first()
+    if config:
+        resolution = config.demographic_grid_resolution_m
+    else:
+        resolution = OTIIndicatorsConfig._meta.get_field('demographic_grid_resolution_m').default
+    started = time.time()
+    with transaction.atomic(), connection.cursor() as c:
+        if settings.DEMOGRAPHIC_GRID_ENGINE == 'numpy':
+            # imported here, so NumPy is only loaded by the engine needing it
+            from datasources.demographic_raster import rasterize_grid
+            c.execute('SELECT PrepareDemographicGrid();')
+            rasterize_grid(c, resolution, settings.DEMOGRAPHIC_RASTER_TILE_SIZE,
+                           settings.DEMOGRAPHIC_RASTER_DIR)
+            c.execute('SELECT IndexDemographicGrid();')
+        else:
+            c.execute('SELECT CreateGrid(%s);', [resolution])
+    logger.info('Created %sm demographics grid with the %s engine in %.1f seconds',
+                resolution, settings.DEMOGRAPHIC_GRID_ENGINE, time.time() - started)
+
+
+def aggregate_demographics(datasource_id):
+    """Sums the demographic features over the cells of each grid of the pyramid, and summarizes them.
+
+    The cell sizes, and the number of quantiles and histogram bins, come from settings.
+    """
+    started = time.time()
+    with transaction.atomic(), connection.cursor() as c:
+        cells = build_pyramid(c, datasource_id, settings.DEMOGRAPHIC_PYRAMID_CELL_SIZES)
+        build_summaries(c, datasource_id, settings.DEMOGRAPHIC_SUMMARY_QUANTILES,
+                        settings.DEMOGRAPHIC_SUMMARY_HISTOGRAM_BINS)
+    logger.info('Aggregated demographics into %d grid cells in %.1f seconds',
+                cells, time.time() - started)
+
+
 def run_shapefile_to_boundary(boundary_id):
     """Populate a boundary's geom field from a shapefile."""
     # Get the boundary object we're processing, note that we're processing, and
@@ -115,9 +262,9 @@ def run_shapefile_to_boundary(boundary_id):
             handle_error('No valid GTFS feed.',
                          'Please upload a valid GTFS feed before adding boundary data.')
             return
-        # Set up temporary directory and unzip to there.
-        temp_dir = extract_zip_to_temp_dir(boundary.source_file)
-        shapefiles = get_shapefiles_in_dir(temp_dir)
+        # Read the shapefile in place, without extracting the zip
+        zip_path = boundary.source_file.path
+        shapefiles = get_shapefiles_in_zip(zip_path)
 
         if len(shapefiles) > 1:
             handle_error('Multiple shapefiles found.', 'Upload only one shapefile at a time.')
@@ -127,8 +274,7 @@ def run_shapefile_to_boundary(boundary_id):
                          'The zip archive must include exactly one shapefile.')
             return
 
-        shapefile_path = os.path.join(temp_dir, shapefiles[0])
-        shape_datasource = GDALDataSource(shapefile_path)
+        shape_datasource = GDALDataSource(get_vsizip_path(zip_path, shapefiles[0]))
         if len(shape_datasource) > 1:
             handle_error('Multiple layers in shapefile.',
                          'The boundary shapefile must have only one layer.')
@@ -140,16 +286,16 @@ def run_shapefile_to_boundary(boundary_id):
             return
 
         # Since this will become a boundary for a city / region, attempt to flatten
-        # all features into one feature.
+        # all features into one feature, after transforming them to our internal
+        # database SRID
         try:
-            union = get_union([feature.geom for feature in boundary_layer])
+            union = get_union([feature.geom.transform(settings.DJANGO_SRID, clone=True)
+                               for feature in boundary_layer],
+                              settings.BOUNDARY_UNION_GRID_SIZE)
         except ValueError as e:
             handle_error('Could not create geometry union.', str(e))
             return
 
-        # Transform to our internal database SRID
-        union.transform(settings.DJANGO_SRID)
-
         # Wrap in a MultiPolygon if necessary
         geometry = make_multipolygon(union)
 
@@ -159,15 +305,14 @@ def run_shapefile_to_boundary(boundary_id):
         boundary.save()
     except Exception as e:
         handle_error('Unexpected error processing shapefile.', str(e))
-    finally:
-        shutil.rmtree(temp_dir, ignore_errors=True)
-        return
 
 
 def run_get_shapefile_fields(demographicdata_id):
     """Get the column field names from a shapefile.
     Opens the Shapefile associated with demographicdata_id, validates it, and extracts the field
-    names available in the Shapefile. Saves them as DemographicDataFieldName objects.
+    names available in the Shapefile. Saves them as DemographicDataFieldName objects, and caches
+    the rest of the layer's metadata (the shapefile's name in the zip, its feature count, SRS
+    and extent) on the DemographicDataSource, so loading the data needn't inspect it again.
     Params:
         :demographicdata_id: ID of a DemographicDataSource from which to get field names.
     """
@@ -186,9 +331,9 @@ def run_get_shapefile_fields(demographicdata_id):
         return
 
     try:
-        # Set up temporary directory and unzip to there.
-        temp_dir = extract_zip_to_temp_dir(demog_data.source_file)
-        shapefiles = get_shapefiles_in_dir(temp_dir)
+        # Read the shapefile in place, without extracting the zip
+        zip_path = demog_data.source_file.path
+        shapefiles = get_shapefiles_in_zip(zip_path)
 
         # There must be valid GTFS data in order to load demographic data
         # otherwise UTM projection may not work.
@@ -205,8 +350,7 @@ def run_get_shapefile_fields(demographicdata_id):
                          'The zip archive must include exactly one shapefile.')
             return
 
-        shapefile_path = os.path.join(temp_dir, shapefiles[0])
-        shape_datasource = GDALDataSource(shapefile_path)
+        shape_datasource = GDALDataSource(get_vsizip_path(zip_path, shapefiles[0]))
         if len(shape_datasource) > 1:
             handle_error('Multiple layers in shapefile.',
                          'The boundary shapefile must have only one layer.')
@@ -219,15 +363,15 @@ def run_get_shapefile_fields(demographicdata_id):
         for field_name in demographic_layer.fields:
             DemographicDataFieldName.objects.get_or_create(datasource=demog_data, name=field_name)
 
+        demog_data.shapefile_name = shapefiles[0]
         demog_data.num_features = len(demographic_layer)
+        demog_data.srs = demographic_layer.srs.wkt
+        demog_data.extent = get_layer_extent(demographic_layer)
         demog_data.status = DemographicDataSource.Statuses.WAITING_USER_INPUT
         demog_data.save()
 
     except Exception as e:
         handle_error('Unexpected error processing shapefile.', str(e))
-    finally:
-        shutil.rmtree(temp_dir, ignore_errors=True)
-        return
 
 
 def run_load_shapefile_data(demographicdata_id, pop1_field, pop2_field, dest1_field):
@@ -245,7 +389,10 @@ def run_load_shapefile_data(demographicdata_id, pop1_field, pop2_field, dest1_fi
         :dest2_field: Same as pop1_field and pop2_field, but data from this field of the
         Shapefile will end up in the destination_metric_1 field of each
         DemographicDataFeature object.
+    The features are streamed into the database in batches with COPY, and the ones
+    that can't be loaded are reported in a single warning.
     """
+
     # We can assume that the shapefile is valid because get_shapefile_fields
     # has been run, so jump straight to getting the data.
     demog_data = DemographicDataSource.objects.get(pk=demographicdata_id)
@@ -259,44 +406,34 @@ def run_load_shapefile_data(demographicdata_id, pop1_field, pop2_field, dest1_fi
     demog_data.demographicdatafeature_set.all().delete()
     error_factory = ErrorFactory(DemographicDataSourceProblem, demog_data, 'datasource')
     try:
-        temp_dir = extract_zip_to_temp_dir(demog_data.source_file)
-        shapefile = os.path.join(temp_dir, get_shapefiles_in_dir(temp_dir)[0])
-        data_layer = GDALDataSource(shapefile)[0]
-
-        for feature in data_layer:
-            try:
-                pop1_val = feature.get(str(pop1_field)) if pop1_field else None
-                pop2_val = feature.get(str(pop2_field)) if pop2_field else None
-                dest1_val = feature.get(str(dest1_field)) if dest1_field else None
-                # If this is too slow we can maybe speed it up with bulk_create
-                (DemographicDataFeature.objects
-                 .get_or_create(population_metric_1=pop1_val,
-                                population_metric_2=pop2_val,
-                                destination_metric_1=dest1_val,
-                                geom=make_multipolygon(feature.geom.transform(settings.DJANGO_SRID,
-                                                                              clone=True)),
-                                datasource=demog_data))
-            except ValueError as e:
-                error_factory.warn('Could not import 1 feature.', str(e))
-
-        # make raw SQL query to execute function that processes demographic data, first
-        # clipping it to region boundary, then turning it into a regular point grid
-        with connection.cursor() as c:
-            c.execute('SELECT ClipDemographics();')
-            c.execute('SELECT CreateGrid();')
+        # Datasources inspected before the shapefile's name was cached need to look it up
+        zip_path = demog_data.source_file.path
+        shapefile_name = demog_data.shapefile_name or get_shapefiles_in_zip(zip_path)[0]
+        data_layer = GDALDataSource(get_vsizip_path(zip_path, shapefile_name))[0]
+
+        rejected_features = RejectedFeatures()
+
+        def reject_feature(number, message):
+            logger.debug('Feature %d error: %s', number, message)
+            rejected_features.add(number, message)
+
+        with transaction.atomic(), connection.cursor() as c:
+            loaded, total = load_layer(c, data_layer, [pop1_field, pop2_field, dest1_field],
+                                       demog_data.id, reject_feature, srs=demog_data.srs)
+        logger.debug('Loaded %i of %i demographic features', loaded, total)
+        rejected_features.report(error_factory)
+
+        # Process the demographic data, first clipping it to region boundary, then
+        # turning it into a regular point grid and aggregating it for maps and legends
+        clip_demographics(datasource=demog_data)
+        create_grid()
+        aggregate_demographics(demog_data.id)
 
         demog_data.status = DemographicDataSource.Statuses.COMPLETE
         demog_data.save()
-        num_loaded_features = DemographicDataFeature.objects.filter(datasource=demog_data).count()
-        if (num_loaded_features < demog_data.num_features):
-            error_factory.warn('Only %s out of %s features loaded; some features may be invalid.'
-                               % (num_loaded_features, demog_data.num_features))
     except Exception as e:
         error_factory.error('Unexpected error loading shapefile.', str(e))
         demog_data.status = DemographicDataSource.Statuses.WAITING_USER_INPUT
         demog_data.save()
-    finally:
-        shutil.rmtree(temp_dir, ignore_errors=True)
-        return
 
 
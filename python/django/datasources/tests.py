@@ -1,20 +1,57 @@
+from collections import namedtuple
+import datetime
+import gzip
+import json
+import multiprocessing
 import os
-from shutil import rmtree
+from shutil import copyfile, rmtree
 import tempfile
 from time import sleep
+import zipfile
 
 from django.conf import settings
+from django.contrib.gis.gdal import OGRGeometry
+from django.core.files import File
+from django.contrib.gis.geos import MultiPolygon, Point, Polygon
+from django.db import DatabaseError, connection
 from django.test import TestCase
 from django.test.utils import override_settings
 
 from rest_framework import status
 from rest_framework.authtoken.models import Token
 from rest_framework.reverse import reverse
+from transitfeed import ProblemReporter
 
+from gtfs_realtime.models import RealStopTime
+from transit_indicators.models import OTIIndicatorsConfig
 from transit_indicators.tests import OTIAPIClient
 from userdata.models import OTIUser
 
-from datasources.models import GTFSFeedProblem, RealTimeProblem
+from datasources.demographic_loader import FeatureCopyRows, RejectedFeatures, copy_features
+from datasources.demographic_pyramid import build_pyramid, build_summaries, get_finer_size
+from datasources.demographic_raster import Tile, polygon_coverage
+from datasources.gtfs_import import (IncrementalImport, IncrementalImportError,
+                                    fingerprint_members)
+from datasources.gtfs_validator import (SampledFeedValidator, StreamingFeedValidator,
+                                        has_column_value)
+from datasources.models import (Boundary, DemographicDataFeature, DemographicDataGridCell,
+                                DemographicDataSource, DemographicDataSummary, GTFSFeed,
+                                GTFSFeedCache, GTFSFeedProblem, OSMData, OSMImportRecord, RealTime,
+                                RealTimeProblem)
+from datasources.realtime_loader import (STOP_TIMES_TABLE, RejectedRows, StopTimeCopyRows,
+                                         attach_partitions, copy_stop_times,
+                                         drop_retired_partitions, expire_partitions,
+                                         get_partitions, get_service_date,
+                                         get_table_constraints, get_table_indexes,
+                                         insert_isolating_failures, open_stop_times_files,
+                                         read_stop_times)
+from datasources.serializers import OSMDataSerializer
+from datasources.tasks.gtfs import OTIProblemAccumulator, extract_gtfs
+from datasources.tasks.osm import (get_delta_bbox, get_source_fingerprint, pad_bbox,
+                                   run_osm_import, save_import_record)
+from datasources.tasks.realtime import load_stop_times
+from datasources.tasks.shapefile import (ErrorFactory, clip_demographics,
+                                         get_shapefiles_in_zip, get_union, get_vsizip_path)
 
 @override_settings(CELERY_EAGER_PROPAGATES_EXCEPTIONS=True,
                    CELERY_ALWAYS_EAGER=True,
@@ -74,6 +111,32 @@ class GTFSFeedTestCase(TestCase):
         problem_count = GTFSFeedProblem.objects.filter(gtfsfeed_id=response.data['id']).count()
         self.assertGreater(problem_count, 0, 'There should have been problems for uploaded data')
 
+    def test_gtfs_validation_cached(self):
+        """Test that re-uploading an identical file reuses the earlier validation"""
+        self.client.authenticate(admin=True)
+        response = self.client.post(self.url, {'source_file': self.test_gtfs_fh})
+        sleep(2) # give time for celery to do job
+        self.test_gtfs_fh.seek(0)
+        repeat_response = self.client.post(self.url, {'source_file': self.test_gtfs_fh})
+        sleep(2)
+        self.assertEqual(len(response.data['source_sha1']), 40)
+        self.assertEqual(response.data['source_sha1'], repeat_response.data['source_sha1'])
+        self.assertEqual(GTFSFeedCache.objects.filter(
+            sha1=response.data['source_sha1']).count(), 1)
+        problem_count = GTFSFeedProblem.objects.filter(gtfsfeed_id=response.data['id']).count()
+        repeat_count = GTFSFeedProblem.objects.filter(
+            gtfsfeed_id=repeat_response.data['id']).count()
+        self.assertEqual(problem_count, repeat_count)
+
+    @override_settings(GTFS_VALIDATOR='transitfeed')
+    def test_gtfs_validation_transitfeed(self):
+        """Test that the transitfeed validator can still be selected"""
+        self.client.authenticate(admin=True)
+        response = self.client.post(self.url, {'source_file': self.test_gtfs_fh})
+        sleep(2) # give time for celery to do job
+        problem_count = GTFSFeedProblem.objects.filter(gtfsfeed_id=response.data['id']).count()
+        self.assertGreater(problem_count, 0, 'There should have been problems for uploaded data')
+
     def test_gtfs_upload_requires_admin(self):
         """Test that verifies GTFS upload requires an admin user"""
         # UNAUTHORIZED if no credentials
@@ -86,6 +149,589 @@ class GTFSFeedTestCase(TestCase):
         response = self.client.post(self.url, {'source_file': self.test_gtfs_fh})
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
 
+    def test_gtfs_replace(self):
+        """Test that a loaded feed is kept until the feed replacing it completes"""
+        self.client.authenticate(admin=True)
+        old_feed = GTFSFeed.objects.create(source_file='old.zip', source_sha1='a' * 40,
+                                           status=GTFSFeed.Statuses.COMPLETE)
+        new_feed = GTFSFeed.objects.create(source_file='new.zip', source_sha1='b' * 40,
+                                           status=GTFSFeed.Statuses.PROCESSING)
+        GTFSFeedCache.objects.create(sha1=old_feed.source_sha1, is_loaded=True)
+        GTFSFeedCache.objects.create(sha1=new_feed.source_sha1)
+
+        # GeoTrellis reports the import of the new feed complete
+        response = self.client.patch(reverse('gtfsfeed-detail', [new_feed.id]),
+                                     {'status': GTFSFeed.Statuses.COMPLETE}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(list(GTFSFeed.objects.values_list('id', flat=True)), [new_feed.id])
+        self.assertEqual(list(GTFSFeedCache.objects.filter(is_loaded=True)
+                              .values_list('sha1', flat=True)), [new_feed.source_sha1])
+
+    def test_gtfs_replace_failed(self):
+        """Test that a loaded feed is kept when the import of the feed replacing it fails"""
+        self.client.authenticate(admin=True)
+        old_feed = GTFSFeed.objects.create(source_file='old.zip', source_sha1='a' * 40,
+                                           status=GTFSFeed.Statuses.COMPLETE)
+        new_feed = GTFSFeed.objects.create(source_file='new.zip', source_sha1='b' * 40,
+                                           status=GTFSFeed.Statuses.PROCESSING)
+        GTFSFeedCache.objects.create(sha1=old_feed.source_sha1, is_loaded=True)
+
+        response = self.client.patch(reverse('gtfsfeed-detail', [new_feed.id]),
+                                     {'status': GTFSFeed.Statuses.ERROR}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(sorted(GTFSFeed.objects.values_list('id', flat=True)),
+                         [old_feed.id, new_feed.id])
+        self.assertTrue(GTFSFeedCache.objects.get(sha1=old_feed.source_sha1).is_loaded)
+
+
+class StreamingFeedValidatorTestCase(TestCase):
+    """Tests the streaming GTFS validator against small generated feeds."""
+
+    FEED_FILES = {
+        'agency.txt': ('agency_name,agency_url,agency_timezone\n'
+                       'Test Transit,http://example.com,America/New_York\n'),
+        'stops.txt': ('stop_id,stop_name,stop_lat,stop_lon\n'
+                      'A,Stop A,39.95,-75.16\n'
+                      'B,Stop B,39.96,-75.17\n'
+                      'C,Stop C,39.97,-75.18\n'),
+        'routes.txt': 'route_id,route_short_name,route_type\nR1,1,3\n',
+        'calendar.txt': ('service_id,monday,tuesday,wednesday,thursday,friday,saturday,'
+                         'sunday,start_date,end_date\nWK,1,1,1,1,1,0,0,20150101,20151231\n'),
+        'trips.txt': 'route_id,service_id,trip_id\nR1,WK,T1\nR1,WK,T2\nR1,WK,T3\n',
+        'stop_times.txt': ('trip_id,arrival_time,departure_time,stop_id,stop_sequence\n'
+                           'T1,08:00:00,08:00:00,A,1\n'
+                           'T1,08:10:00,08:10:00,B,2\n'
+                           'T2,08:00:00,08:00:00,A,1\n'
+                           'T2,08:10:00,08:10:00,B,2\n'
+                           'T3,09:00:00,09:00:00,A,1\n'
+                           'T3,08:50:00,08:55:00,Z,2\n'),
+    }
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def validate_feed(self, processes=1, sample_rows=None, **overrides):
+        """Writes FEED_FILES (with overrides, None removes a file) and validates it.
+
+        Only a sample of each table is validated if sample_rows is given.
+        """
+        feed_files = dict(self.FEED_FILES, **overrides)
+        feed_path = os.path.join(self.temp_dir, 'feed.zip')
+        with zipfile.ZipFile(feed_path, 'w') as feed:
+            for name, contents in feed_files.items():
+                if contents is not None:
+                    feed.writestr(name, contents)
+        accumulator = OTIProblemAccumulator()
+        problems = ProblemReporter(accumulator=accumulator)
+        if sample_rows is None:
+            validator = StreamingFeedValidator(feed_path, problems, processes=processes)
+        else:
+            validator = SampledFeedValidator(feed_path, problems, sample_rows=sample_rows)
+        validator.validate()
+        self.accumulator = accumulator
+        return validator, [problem.__class__.__name__
+                           for problem, occurrences, samples in accumulator.problems.values()]
+
+    def test_streaming_validation(self):
+        """Test that references, ordering, duplicates and coverage are checked"""
+        validator, problem_names = self.validate_feed()
+        # T3 references unknown stop Z; C is unused; T3 goes back in time; T1/T2 are duplicates
+        self.assertIn('InvalidValue', problem_names)
+        self.assertIn('UnusedStop', problem_names)
+        self.assertIn('OtherProblem', problem_names)
+        self.assertIn('DuplicateTrip', problem_names)
+        self.assertFalse(validator.has_shapes)
+        self.assertFalse(validator.has_shape_dist_traveled)
+
+    def test_parallel_validation(self):
+        """Test that validating tables in worker processes finds the same problems"""
+        validator, problem_names = self.validate_feed()
+        problems = self.accumulator.problems.keys()
+        validator, problem_names = self.validate_feed(processes=4)
+        self.assertEqual(sorted(self.accumulator.problems.keys()), sorted(problems))
+        self.assertEqual(len(validator.trips), 3)
+
+    def test_parallel_validation_in_daemon(self):
+        """Test that tables are validated in processes from a daemonic (celery) worker too"""
+        validator, problem_names = self.validate_feed()
+        problems = sorted(self.accumulator.problems.keys())
+        results = multiprocessing.Queue()
+
+        def validate_in_daemon():
+            try:
+                self.validate_feed(processes=4)
+                results.put(sorted(self.accumulator.problems.keys()))
+            except Exception as e:
+                results.put(repr(e))
+
+        worker = multiprocessing.Process(target=validate_in_daemon)
+        worker.daemon = True
+        worker.start()
+        daemon_problems = results.get(timeout=60)
+        worker.join()
+        self.assertEqual(daemon_problems, problems)
+
+    def test_missing_file(self):
+        """Test that required files are checked"""
+        validator, problem_names = self.validate_feed(**{'stops.txt': None})
+        self.assertIn('MissingFile', problem_names)
+
+    def test_shape_dist_traveled_scan(self):
+        """Test that shape_dist_traveled is found by both the validator and the column scan"""
+        stop_times = ('trip_id,arrival_time,departure_time,stop_id,stop_sequence,'
+                      'shape_dist_traveled\n'
+                      'T1,08:00:00,08:00:00,A,1,\n'
+                      'T1,08:10:00,08:10:00,B,2,1.5\n')
+        validator, problem_names = self.validate_feed(**{'stop_times.txt': stop_times})
+        self.assertTrue(validator.has_shape_dist_traveled)
+        feed_path = os.path.join(self.temp_dir, 'feed.zip')
+        self.assertTrue(has_column_value(feed_path, 'stop_times.txt', 'shape_dist_traveled'))
+        self.assertFalse(has_column_value(feed_path, 'stop_times.txt', 'stop_headsign'))
+
+    def test_sampled_validation(self):
+        """Test that pre-validation checks structure and sample rows, but not references"""
+        # the only row going back in time is past the sample
+        validator, problem_names = self.validate_feed(sample_rows=5)
+        self.assertEqual(problem_names, [])
+
+        # the unknown stop Z isn't reported, since references aren't resolved
+        validator, problem_names = self.validate_feed(sample_rows=6)
+        self.assertEqual(problem_names, ['OtherProblem'])
+
+        stops = self.FEED_FILES['stops.txt'] + 'D,Caf\xe9,39.98,-75.19\n'
+        validator, problem_names = self.validate_feed(sample_rows=10, **{'routes.txt': None,
+                                                                       'stops.txt': stops})
+        self.assertIn('MissingFile', problem_names)
+        self.assertIn('InvalidValue', problem_names)
+
+    def test_problem_aggregation(self):
+        """Test that identical problems are stored once with their occurrences"""
+        stop_times = (self.FEED_FILES['stop_times.txt'] +
+                      'T3,09:10:00,09:10:00,Z,3\n'
+                      'T3,09:20:00,09:20:00,Z,4\n')
+        self.validate_feed(**{'stop_times.txt': stop_times})
+        problems = [problem for problem in self.accumulator.get_gtfsfeed_problems(GTFSFeed())
+                    if problem.description.startswith('Invalid value Z')]
+        self.assertEqual(len(problems), 1)
+        self.assertEqual(problems[0].occurrences, 3)
+        self.assertEqual(len(problems[0].sample_rows.splitlines()), 3)
+        self.assertIn('stop_times.txt:8', problems[0].sample_rows)
+
+
+class RecordingCursor(object):
+    """Stands in for a database cursor, keeping the statements it's given."""
+    rowcount = 0
+
+    def __init__(self):
+        self.statements = []
+
+    def execute(self, sql, params=None):
+        self.statements.append((sql, params))
+
+    def executemany(self, sql, param_list):
+        for params in param_list:
+            self.statements.append((sql, params))
+
+
+class IncrementalImportTestCase(TestCase):
+    """Tests diffing two versions of a feed into changes to the gtfs tables."""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def write_feed(self, name, **overrides):
+        """Writes StreamingFeedValidatorTestCase's feed, with overrides, to a zip."""
+        feed_files = dict(StreamingFeedValidatorTestCase.FEED_FILES, **overrides)
+        feed_path = os.path.join(self.temp_dir, name)
+        with zipfile.ZipFile(feed_path, 'w') as feed:
+            for file_name, contents in feed_files.items():
+                feed.writestr(file_name, contents)
+        return feed_path
+
+    def make_import(self, **overrides):
+        old_feed = self.write_feed('old.zip')
+        new_feed = self.write_feed('new.zip', **overrides)
+        return IncrementalImport(old_feed, new_feed, fingerprint_members(old_feed),
+                                 fingerprint_members(new_feed))
+
+    def test_row_changes(self):
+        """Test that only changed rows of stops and stop times are written"""
+        stops = ('stop_id,stop_name,stop_lat,stop_lon\n'
+                 'A,Stop A,39.95,-75.16\n'
+                 'B,Renamed Stop B,39.96,-75.17\n'
+                 'D,Stop D,39.98,-75.19\n')
+        stop_times = StreamingFeedValidatorTestCase.FEED_FILES['stop_times.txt'].replace(
+            'T3,08:50:00,08:55:00,Z,2', 'T3,9:10:00,09:15:00,D,2')
+        incremental_import = self.make_import(**{'stops.txt': stops,
+                                                 'stop_times.txt': stop_times})
+        self.assertEqual(incremental_import.changed_files, set(['stops.txt', 'stop_times.txt']))
+        cursor = RecordingCursor()
+        incremental_import.apply(cursor)
+        # B updated, D inserted, C deleted; T3's second stop updated
+        self.assertEqual(incremental_import.row_counts['gtfs_stops'], (1, 1, 1))
+        self.assertEqual(incremental_import.row_counts['gtfs_stop_times'], (0, 1, 0))
+        self.assertIn(('D', '09:10:00', '09:15:00', None, 'T3', 2),
+                      [params for sql, params in cursor.statements])
+        self.assertIn('gtfs_stops_buffers', incremental_import.invalidated_tables())
+
+    def test_replaced_table(self):
+        """Test that a changed calendar replaces the whole table"""
+        calendar = ('service_id,monday,tuesday,wednesday,thursday,friday,saturday,'
+                    'sunday,start_date,end_date\nWK,1,1,1,1,1,1,0,20150101,20161231\n')
+        incremental_import = self.make_import(**{'calendar.txt': calendar})
+        cursor = RecordingCursor()
+        incremental_import.apply(cursor)
+        self.assertEqual(cursor.statements[0], ('DELETE FROM gtfs_calendar', None))
+        self.assertEqual(incremental_import.row_counts['gtfs_calendar'][0], 1)
+        self.assertEqual(incremental_import.invalidated_tables(), set())
+
+    def test_full_import_required(self):
+        """Test that changes needing the GeoTrellis import are refused"""
+        shapes = 'shape_id,shape_pt_lat,shape_pt_lon,shape_pt_sequence\nS1,39.95,-75.16,1\n'
+        incremental_import = self.make_import(**{'shapes.txt': shapes})
+        self.assertRaises(IncrementalImportError, incremental_import.apply, RecordingCursor())
+
+        stop_times = StreamingFeedValidatorTestCase.FEED_FILES['stop_times.txt'].replace(
+            'T1,08:10:00,08:10:00,B,2', 'T1,,,B,2')
+        incremental_import = self.make_import(**{'stop_times.txt': stop_times})
+        self.assertRaises(IncrementalImportError, incremental_import.apply, RecordingCursor())
+
+
+class ExtractGTFSTestCase(TestCase):
+    """Tests extracting a GTFS zip file for the GeoTrellis import."""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.gtfs_path = os.path.join(self.temp_dir, 'feed.zip')
+        file_directory = os.path.dirname(os.path.abspath(__file__))
+        copyfile(os.path.join(file_directory, 'tests', 'patco.zip'), self.gtfs_path)
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def test_extract_gtfs(self):
+        """Test that members are extracted whole and left alone when they match"""
+        gtfs_file = namedtuple('GTFSFile', 'path')(self.gtfs_path)
+        zip_dir = extract_gtfs(gtfs_file)
+        self.assertEqual(zip_dir, self.gtfs_path + '_unzipped')
+        with zipfile.ZipFile(self.gtfs_path) as zip_file:
+            for name in zip_file.namelist():
+                with open(os.path.join(zip_dir, name), 'rb') as extracted:
+                    self.assertEqual(extracted.read(), zip_file.read(name))
+        self.assertFalse([name for name in os.listdir(zip_dir) if name.endswith('.partial')])
+
+        # a matching file isn't rewritten, a modified one is
+        stops_path = os.path.join(zip_dir, 'stops.txt')
+        trips_path = os.path.join(zip_dir, 'trips.txt')
+        os.utime(stops_path, (0, 0))
+        with open(trips_path, 'ab') as trips:
+            trips.write('modified')
+        extract_gtfs(gtfs_file)
+        self.assertEqual(os.path.getmtime(stops_path), 0)
+        with zipfile.ZipFile(self.gtfs_path) as zip_file:
+            with open(trips_path, 'rb') as trips:
+                self.assertEqual(trips.read(), zip_file.read('trips.txt'))
+
+
+class GetUnionTestCase(TestCase):
+
+    def test_union(self):
+        """Test that features are unioned into one valid geometry"""
+        squares = [Polygon.from_bbox((x, y, x + 1, y + 1), srid=3857)
+                   for x in range(20) for y in range(20)]
+        union = get_union(squares)
+        self.assertTrue(union.valid)
+        self.assertEqual(union.area, 400)
+        self.assertEqual(union.geom_type, 'Polygon')
+
+        # a self-intersecting "bowtie" is repaired rather than failing the union
+        bowtie = Polygon(((30, 0), (31, 1), (31, 0), (30, 1), (30, 0)), srid=3857)
+        self.assertFalse(bowtie.valid)
+        union = get_union(squares + [bowtie])
+        self.assertTrue(union.valid)
+        self.assertGreater(union.area, 400)
+
+    def test_snapped_union(self):
+        """Test that snapping to a grid closes slivers between neighbouring features"""
+        left = Polygon.from_bbox((0, 0, 1, 1), srid=3857)
+        right = Polygon.from_bbox((1.001, 0, 2, 1), srid=3857)
+        self.assertEqual(get_union([left, right]).geom_type, 'MultiPolygon')
+        union = get_union([left, right], grid_size=0.01)
+        self.assertEqual(union.geom_type, 'Polygon')
+        self.assertEqual(union.area, 2)
+        self.assertRaises(ValueError, get_union, [])
+        self.assertRaises(ValueError, get_union, [Point(0, 0)])
+
+
+class ShapefileZipTestCase(TestCase):
+
+    def test_shapefiles_in_zip(self):
+        """Test that shapefiles are found in a zip and addressed in place, without extracting it"""
+        temp_dir = tempfile.mkdtemp()
+        zip_path = os.path.join(temp_dir, 'blocks.zip')
+        with zipfile.ZipFile(zip_path, 'w') as zip_file:
+            for name in ('blocks/blocks.shp', 'blocks/blocks.dbf', 'blocks/blocks.prj', 'README'):
+                zip_file.writestr(name, '')
+        self.assertEqual(get_shapefiles_in_zip(zip_path), ['blocks/blocks.shp'])
+        self.assertEqual(get_vsizip_path(zip_path, 'blocks/blocks.shp'),
+                         '/vsizip/%s/blocks/blocks.shp' % zip_path)
+        self.assertEqual(os.listdir(temp_dir), ['blocks.zip'])
+        rmtree(temp_dir)
+
+
+class DemographicRasterTestCase(TestCase):
+
+    def test_polygon_coverage(self):
+        """Test that the area of a polygon in each cell is computed exactly"""
+        square = Polygon(((10, 10), (30, 10), (30, 30), (10, 30), (10, 10)),
+                         ((15, 15), (15, 25), (25, 25), (25, 15), (15, 15)))
+        coverage = polygon_coverage(square, (0, 0), 20, (2, 2))
+        self.assertAlmostEqual(coverage.sum(), square.area)
+        # each cell holds a quarter of the square, less a quarter of the hole
+        for area in coverage.flat:
+            self.assertAlmostEqual(area, 75)
+
+        triangle = Polygon(((0, 0), (3, 0), (0, 3), (0, 0)))
+        coverage = polygon_coverage(triangle, (0, 0), 1, (3, 3))
+        self.assertAlmostEqual(coverage.sum(), 4.5)
+        self.assertAlmostEqual(coverage[0, 0], 1)
+        self.assertAlmostEqual(coverage[0, 2], 0.5)
+        self.assertAlmostEqual(coverage[2, 2], 0)
+
+    def test_tile(self):
+        """Test that metrics are spread over the cells by the area of the features covering them"""
+        tile = Tile(0, 0, 4, 2, 10)
+        tile.add_feature(1, (100, None, 8), 400, Polygon.from_bbox((0, 0, 20, 20)))
+        tile.add_feature(2, (30, None, 0), 300, Polygon.from_bbox((15, 0, 30, 20)))
+        self.assertAlmostEqual(tile.values[0].sum(), 130)
+        self.assertAlmostEqual(tile.values[0][0, 0], 25)
+        self.assertAlmostEqual(tile.values[0][0, 1], 30)
+        self.assertAlmostEqual(tile.values[2].sum(), 8)
+        self.assertFalse(tile.has_value[1].any())
+        self.assertEqual(tile.feature_ids.tolist(), [[1, 1, 2, 0], [1, 1, 2, 0]])
+        self.assertEqual(len(list(tile.get_grid_rows(32618))), 6)
+
+
+class DemographicLoaderTestCase(TestCase):
+
+    def get_features(self):
+        """Returns features in EPSG:4326 as read from a shapefile, two of them invalid"""
+        square = 'POLYGON((-75.2 39.9, -75.1 39.9, -75.1 40, -75.2 40, -75.2 39.9))'
+        return [(1, [10, 2.5, None], OGRGeometry(square, srs=4326)),
+                (2, ['many', 1, 1], OGRGeometry(square, srs=4326)),
+                (3, [5, None, 7], OGRGeometry('POINT(-75.1 39.9)', srs=4326)),
+                (4, [0, '', '3'], OGRGeometry('MULTI' + square.replace('((', '(((') + ')',
+                                              srs=4326))]
+
+    def test_copy_rows(self):
+        """Test that features are reprojected and formatted for COPY, skipping invalid ones"""
+        rejected = RejectedFeatures()
+        rows = list(FeatureCopyRows(self.get_features(), settings.DJANGO_SRID, 7, rejected.add))
+        self.assertEqual([number for number, text in rows], [1, 4])
+        self.assertEqual(rejected.count, 2)
+        self.assertEqual(rows[0][1].split('\t')[:3], ['10.0', '2.5', '\\N'])
+        self.assertEqual(rows[1][1].split('\t')[:3], ['0.0', '\\N', '3.0'])
+        self.assertEqual(rows[0][1].split('\t')[4:6], ['7', settings.OTI_CITY_NAME])
+        self.assertIn('2 features could not be imported: 2-3', rejected.get_description())
+
+    def test_copy_features(self):
+        """Test that features are copied into the table as reprojected MultiPolygons"""
+        datasource = DemographicDataSource.objects.create()
+        rejected = RejectedFeatures()
+        with connection.cursor() as cursor:
+            copied, total = copy_features(cursor, self.get_features(), settings.DJANGO_SRID,
+                                          datasource.id, rejected.add, batch_size=1)
+        self.assertEqual((copied, total), (2, 4))
+        features = DemographicDataFeature.objects.filter(datasource=datasource).order_by('id')
+        self.assertEqual([feature.population_metric_1 for feature in features], [10, 0])
+        self.assertEqual(features[0].geom.geom_type, 'MultiPolygon')
+        self.assertEqual(features[0].geom.srid, settings.DJANGO_SRID)
+        self.assertAlmostEqual(features[0].geom.centroid.x, -8365000, delta=10000)
+
+
+class ClipDemographicsTestCase(TestCase):
+
+    def setUp(self):
+        self.datasource = DemographicDataSource.objects.create(
+            extent=Polygon.from_bbox((0, 0, 1000, 1000), srid=settings.DJANGO_SRID))
+        DemographicDataFeature.objects.create(
+            datasource=self.datasource, population_metric_1=10,
+            geom=MultiPolygon(Polygon.from_bbox((0, 0, 1000, 1000)), srid=settings.DJANGO_SRID))
+
+    def set_boundary(self, bbox):
+        boundary = Boundary.objects.create(
+            source_file='boundary.zip',
+            geom=MultiPolygon(Polygon.from_bbox(bbox), srid=settings.DJANGO_SRID))
+        OTIIndicatorsConfig.objects.create(poverty_line=256.36, nearby_buffer_distance_m=500,
+                                           max_commute_time_s=3600, avg_fare=500,
+                                           arrive_by_time_s=900, city_boundary=boundary)
+
+    def test_extent_within_boundary(self):
+        """Test that features of a layer within the boundary are left alone"""
+        self.set_boundary((-1000, -1000, 2000, 2000))
+        self.assertEqual(clip_demographics(datasource=self.datasource), 0)
+        self.assertEqual(DemographicDataFeature.objects.count(), 1)
+
+    def test_extent_outside_boundary(self):
+        """Test that features of a layer outside the boundary are deleted"""
+        self.set_boundary((5000, 5000, 6000, 6000))
+        self.assertEqual(clip_demographics(datasource=self.datasource), 1)
+        self.assertEqual(DemographicDataFeature.objects.count(), 0)
+
+
+class DemographicPyramidTestCase(TestCase):
+
+    def setUp(self):
+        self.datasource = DemographicDataSource.objects.create()
+        # ten 100m squares along the x axis, from 0 to 1000m, with metrics 1 to 10
+        for number in range(1, 11):
+            x = (number - 1) * 100
+            DemographicDataFeature.objects.create(
+                datasource=self.datasource, population_metric_1=number, destination_metric_1=None,
+                geom=MultiPolygon(Polygon.from_bbox((x, 0, x + 100, 100)),
+                                  srid=settings.DJANGO_SRID))
+
+    def test_finer_size(self):
+        """Test that coarser grids are summed from the largest finer grid dividing them"""
+        self.assertEqual(get_finer_size(4000.0, [1000.0, 2000.0]), 2000.0)
+        self.assertEqual(get_finer_size(3000.0, [1000.0, 2000.0]), 1000.0)
+        self.assertIsNone(get_finer_size(2500.0, [1000.0, 2000.0]))
+
+    def test_build_pyramid(self):
+        """Test that the features' metrics are summed over the cells of each grid"""
+        with connection.cursor() as cursor:
+            self.assertEqual(build_pyramid(cursor, self.datasource.id, (500, 1000, 1500)), 4)
+        cells = DemographicDataGridCell.objects.filter(datasource=self.datasource)
+        self.assertEqual([(cell.grid_x, cell.population_metric_1, cell.feature_count)
+                          for cell in cells.filter(cell_size=500).order_by('grid_x')],
+                         [(0, 15, 5), (1, 40, 5)])
+        for size in (1000, 1500):
+            cell = cells.get(cell_size=size)
+            self.assertEqual((cell.population_metric_1, cell.feature_count), (55, 10))
+            self.assertIsNone(cell.destination_metric_1)
+            self.assertEqual(cell.geom.extent, (0, 0, size, size))
+
+    def test_build_pyramid_split(self):
+        """Test that a feature's metrics are split among the finest cells by area"""
+        datasource = DemographicDataSource.objects.create()
+        DemographicDataFeature.objects.create(
+            datasource=datasource, population_metric_1=100,
+            geom=MultiPolygon(Polygon.from_bbox((400, 0, 1000, 100)),
+                              srid=settings.DJANGO_SRID))
+        with connection.cursor() as cursor:
+            self.assertEqual(build_pyramid(cursor, datasource.id, (500, 1000)), 3)
+        cells = DemographicDataGridCell.objects.filter(datasource=datasource)
+        finest = cells.filter(cell_size=500).order_by('grid_x')
+        self.assertEqual([(cell.grid_x, cell.feature_count) for cell in finest], [(0, 0), (1, 1)])
+        self.assertAlmostEqual(finest[0].population_metric_1, 100 / 6.0)
+        self.assertAlmostEqual(finest[1].population_metric_1, 500 / 6.0)
+        self.assertAlmostEqual(cells.get(cell_size=1000).population_metric_1, 100)
+
+    def test_build_summaries(self):
+        """Test that each metric's range, quantiles and histogram are computed"""
+        with connection.cursor() as cursor:
+            build_summaries(cursor, self.datasource.id, 5, 3)
+        summary = DemographicDataSummary.objects.get(datasource=self.datasource,
+                                                     metric='population_metric_1')
+        self.assertEqual((summary.count, summary.min, summary.max), (10, 1, 10))
+        self.assertEqual(json.loads(summary.quantiles), [2, 4, 6, 8, 10])
+        self.assertEqual(json.loads(summary.histogram), [3, 3, 4])
+        empty = DemographicDataSummary.objects.get(datasource=self.datasource,
+                                                   metric='destination_metric_1')
+        self.assertEqual((empty.count, empty.min), (0, None))
+        self.assertEqual(json.loads(empty.histogram), [])
+
+        response = self.client.get('/api/demographics-ranges/', {'type': 'population_metric_1'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data['min'], response.data['max']), (1, 10))
+
+
+class OSMDataTestCase(TestCase):
+
+    def setUp(self):
+        self.gtfsfeed = GTFSFeed.objects.create(source_file='gtfs.zip')
+
+    def test_pbf_source_validation(self):
+        """Test that imports from a local .osm.pbf file must name an existing one"""
+        temp_dir = tempfile.mkdtemp()
+        pbf_path = os.path.join(temp_dir, 'region.osm.pbf')
+        data = {'gtfsfeed': self.gtfsfeed.id, 'source': OSMData.Sources.PBF,
+                'pbf_path': pbf_path}
+        self.assertFalse(OSMDataSerializer(data=data).is_valid())
+
+        open(pbf_path, 'w').close()
+        self.assertTrue(OSMDataSerializer(data=data).is_valid())
+
+        data['pbf_path'] = os.path.join(temp_dir, 'region.osm')
+        open(data['pbf_path'], 'w').close()
+        self.assertFalse(OSMDataSerializer(data=data).is_valid())
+
+        # downloads from the overpass API need no local file
+        data['source'] = OSMData.Sources.OVERPASS
+        self.assertTrue(OSMDataSerializer(data=data).is_valid())
+        rmtree(temp_dir)
+
+    def test_delta_bbox(self):
+        """Test that only the part of a bounding box not imported yet is imported"""
+        covered = Polygon.from_bbox((10.0, 20.0, 11.0, 21.0))
+        self.assertIsNone(get_delta_bbox(covered, (10.2, 20.2, 10.8, 20.8)))
+        # the stops spread east: only the strip east of the covered box is needed
+        self.assertEqual(get_delta_bbox(covered, (10.2, 20.2, 11.5, 20.8)),
+                         (11.0, 20.2, 11.5, 20.8))
+        # and north too: the strips are combined
+        self.assertEqual(get_delta_bbox(covered, (10.2, 20.2, 11.5, 21.5)),
+                         (10.2, 20.2, 11.5, 21.5))
+        self.assertEqual(get_delta_bbox(covered, (10.2, 20.2, 10.8, 21.5)),
+                         (10.2, 21.0, 10.8, 21.5))
+        # a box elsewhere is imported whole
+        self.assertEqual(get_delta_bbox(covered, (12.0, 20.2, 12.5, 20.8)),
+                         (12.0, 20.2, 12.5, 20.8))
+        # once that's imported, the area between the two boxes is still missing
+        covered = covered.union(Polygon.from_bbox((12.0, 20.2, 12.5, 20.8)))
+        self.assertIsNone(get_delta_bbox(covered, (12.1, 20.3, 12.4, 20.7)))
+        self.assertEqual(get_delta_bbox(covered, (10.5, 20.5, 12.5, 20.8)),
+                         (11.0, 20.5, 12.0, 20.8))
+
+        self.assertEqual(pad_bbox((-179.995, 20.0, 11.0, 89.995), 0.01),
+                         (-180, 19.99, 11.01, 90))
+
+    def test_reuse_after_feed_delete(self):
+        """Test that the OSM import for a re-uploaded feed reuses the roads imported before"""
+        with connection.cursor() as c:
+            c.execute('CREATE TABLE gtfs_stops (stop_id text, the_geom geometry(Point, 4326), '
+                      '                         geom geometry(Point, 32618));')
+            c.execute("INSERT INTO gtfs_stops SELECT 'A', point, ST_Transform(point, 32618) "
+                      "FROM (SELECT ST_SetSRID(ST_MakePoint(-75.16, 39.95), 4326) AS point) p;")
+            for table in ('planet_osm_line', 'planet_osm_point', 'planet_osm_polygon'):
+                c.execute('CREATE TABLE %s (osm_id bigint);' % table)
+            c.execute('CREATE TABLE planet_osm_roads (osm_id bigint, highway text, '
+                      '                               way geometry(LineString, 32618));')
+            c.execute("INSERT INTO planet_osm_roads VALUES (1, 'primary', NULL);")
+        first_import = OSMData.objects.create(gtfsfeed=self.gtfsfeed,
+                                              status=OSMData.Statuses.COMPLETE)
+        save_import_record(Polygon.from_bbox((-75.2, 39.9, -75.1, 40.0)),
+                           get_source_fingerprint(first_import), 32618)
+
+        # a new version of the feed is uploaded after deleting the old one
+        self.gtfsfeed.delete()
+        self.assertFalse(OSMData.objects.exists())
+        self.assertEqual(OSMImportRecord.objects.count(), 1)
+        gtfsfeed = GTFSFeed.objects.create(source_file='gtfs.zip')
+        osm_data = OSMData.objects.create(gtfsfeed=gtfsfeed)
+        run_osm_import(osm_data.id)
+
+        # osm2pgsql wasn't run: nothing was downloaded for it
+        osm_data = OSMData.objects.get(pk=osm_data.id)
+        self.assertEqual(osm_data.status, OSMData.Statuses.COMPLETE)
+        self.assertFalse(osm_data.source_file)
+
+
 class RealTimeTestCase(TestCase):
 
     def setUp(self):
@@ -123,3 +769,145 @@ class RealTimeTestCase(TestCase):
         response = self.client.post(self.url, {'source_file': self.test_realtime_fh,
                                                'city_name': settings.OTI_CITY_NAME})
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_copy_rows(self):
+        """Test that stop times are formatted for COPY and invalid rows are skipped"""
+        invalid_rows = []
+        service_date = datetime.date(2015, 6, 1)
+        stop_times = StopTimeCopyRows(read_stop_times([(None, self.test_realtime_fh)],
+                                                      service_date),
+                                      7, lambda line, message: invalid_rows.append(line))
+        rows = list(stop_times)
+        self.assertEqual([3, 5], invalid_rows)
+        self.assertEqual((7, 9), (stop_times.valid, stop_times.total))
+        self.assertEqual([line for line, date, text in rows], [1, 2, 4, 6, 7, 8, 9])
+        self.assertEqual(rows[0][1], service_date)
+        self.assertEqual(rows[0][2].split('\t')[:3], ['100A1', '28816', '1'])
+        self.assertEqual(rows[0][2].split('\t')[-4:], ['0', '\\N', '2015-06-01', '7\n'])
+        # times are also copied as seconds past midnight
+        self.assertEqual(rows[1][2].split('\t')[3:7], ['00:02:51', '00:04:06', '171', '246'])
+
+    def test_compressed_uploads(self):
+        """Test that gzipped files and zips of several files are read on the fly"""
+        contents = self.test_realtime_fh.read()
+        temp_dir = tempfile.mkdtemp()
+        gz_path = os.path.join(temp_dir, 'stop_times.txt_new.gz')
+        zip_path = os.path.join(temp_dir, 'stop_times.zip')
+        gz_file = gzip.open(gz_path, 'wb')
+        gz_file.write(contents)
+        gz_file.close()
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+            zip_file.writestr('2015-06-02.txt_new', contents)
+            zip_file.writestr('2015-06-01.txt_new', contents)
+            zip_file.writestr('README', 'not stop times')
+
+        upload_date = datetime.date(2015, 5, 31)
+        rows = list(read_stop_times(open_stop_times_files(gz_path), upload_date))
+        self.assertEqual([line for line, row in rows], range(1, 10))
+        self.assertEqual(rows[0][1]['stop_id'], '28816')
+        self.assertEqual(rows[0][1]['service_date'], upload_date)
+
+        # rows of the second file continue the numbering of the first, and
+        # each file's rows take the date in its name
+        rows = list(read_stop_times(open_stop_times_files(zip_path), upload_date))
+        self.assertEqual([line for line, row in rows], range(1, 19))
+        self.assertEqual(rows[9][1]['stop_id'], '28816')
+        self.assertEqual([rows[0][1]['service_date'], rows[9][1]['service_date']],
+                         [datetime.date(2015, 6, 1), datetime.date(2015, 6, 2)])
+        self.assertEqual(get_service_date('/uploads/stop_times_20150603.txt_new'),
+                         datetime.date(2015, 6, 3))
+        self.assertIsNone(get_service_date('stop_times_20151303.txt_new'))
+        rmtree(temp_dir)
+
+    def test_failure_isolation(self):
+        """Test that a failed batch is bisected down to its bad rows"""
+        bad_rows = set([17, 600, 601])
+        attempts = []
+
+        def insert(rows):
+            attempts.append(len(rows))
+            if any(line in bad_rows for line, row in rows):
+                raise DatabaseError('invalid input syntax\nCONTEXT: COPY')
+
+        rows = [(line, None) for line in range(1, 1001)]
+        failures = insert_isolating_failures(rows, insert)
+        self.assertEqual(failures, [(17, 'invalid input syntax'),
+                                    (600, 'invalid input syntax'),
+                                    (601, 'invalid input syntax')])
+        self.assertLess(len(attempts), 3 * 2 * 10 + 1)
+
+        rejected_rows = RejectedRows(max_samples=2)
+        for line, message in failures:
+            rejected_rows.add(line, message)
+        self.assertEqual(rejected_rows.count, 3)
+        self.assertEqual(rejected_rows.get_description(),
+                         '3 rows could not be imported: 17, 600-601')
+        self.assertEqual(len(rejected_rows.samples), 2)
+
+    def test_partitions(self):
+        """Test that each day is loaded into a partition replacing the day's old stop times"""
+        def stop_times(service_date):
+            stop_times_file = open(self.file_directory + '/tests/stop_times_test.txt_new')
+            return read_stop_times([(None, stop_times_file)], service_date)
+
+        june_1 = datetime.date(2015, 6, 1)
+        june_2 = datetime.date(2015, 6, 2)
+        old_data = RealTime.objects.create()
+        RealStopTime.objects.create(datasource=old_data, trip_id='T', stop_id='S',
+                                    stop_sequence=1, arrival_time='08:00:00',
+                                    departure_time='08:00:00', service_date=june_1)
+        first_data = RealTime.objects.create()
+        second_data = RealTime.objects.create()
+        with connection.cursor() as cursor:
+            copied, total, partitions = copy_stop_times(cursor, stop_times(june_1),
+                                                        first_data.id, lambda line, message: None)
+            attach_partitions(cursor, partitions)
+            self.assertEqual(copied, 7)
+            self.assertEqual(get_partitions(cursor), [(partitions[june_1], june_1)])
+            self.assertEqual(len(get_table_indexes(cursor, partitions[june_1])),
+                             len(get_table_indexes(cursor, STOP_TIMES_TABLE)))
+            self.assertEqual(len(get_table_constraints(cursor, partitions[june_1])),
+                             len(get_table_constraints(cursor, STOP_TIMES_TABLE)))
+            # the stop times kept in the parent table for the day are replaced too
+            self.assertFalse(RealStopTime.objects.filter(datasource=old_data).exists())
+
+            # loading the day again replaces it, and a day past the window expires it
+            copied, total, partitions = copy_stop_times(cursor, stop_times(june_1),
+                                                        second_data.id, lambda line, message: None)
+            attach_partitions(cursor, partitions)
+            self.assertEqual(RealStopTime.objects.filter(datasource=first_data).count(), 0)
+            copied, total, partitions = copy_stop_times(cursor, stop_times(june_2),
+                                                        second_data.id, lambda line, message: None)
+            attach_partitions(cursor, partitions)
+            self.assertEqual(RealStopTime.objects.filter(service_date=june_1).count(), 7)
+            self.assertEqual(expire_partitions(cursor, 1), june_2)
+            self.assertEqual(get_partitions(cursor), [(partitions[june_2], june_2)])
+            drop_retired_partitions(cursor)
+
+        self.assertEqual(RealStopTime.objects.count(), 7)
+        self.assertEqual(RealStopTime.objects.filter(service_date=june_2).count(), 7)
+
+    @override_settings(REALTIME_LOADER='orm', REALTIME_RETENTION_DAYS=2)
+    def test_orm_loader_retention(self):
+        """Test that the ORM loader only replaces the days it imports, keeping the window"""
+        may_31 = datetime.date(2015, 5, 31)
+        june_1 = datetime.date(2015, 6, 1)
+        june_2 = datetime.date(2015, 6, 2)
+        old_data = RealTime.objects.create()
+        for service_date in (may_31, june_1, june_2):
+            RealStopTime.objects.create(datasource=old_data, trip_id='T', stop_id='S',
+                                        stop_sequence=1, arrival_time='08:00:00',
+                                        departure_time='08:00:00', service_date=service_date)
+        real_time = RealTime.objects.create(service_date=june_2)
+        real_time.source_file.save('stop_times_test.txt_new', File(self.test_realtime_fh))
+
+        result = load_stop_times(real_time, ErrorFactory(RealTimeProblem, real_time, 'realtime'))
+        real_time.source_file.delete()
+        self.assertEqual(result['imported'], 7)
+        # the day imported is replaced, the day before kept and the one before that expired
+        self.assertEqual(RealStopTime.objects.filter(service_date=june_2).count(), 7)
+        self.assertFalse(RealStopTime.objects.filter(datasource=old_data,
+                                                     service_date=june_2).exists())
+        self.assertTrue(RealStopTime.objects.filter(datasource=old_data,
+                                                    service_date=june_1).exists())
+        self.assertFalse(RealStopTime.objects.filter(service_date=may_31).exists())
@@ -0,0 +1,31 @@
+"""Upload handlers for data source files."""
+import hashlib
+
+from django.core.files.uploadhandler import FileUploadHandler
+
+
+class HashingUploadHandler(FileUploadHandler):
+    """Computes the SHA-1 of each uploaded file as it streams through.
+
+    Doesn't store anything itself: every chunk is passed on unchanged to the
+    following handlers, which write the file to memory or disk as usual. Must
+    be inserted before those handlers.
+    """
+
+    def __init__(self, request=None):
+        super(HashingUploadHandler, self).__init__(request)
+        self.sha1 = None
+        # field name -> hex SHA-1 of the file uploaded in that field
+        self.hashes = {}
+
+    def new_file(self, *args, **kwargs):
+        super(HashingUploadHandler, self).new_file(*args, **kwargs)
+        self.sha1 = hashlib.sha1()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.sha1.update(raw_data)
+        return raw_data
+
+    def file_complete(self, file_size):
+        self.hashes[self.field_name] = self.sha1.hexdigest()
+        return None
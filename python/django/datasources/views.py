@@ -1,21 +1,27 @@
 """Endpoints for data sources."""
 
 import sys
+from django.contrib.gis.geos import Polygon
 from django.db.models import Max, Min
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from transit_indicators.permissions import IsAuthenticatedAndAdminUserOrReadOnly
 from transit_indicators.viewsets import OTIAdminViewSet
 from datasources.viewsets import FileDataSourceViewSet
-from datasources.models import (GTFSFeed, GTFSFeedProblem, Boundary, BoundaryProblem,
-                                RealTime, RealTimeProblem, FileDataSource,
+from datasources.models import (GTFSFeed, GTFSFeedCache, GTFSFeedProblem, Boundary,
+                                BoundaryProblem, RealTime, RealTimeProblem, FileDataSource,
                                 DemographicDataSource, DemographicDataSourceProblem,
-                                DemographicDataFeature, OSMData, OSMDataProblem)
+                                DemographicDataFeature, DemographicDataGridCell,
+                                DemographicDataSummary, OSMData, OSMDataProblem)
 from datasources.serializers import (GTFSFeedSerializer, BoundarySerializer, RealTimeSerializer,
-                                     DemographicDataSourceSerializer, OSMDataSerializer)
-from datasources.tasks import (validate_gtfs, shapefile_to_boundary, get_shapefile_fields,
+                                     DemographicDataSourceSerializer, OSMDataSerializer,
+                                     DemographicDataGridCellSerializer,
+                                     DemographicDataSummarySerializer)
+from datasources.upload_handlers import HashingUploadHandler
+from datasources.tasks import (prevalidate_gtfs, shapefile_to_boundary, get_shapefile_fields,
                                load_shapefile_data, import_osm_data, import_real_time_data)
 from transit_indicators.models import OTIDemographicConfig
 from transit_indicators.serializers import OTIDemographicConfigSerializer
@@ -27,10 +33,29 @@ class GTFSFeedViewSet(FileDataSourceViewSet):
     serializer_class = GTFSFeedSerializer
 
     def create(self, request):
-        """Override create method to call validation task with celery"""
+        """Override create method to hash the upload and call validation task with celery"""
+        # The hashing handler has to be installed before the upload is read
+        hasher = HashingUploadHandler(request)
+        request.upload_handlers.insert(0, hasher)
         response = super(GTFSFeedViewSet, self).create(request)
         if response.status_code == status.HTTP_201_CREATED:
-            validate_gtfs.apply_async(args=[self.object.id], queue='datasources')
+            self.object.source_sha1 = hasher.hashes.get('source_file', '')
+            self.object.save()
+            response.data['source_sha1'] = self.object.source_sha1
+            prevalidate_gtfs.apply_async(args=[self.object.id], queue='prevalidation')
+        return response
+
+    def update(self, request, *args, **kwargs):
+        """Override update to record which feed is loaded once its import completes
+
+        The feeds it replaces are deleted then.
+        """
+        response = super(GTFSFeedViewSet, self).update(request, *args, **kwargs)
+        if (response.status_code == status.HTTP_200_OK and
+                self.object.status == GTFSFeed.Statuses.COMPLETE):
+            if self.object.source_sha1:
+                GTFSFeedCache.mark_loaded(self.object.source_sha1)
+            self.object.delete_replaced()
         return response
 
 
@@ -176,9 +201,46 @@ class DemographicDataFeatureViewSet(OTIAdminViewSet):
     filter_fields = ('datasource',)
 
 
+class DemographicDataGridCellViewSet(viewsets.ReadOnlyModelViewSet):
+    """Sums of demographic data over the cells of grids of several sizes, for drawing maps.
+
+    GET params:
+      cell_size: Number, Size of the cells of the grid to return
+      bbox: String, 'xmin,ymin,xmax,ymax' (in the database SRID) limiting the cells to
+            those overlapping the box
+    """
+    model = DemographicDataGridCell
+    serializer_class = DemographicDataGridCellSerializer
+    permission_classes = [IsAuthenticatedAndAdminUserOrReadOnly]
+    filter_fields = ('datasource', 'cell_size',)
+
+    def get_queryset(self):
+        queryset = DemographicDataGridCell.objects.all()
+        bbox = self.request.QUERY_PARAMS.get('bbox', None)
+        if bbox:
+            try:
+                queryset = queryset.filter(geom__bboverlaps=Polygon.from_bbox(
+                    [float(coord) for coord in bbox.split(',')]))
+            except (TypeError, ValueError):
+                # an invalid box returns nothing
+                return queryset.none()
+        return queryset
+
+
+class DemographicDataSummaryViewSet(viewsets.ReadOnlyModelViewSet):
+    """Summary statistics of each demographic data field, for building legends."""
+    model = DemographicDataSummary
+    serializer_class = DemographicDataSummarySerializer
+    permission_classes = [IsAuthenticatedAndAdminUserOrReadOnly]
+    filter_fields = ('datasource', 'metric',)
+
+
 class DemographicDataRanges(APIView):
     """ Endpoint to GET the min/max ranges of demographic data
 
+    The ranges come from the summary statistics computed when demographic data is loaded,
+    or from the features themselves if there are none.
+
     GET params:
       type: String (required), Name of the demographic data field to use for range calculation
     """
@@ -188,6 +250,11 @@ class DemographicDataRanges(APIView):
             response = {'error': 'type parameter is required'}
             return Response(response, status=status.HTTP_400_BAD_REQUEST)
 
+        summaries = DemographicDataSummary.objects.filter(metric=get_type)
+        if summaries.exists():
+            agg = summaries.aggregate(min=Min('min'), max=Max('max'))
+            return Response(agg, status=status.HTTP_200_OK)
+
         try:
             agg = DemographicDataFeature.objects.all().aggregate(min=Min(get_type), max=Max(get_type))
             return Response(agg, status=status.HTTP_200_OK)
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+# Converts a H:MM:SS / HH:MM:SS time column to seconds past midnight; malformed times become null
+TIME_TO_SECONDS = """
+CASE WHEN trim({column}) ~ '^[0-9]+:[0-5]?[0-9]:[0-5]?[0-9]$'
+     THEN split_part(trim({column}), ':', 1)::integer * 3600 +
+          split_part(trim({column}), ':', 2)::integer * 60 +
+          split_part(trim({column}), ':', 3)::integer
+END"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gtfs_realtime', '0003_auto_20140918_1327'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='realstoptime',
+            name='arrival_seconds',
+            field=models.IntegerField(null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='realstoptime',
+            name='departure_seconds',
+            field=models.IntegerField(null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.RunSQL(
+            'UPDATE gtfs_stop_times_real SET arrival_seconds = %s, departure_seconds = %s' % (
+                TIME_TO_SECONDS.format(column='arrival_time'),
+                TIME_TO_SECONDS.format(column='departure_time'))
+        ),
+        migrations.AlterIndexTogether(
+            name='realstoptime',
+            index_together=set([('trip_id', 'stop_sequence')]),
+        ),
+    ]
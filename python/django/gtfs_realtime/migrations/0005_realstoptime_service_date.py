@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datasources', '0020_realtime_service_date'),
+        ('gtfs_realtime', '0004_stop_time_seconds'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='realstoptime',
+            name='service_date',
+            field=models.DateField(db_index=True, null=True, blank=True),
+            preserve_default=True,
+        ),
+        # stop times imported before partitioning stay in the parent table, dated by their upload
+        migrations.RunSQL(
+            """UPDATE gtfs_stop_times_real s SET service_date = r.create_date::date
+               FROM datasources_realtime r WHERE r.id = s.datasource_id"""
+        ),
+    ]
@@ -15,6 +15,11 @@ class AbstractStopTime(models.Model):
     arrival_time = models.CharField(max_length=12)
     departure_time = models.CharField(max_length=12)
 
+    ## The same times as seconds past midnight of the service day, so they can be
+    ## compared with scheduled times without parsing; null if the time is blank
+    arrival_seconds = models.IntegerField(null=True, blank=True)
+    departure_seconds = models.IntegerField(null=True, blank=True)
+
     stop_headsign = models.CharField(max_length=255, null=True, blank=True)
 
     pickup_type = models.IntegerField(default=0)
@@ -31,5 +36,10 @@ class RealStopTime(AbstractStopTime):
 
     datasource = models.ForeignKey(RealTime)
 
+    ## Day of service the stop times were observed on; the table is partitioned by it
+    service_date = models.DateField(null=True, blank=True, db_index=True)
+
     class Meta(AbstractStopTime.Meta):
         db_table = 'gtfs_stop_times_real'
+        # observed stop times are joined to scheduled ones by trip and stop sequence
+        index_together = [['trip_id', 'stop_sequence']]
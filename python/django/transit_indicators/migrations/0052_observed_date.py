@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transit_indicators', '0051_auto_20150619_2014'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='otiindicatorsconfig',
+            name='observed_date',
+            field=models.DateField(null=True, blank=True),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transit_indicators', '0052_observed_date'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='otiindicatorsconfig',
+            name='demographic_grid_resolution_m',
+            field=models.FloatField(default=500),
+            preserve_default=True,
+        ),
+    ]
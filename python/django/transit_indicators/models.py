@@ -91,6 +91,15 @@ class OTIIndicatorsConfig(models.Model):
     region_boundary = models.ForeignKey(Boundary, blank=True, null=True,
                                         on_delete=models.SET_NULL, related_name='+')
 
+    # Service date of the observed stop times compared with the schedule by the
+    # observed-data indicators; the latest day loaded if not set. It's a single day,
+    # since observed trips are matched to scheduled ones by trip_id.
+    observed_date = models.DateField(blank=True, null=True)
+
+    # Spacing (meters) of the regular grid of points the demographic data is
+    # sampled onto when it's loaded.
+    demographic_grid_resolution_m = models.FloatField(default=500)
+
 
 class OTIDemographicConfig(models.Model):
     """Stores configuration relating to demographic data.
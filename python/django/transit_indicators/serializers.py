@@ -174,6 +174,12 @@ class OTIIndicatorsConfigSerializer(serializers.ModelSerializer):
         self.raise_if_lt_0(attrs[source])
         return attrs
 
+    def validate_demographic_grid_resolution_m(self, attrs, source):
+        """ Make sure the grid resolution is positive """
+        if source in attrs and attrs[source] <= 0:
+            raise serializers.ValidationError("Must be > 0")
+        return attrs
+
     # The other two fields on this model are PositiveIntegerFields, so they
     # validate themselves automatically.
 
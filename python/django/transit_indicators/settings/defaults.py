@@ -113,11 +113,15 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_QUEUES = (
     Queue('datasources', Exchange('datasources'), routing_key='datasources'),
+    # GTFS pre-validation gets its own worker, so uploads are checked while imports run
+    Queue('prevalidation', Exchange('prevalidation'), routing_key='prevalidation'),
     Queue('indicators', Exchange('indicators'), routing_key='indicators'),
     Queue('scenarios', Exchange('scenarios'), routing_key='scenarios')
 )
 CELERY_ROUTES = {
     'datasource_import_tasks': {'queue': 'datasources', 'routing_key': 'datasources'},
+    'datasources.tasks.prevalidate_gtfs': {'queue': 'prevalidation',
+                                           'routing_key': 'prevalidation'},
     'calculate_indicator_tasks': {'queue': 'indicators', 'routing_key': 'indicators'},
     'create_scenario_tasks': {'queue': 'scenarios', 'routing_key': 'scenarios'}
 }
@@ -144,6 +148,71 @@ REST_FRAMEWORK = {
 # Settings for Geometry data stored in database
 DJANGO_SRID = 3857
 
+# Engine used to validate uploaded GTFS feeds: 'streaming' reads each table out of
+# the zip in bounded memory, 'transitfeed' loads the whole feed with transitfeed's Loader.
+GTFS_VALIDATOR = 'streaming'
+
+# Number of rows checked from each table by the quick pre-validation of uploaded GTFS
+# feeds, which reports structural problems before the full validation has run
+GTFS_PREVALIDATION_SAMPLE_ROWS = 1000
+
+# Number of processes the streaming validator checks GTFS tables in
+GTFS_VALIDATION_PROCESSES = 4
+
+# How valid GTFS feeds are imported: 'full' reloads every table through GeoTrellis,
+# 'incremental' applies only the changes from the currently loaded feed where it can,
+# and falls back to a full import otherwise.
+GTFS_IMPORT_MODE = 'full'
+
+# Number of example rows saved with each distinct GTFS problem
+GTFS_PROBLEM_SAMPLE_ROWS = 10
+
+# How uploaded realtime stop times are loaded: 'copy' streams the file into the table
+# with COPY FROM STDIN, 'orm' creates RealStopTime objects in batches.
+REALTIME_LOADER = 'copy'
+
+# Number of days of observed stop times kept, counting back from the latest service
+# date loaded; older days are dropped after each import, whichever the loader.
+REALTIME_RETENTION_DAYS = 28
+
+# Locally stored .osm.pbf file (a regional extract or the planet) that OSM imports with
+# the 'pbf' source clip their roads out of, unless they name their own file.
+OSM_PBF_PATH = ''
+
+# Margin (in degrees) added on each side of the extent of the GTFS stops when clipping
+# roads out of a local .osm.pbf file
+OSM_PBF_MARGIN = 0.01
+
+# Size (in meters) of the grid the features of boundary shapefiles are snapped to before
+# they're unioned into one boundary, closing slivers between them; 0 doesn't snap them.
+BOUNDARY_UNION_GRID_SIZE = 0
+
+# Number of demographic features, by id, clipped to the region boundary in each transaction
+DEMOGRAPHICS_CLIP_CHUNK_SIZE = 10000
+
+# How the demographic grid is built: 'postgis' gives each feature's metrics in equal
+# shares to the grid points inside it, 'numpy' rasterizes the features, spreading
+# their metrics over the cells by the exact area they cover, and also writes the
+# rasters out for the Scala service.
+DEMOGRAPHIC_GRID_ENGINE = 'postgis'
+
+# Width and height (in cells) of the tiles the 'numpy' grid engine rasterizes at once
+DEMOGRAPHIC_RASTER_TILE_SIZE = 512
+
+# Directory the 'numpy' grid engine writes its rasters into; the data directory of the
+# Scala service's raster catalog
+DEMOGRAPHIC_RASTER_DIR = os.path.normpath(os.path.join(BASE_DIR, '..', '..', '..', 'scala',
+                                                       'opentransit', 'data', 'data'))
+
+# Widths and heights (in units of DJANGO_SRID) of the cells of the grids the demographic
+# metrics are summed over after a load, for drawing them at each zoom level. Sizes that
+# are multiples of a smaller size are summed from that size's cells.
+DEMOGRAPHIC_PYRAMID_CELL_SIZES = (1000, 4000, 16000, 64000)
+
+# Number of quantiles, and of histogram bins, in the summary statistics of each demographic metric
+DEMOGRAPHIC_SUMMARY_QUANTILES = 5
+DEMOGRAPHIC_SUMMARY_HISTOGRAM_BINS = 20
+
 # Temporary default city_name for indicators
 OTI_CITY_NAME = 'My City'
 
@@ -165,6 +165,11 @@ class OTIIndicatorsConfigTestCase(TestCase):
         check_negative_number(self.data, 'nearby_buffer_distance_m')
         check_negative_number(self.data, 'max_commute_time_s')
         check_negative_number(self.data, 'arrive_by_time_s')
+        check_negative_number(self.data, 'demographic_grid_resolution_m')
+
+        bad_data = dict(self.data, demographic_grid_resolution_m=0)
+        response = self.client.post(self.list_url, bad_data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
 
 class SamplePeriodsTestCase(TestCase):
@@ -14,6 +14,8 @@ router.register(r'boundary-problems', datasourcesviews.BoundaryProblemViewSet)
 router.register(r'demographics', datasourcesviews.DemographicDataSourceViewSet)
 router.register(r'demographics-features', datasourcesviews.DemographicDataFeatureViewSet)
 router.register(r'demographics-problems', datasourcesviews.DemographicDataSourceProblemViewSet)
+router.register(r'demographics-grid', datasourcesviews.DemographicDataGridCellViewSet)
+router.register(r'demographics-summaries', datasourcesviews.DemographicDataSummaryViewSet)
 router.register(r'real-time', datasourcesviews.RealTimeViewSet, base_name='real-time')
 router.register(r'real-time-problems', datasourcesviews.RealTimeProblemViewSet, base_name='real-time-problems')
 router.register(r'osm-data', datasourcesviews.OSMDataViewSet, base_name='osm-data')
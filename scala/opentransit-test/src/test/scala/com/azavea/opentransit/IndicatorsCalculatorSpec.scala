@@ -164,6 +164,46 @@ trait ObservedStopTimeSpec { this: IndicatorSpec =>
 
     def missingTripData: Int = 0
   }
+
+  // Deviations as gtfs_stop_time_deviations holds them, from the same matched stops
+  // Headways of each matched stop (by trip id and index), scheduled and observed: the
+  // time since the previous arrival of the route at the stop, None for the first one
+  lazy val periodHeadways: Map[(String, Int), (Option[Int], Option[Int])] = {
+    def headways(arrivals: Seq[((String, Int), LocalDateTime)]): Map[(String, Int), Int] = {
+      val sorted = arrivals.sortWith((a, b) => a._2.compareTo(b._2) < 0)
+      sorted.zip(sorted.drop(1)).map { case ((_, previous), (key, arrival)) =>
+        key -> org.joda.time.Seconds.secondsBetween(previous, arrival).getSeconds
+      }.toMap
+    }
+
+    system.routes.flatMap { route =>
+      val matched = route.trips.flatMap { trip =>
+        observedPeriodTrips(trip.id).zipWithIndex.map { case ((sched, obsvd), i) =>
+          ((trip.id, i), sched, obsvd)
+        }
+      }
+      matched.groupBy(_._2.stop.id).values.flatMap { atStop =>
+        val scheduled = headways(atStop.map { case (key, sched, _) => (key, sched.arrivalTime) })
+        val observed = headways(atStop.map { case (key, _, obsvd) => (key, obsvd.arrivalTime) })
+        atStop.map { case (key, _, _) => key -> (scheduled.get(key), observed.get(key)) }
+      }
+    }.toMap
+  }
+
+  trait StopTimeDeviationSpecParams extends StopTimeDeviations {
+    def deviationsByTrip(tripId: String): Seq[StopTimeDeviation] =
+      observedPeriodTrips(tripId).zipWithIndex.map { case ((sched, obsvd), i) =>
+        def seconds(from: LocalDateTime, to: LocalDateTime): Option[Int] =
+          Some(org.joda.time.Seconds.secondsBetween(from, to).getSeconds)
+        val (scheduledHeadway, observedHeadway) = periodHeadways((tripId, i))
+        StopTimeDeviation(tripId, sched.stop.id, i + 1,
+          seconds(sched.arrivalTime, obsvd.arrivalTime),
+          seconds(sched.departureTime, obsvd.departureTime),
+          seconds(sched.arrivalTime, sched.departureTime),
+          seconds(obsvd.arrivalTime, obsvd.departureTime),
+          scheduledHeadway, observedHeadway)
+      }
+  }
 }
 
 trait BoundariesSpec {this: IndicatorSpec =>
@@ -9,9 +9,9 @@ import org.scalatest._
 import org.scalatest.OptionValues._
 
 class DwellTimeSpec extends FlatSpec with Matchers with IndicatorSpec with ObservedStopTimeSpec {
-  val observedMapping = new ObservedStopTimeSpecParams {}
+  val deviations = new StopTimeDeviationSpecParams {}
   it should "calculate dwell time performance for SEPTA" in {
-    val calculation = new DwellTimePerformance(observedMapping).calculation(period)
+    val calculation = new DwellTimePerformance(deviations).calculation(period)
     val AggregatedResults(byRoute, byRouteType, bySystem) = calculation(system)
     // The arrival / departure times were randomly nudged by up to 15 minutes in either direction,
     // which results in the average dwell time deviation being 5 minutes. I haven't quite wrapped
@@ -18,7 +18,7 @@ class HeadwayRegularitySpec
     with ObservedStopTimeSpec {
 
 
-  val observedMapping = new ObservedStopTimeSpecParams {}
+  val deviations = new StopTimeDeviationSpecParams {}
 
   // The observed data was created by randomly increasing the arrival and departure times
   // for each stop by up to 15 minutes (mean of 7.5 minutes). This would not be expected to
@@ -26,7 +26,7 @@ class HeadwayRegularitySpec
   // the same direction by the same amount on average. The actual value is roughly in line with
   // these expectations.
   it should "calculate the regularity of headway for SEPTA" in {
-    val calculation = new HeadwayRegularity(observedMapping).calculation(period)
+    val calculation = new HeadwayRegularity(deviations).calculation(period)
     val AggregatedResults(byRoute, byRouteType, bySystem) = calculation(system)
     bySystem.get should be (0.6867 +- 1e-1)
   }
@@ -18,11 +18,11 @@ class OnTimePerformanceSpec
     with ObservedStopTimeSpec {
 
 
-  val observedMapping = new ObservedStopTimeSpecParams {}
+  val deviations = new StopTimeDeviationSpecParams {}
 
   // Noise with a mean value of 7.5 minutes was introduced to create this simulated observational data
   it should "calculate on time performance for SEPTA" in {
-    val calculation = new OnTimePerformance(observedMapping).calculation(period)
+    val calculation = new OnTimePerformance(deviations).calculation(period)
     val AggregatedResults(byRoute, byRouteType, bySystem) = calculation(system)
     bySystem.get should be (7.5 +- 1e-1)
   }
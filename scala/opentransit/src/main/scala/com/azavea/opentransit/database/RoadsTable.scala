@@ -6,6 +6,7 @@ import geotrellis.slick._
 import grizzled.slf4j.Logging
 
 import scala.slick.driver.{JdbcDriver, JdbcProfile, PostgresDriver}
+import scala.slick.jdbc.{StaticQuery => Q}
 
 /**
   * A multiline of all roads pulled from OSM.
@@ -42,4 +43,22 @@ object RoadsTable extends Logging {
     val roads = roadTable.list
     roads.map(_.geom.geom)
   }
+
+  /**
+  * Returns the length (in km) of all roads in the imported extent, as precomputed
+  * into osm_road_lengths by the OSM import; None if it hasn't been computed. Reads
+  * the all-class row (NULL highway): the per-class rows overlap where roads share
+  * segments, so their sum would count those twice
+  */
+  def precomputedRoadLength(implicit session: Session): Option[Double] = {
+    val computed = Q.queryNA[Boolean]("""
+      SELECT EXISTS (SELECT 1 FROM information_schema.tables
+                     WHERE table_name = 'osm_road_lengths');""").first
+    if (computed)
+      Q.queryNA[Option[Double]]("""
+        SELECT length_m / 1000 FROM osm_road_lengths
+        WHERE boundary_id IS NULL AND highway IS NULL;""").firstOption.flatten
+    else
+      None
+  }
 }
@@ -0,0 +1,45 @@
+package com.azavea.opentransit.database
+
+import grizzled.slf4j.Logging
+
+import scala.slick.jdbc.{GetResult, StaticQuery => Q}
+import scala.slick.jdbc.JdbcBackend.Session
+
+/**
+  * How an observed stop time deviates from the scheduled one, as precomputed into
+  * gtfs_stop_time_deviations (times in seconds; None where a time is missing). The
+  * headways are the times since the previous arrival of the route at the stop
+  */
+case class StopTimeDeviation(
+  tripId: String,
+  stopId: String,
+  stopSequence: Int,
+  arrivalDelay: Option[Int],
+  departureDelay: Option[Int],
+  scheduledDwell: Option[Int],
+  observedDwell: Option[Int],
+  scheduledHeadway: Option[Int],
+  observedHeadway: Option[Int]
+)
+
+object StopTimeDeviationsTable extends Logging {
+  implicit val getStopTimeDeviationResult =
+    GetResult(r => StopTimeDeviation(r.<<, r.<<, r.<<, r.<<, r.<<, r.<<, r.<<, r.<<, r.<<))
+
+  /**
+  * Returns the deviations of the observed service date read by the indicators (see
+  * gtfs_observed_service_date), building them first if they haven't been
+  */
+  def observedDeviations(implicit session: Session): List[StopTimeDeviation] = {
+    val count = Q.queryNA[Int]("SELECT EnsureStopTimeDeviations();").first
+    debug(s"Stop time deviations of the observed service date: $count")
+    if (count > 0)
+      Q.queryNA[StopTimeDeviation]("""
+        SELECT trip_id, stop_id, stop_sequence, arrival_delay, departure_delay,
+               scheduled_dwell, observed_dwell, scheduled_headway, observed_headway
+        FROM gtfs_stop_time_deviations
+        WHERE service_date = (SELECT service_date FROM gtfs_observed_service_date);""").list
+    else
+      Nil
+  }
+}
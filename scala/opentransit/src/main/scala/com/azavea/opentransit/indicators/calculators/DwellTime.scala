@@ -8,18 +8,20 @@ import com.github.nscala_time.time.Imports._
 import org.joda.time._
 
 /** This indicator calculates the average deviation from scheduled dwell time
- *  in minutes.
+ *  in minutes, from the dwell times precomputed at realtime import.
  */
-class DwellTimePerformance(params: ObservedStopTimes) extends Indicator with AggregatesByAll {
+class DwellTimePerformance(params: StopTimeDeviations) extends Indicator with AggregatesByAll {
   type Intermediate = Seq[Double]
 
   val name = "dwell_time"
 
   def calculation(period: SamplePeriod) = {
     def map(trip: Trip): Seq[Double] = {
-      params.observedStopsByTrip(trip.id).map { case (sched, obsvd) =>
-          dwellTimeDeviation(sched, obsvd)
-      }
+      for {
+        deviation <- params.deviationsByTrip(trip.id)
+        scheduled <- deviation.scheduledDwell
+        observed <- deviation.observedDwell
+      } yield (scheduled - observed).abs.toDouble
     }
 
     def reduce(deviations: Seq[Seq[Double]]): Double = {
@@ -34,9 +36,4 @@ class DwellTimePerformance(params: ObservedStopTimes) extends Indicator with Agg
 
     perTripCalculation(map, reduce)
   }
-
-  def dwellTimeDeviation(s1: ScheduledStop, s2: ScheduledStop): Double = {
-    (Seconds.secondsBetween(s1.arrivalTime, s1.departureTime).getSeconds -
-     Seconds.secondsBetween(s2.arrivalTime, s2.departureTime).getSeconds).abs.toDouble
-  }
 }
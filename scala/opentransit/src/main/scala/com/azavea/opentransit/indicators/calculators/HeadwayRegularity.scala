@@ -1,7 +1,5 @@
 package com.azavea.opentransit.indicators.calculators
 
-import org.joda.time.Seconds
-
 import com.azavea.gtfs._
 import com.azavea.opentransit._
 import com.azavea.opentransit.indicators._
@@ -9,9 +7,10 @@ import com.azavea.opentransit.indicators.parameters._
 
 /**
 * This indicator calculates the average deviation between
-* frequency predicted and actually observed (in minutes)
+* frequency predicted and actually observed (in minutes),
+* from the headways precomputed at realtime import
 **/
-class HeadwayRegularity(params: ObservedStopTimes)
+class HeadwayRegularity(params: StopTimeDeviations)
     extends Indicator
       with AggregatesByAll {
   type Intermediate = Double
@@ -21,9 +20,9 @@ class HeadwayRegularity(params: ObservedStopTimes)
   def calculation(period: SamplePeriod) = {
 
     def map(trips: Seq[Trip]): Double = {
-      val scheduledHeadway = tripsToHeadway(trips)
-      val observedHeadway = tripsToHeadway(trips.map { trip => 
-        params.observedTripById(trip.id) }.toSeq)
+      val deviations = trips.flatMap { trip => params.deviationsByTrip(trip.id) }
+      val scheduledHeadway = averageHeadway(deviations.flatMap(_.scheduledHeadway))
+      val observedHeadway = averageHeadway(deviations.flatMap(_.observedHeadway))
       if (observedHeadway != 0) (scheduledHeadway - observedHeadway).abs.toDouble / 60 // div60 for minutes
       else 0 // report no difference if missing observed headway
     }
@@ -38,23 +37,10 @@ class HeadwayRegularity(params: ObservedStopTimes)
     perRouteCalculation(map, reduce)
   }
 
-  def tripsToHeadway(trips: Seq[Trip]): Double = {
-    val headways: Seq[Double] =
-      trips.map { trip =>
-        trip.schedule
-          .groupBy(_.stop.id)
-      }.combineMaps.mapValues(arrivals =>
-        arrivals.sortWith((a,b) =>
-          a.arrivalTime.compareTo(b.arrivalTime) < 0)
-      ).flatMap { case (k, groupedStops) =>
-          groupedStops.zip(groupedStops.tail).map { case (a, b) =>
-            Seconds.secondsBetween(a.arrivalTime, b.arrivalTime).getSeconds.toDouble
-          }
-        }.toSeq
-
+  def averageHeadway(headways: Seq[Int]): Double = {
     val (total, count) =
-      headways.foldLeft((0.0, 0)) { case ((total, count), diff) =>
-        (total + diff, count + 1)
+      headways.foldLeft((0.0, 0)) { case ((total, count), headway) =>
+        (total + headway, count + 1)
       }
     if (count > 0) total / count else 0
   }
@@ -1,7 +1,5 @@
 package com.azavea.opentransit.indicators.calculators
 
-import org.joda.time.Seconds
-
 import com.azavea.gtfs._
 import com.azavea.opentransit._
 import com.azavea.opentransit.indicators._
@@ -9,9 +7,10 @@ import com.azavea.opentransit.indicators.parameters._
 
 /**
 * This indicator calculates the average deviation between
-* arrival times predicted and actually observed (in minutes)
+* arrival times predicted and actually observed (in minutes),
+* from the arrival delays precomputed at realtime import
 **/
-class OnTimePerformance(params: ObservedStopTimes)
+class OnTimePerformance(params: StopTimeDeviations)
     extends Indicator
       with AggregatesByAll {
   type Intermediate = Seq[Double]
@@ -22,9 +21,9 @@ class OnTimePerformance(params: ObservedStopTimes)
 
     def map(trip: Trip): Seq[Double] =
       for {
-        (sched, obs) <- params.observedStopsByTrip(trip.id)
-        deviation = Seconds.secondsBetween(sched.arrivalTime, obs.arrivalTime).getSeconds
-      } yield deviation.abs.toDouble
+        deviation <- params.deviationsByTrip(trip.id)
+        delay <- deviation.arrivalDelay
+      } yield delay.abs.toDouble
 
     def reduce(timeDeltas: Seq[Seq[Double]]): Double = {
       val (total, count) =
@@ -35,8 +35,10 @@ object ObservedStopTimes {
     lazy val observedSystem = {
       val observedGtfsRecords =
         db withSession { implicit session =>
+          // the view limits the observed stop times to the configured service date, so
+          // each trip is observed at most once and can be matched by its id alone
           new DatabaseGtfsRecords with DefaultProfile {
-            override val stopTimesTableName = "gtfs_stop_times_real"
+            override val stopTimesTableName = "gtfs_stop_times_observed"
           }
         }
       val builder = TransitSystemBuilder(observedGtfsRecords)
@@ -37,6 +37,7 @@ trait IndicatorParams extends Boundaries
                          with StaticParams
                          with Demographics
                          with ObservedStopTimes
+                         with StopTimeDeviations
 object IndicatorParams {
   def apply(
     request: IndicatorCalculationRequest,
@@ -55,6 +56,7 @@ object IndicatorParams {
 
     // Observed data and demographics are in the aux db
     val observedStopTimes = ObservedStopTimes(system, period, auxDb, request.paramsRequirements.observed)
+    val stopTimeDeviations = StopTimeDeviations(auxDb, request.paramsRequirements.observed)
     val demographics = Demographics(auxDb)
 
     new IndicatorParams {
@@ -64,6 +66,8 @@ object IndicatorParams {
         observedStopTimes.observedTripById(tripId)
       def missingTripData: Int =
         observedStopTimes.missingTripData
+      def deviationsByTrip(tripId: String) =
+        stopTimeDeviations.deviationsByTrip(tripId)
 
       def bufferForStop(stop: Stop): Projected[MultiPolygon] = stopBuffers.bufferForStop(stop)
       def bufferForStops(stops: Seq[Stop]): Projected[MultiPolygon] = stopBuffers.bufferForStops(stops)
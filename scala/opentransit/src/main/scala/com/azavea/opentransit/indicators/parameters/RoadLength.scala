@@ -17,7 +17,15 @@ trait RoadLength {
 }
 
 object RoadLength extends Logging {
-  def totalRoadLength(implicit session: Session): Double = {
+  def totalRoadLength(implicit session: Session): Double =
+    RoadsTable.precomputedRoadLength match {
+      case Some(len) =>
+        debug(s"Precomputed length of roadlines: $len")
+        len
+      case None => measuredRoadLength
+    }
+
+  def measuredRoadLength(implicit session: Session): Double = {
     debug("Fetching Roads")
     val roadLines: List[Line] = RoadsTable.allRoads
     val distinctRoadLines: Array[Line] =
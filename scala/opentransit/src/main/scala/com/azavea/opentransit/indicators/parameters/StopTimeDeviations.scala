@@ -0,0 +1,27 @@
+package com.azavea.opentransit.indicators.parameters
+
+import com.azavea.opentransit.database.{ StopTimeDeviation, StopTimeDeviationsTable }
+
+import scala.slick.jdbc.JdbcBackend.DatabaseDef
+
+/**
+ * Trait used to populate parameters with the deviations of observed stop times
+ * from the schedule, precomputed at realtime import
+ */
+trait StopTimeDeviations {
+  def deviationsByTrip(tripId: String): Seq[StopTimeDeviation]
+}
+
+object StopTimeDeviations {
+  def apply(db: DatabaseDef, hasObserved: Boolean): StopTimeDeviations = {
+    lazy val deviations: Map[String, Seq[StopTimeDeviation]] =
+      db withSession { implicit session =>
+        StopTimeDeviationsTable.observedDeviations.groupBy(_.tripId)
+      }
+
+    new StopTimeDeviations {
+      def deviationsByTrip(tripId: String): Seq[StopTimeDeviation] =
+        if (hasObserved) deviations.getOrElse(tripId, Nil) else Nil
+    }
+  }
+}